@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Backup codec benchmark
+# Compares the write/read throughput and compression ratio of each backup codec
+# on a synthetic KV Store collection.  Runs without Splunk.
+#
+# Usage: python3 benchmarks/codec_benchmark.py [--records 200000] [--width narrow|wide] [--level 6] [--json]
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+from kv_compression import codecs
+
+def generate_collection(records, width, seed=0):
+	"""Build a backup file body (JSON array, one record per line) with realistic redundancy"""
+	rnd = random.Random(seed)
+	words = [''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(3, 10))) for _ in range(500)]
+	field_count = 8 if width == 'narrow' else 60
+	lines = []
+	for i in range(records):
+		record = {'_key': '%024x' % rnd.getrandbits(96), '_user': 'nobody', 'id': i}
+		for f in range(field_count):
+			if f % 3 == 0:
+				record['field%d' % f] = rnd.randint(0, 100000)
+			else:
+				record['field%d' % f] = ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 6)))
+		lines.append(json.dumps(record))
+	return ('[' + ',\n'.join(lines) + ']').encode('utf-8')
+
+def benchmark_codec(codec, data, level, threads, tmp_dir, chunk_size=1048576):
+	filename = os.path.join(tmp_dir, 'benchmark#collection#0.json' + codec.extension)
+	start = time.time()
+	fh = codec.open_writer(filename, level, threads)
+	for i in range(0, len(data), chunk_size):
+		fh.write(data[i:i+chunk_size])
+	fh.close()
+	write_seconds = time.time() - start
+
+	start = time.time()
+	with codec.open_reader(filename) as fh:
+		read_back = fh.read()
+	read_seconds = time.time() - start
+	if read_back != data:
+		raise Exception('%s: data read back does not match' % codec.name)
+
+	compressed_bytes = os.path.getsize(filename)
+	os.remove(filename)
+	mb = len(data) / 1048576.0
+	return {
+		'codec': codec.name,
+		'level': level,
+		'uncompressed_bytes': len(data),
+		'compressed_bytes': compressed_bytes,
+		'ratio': round(len(data) / float(compressed_bytes), 2),
+		'write_seconds': round(write_seconds, 3),
+		'read_seconds': round(read_seconds, 3),
+		'write_mb_per_sec': round(mb / write_seconds, 1) if write_seconds > 0 else None,
+		'read_mb_per_sec': round(mb / read_seconds, 1) if read_seconds > 0 else None
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare backup codec throughput and compression ratio')
+	parser.add_argument('--records', type=int, default=200000, help='Number of records in the synthetic collection')
+	parser.add_argument('--width', choices=['narrow', 'wide'], default='narrow', help='Record width')
+	parser.add_argument('--level', type=int, default=6, help='Compression level')
+	parser.add_argument('--threads', type=int, default=0, help='Compression threads (gzip/zstd, 0 = one per core)')
+	parser.add_argument('--codecs', default=','.join(sorted(codecs.keys())), help='Comma-separated codecs to test')
+	parser.add_argument('--json', action='store_true', help='Print results as JSON')
+	args = parser.parse_args()
+
+	data = generate_collection(args.records, args.width)
+	results = []
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		for name in args.codecs.split(','):
+			results.append(benchmark_codec(codecs[name.strip()], data, args.level, args.threads, tmp_dir))
+
+	if args.json:
+		print(json.dumps(results, indent=2))
+	else:
+		print('%-6s %10s %8s %12s %12s' % ('codec', 'size (MB)', 'ratio', 'write MB/s', 'read MB/s'))
+		for r in results:
+			print('%-6s %10.1f %8.2f %12s %12s' % (r['codec'], r['compressed_bytes'] / 1048576.0, r['ratio'], r['write_mb_per_sec'], r['read_mb_per_sec']))
+
+if __name__ == '__main__':
+	main()
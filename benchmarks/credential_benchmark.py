@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Credential decryption benchmark
+# Times decrypting remote Splunk credentials ($7$ AES-256-GCM passwords) with the
+# bundled pure-Python splunksecrets implementation, with native AES-GCM (if the
+# cryptography package is installed) and from the per-process cache.  Runs without
+# Splunk, but needs the six package (included with Splunk's Python).
+#
+# Usage: python3 benchmarks/credential_benchmark.py [--credentials 5] [--iterations 3] [--json]
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+import kv_credentials
+from splunksecrets import encrypt_new
+
+def time_decrypt(splunk_secret, ciphertexts, iterations, native, cached):
+	"""Average seconds to decrypt each of the ciphertexts once"""
+	seconds = []
+	for i in range(iterations):
+		if not cached:
+			kv_credentials.clear_cache()
+		start = time.time()
+		for ciphertext in ciphertexts:
+			kv_credentials.decrypt_password(splunk_secret, ciphertext, native=native)
+		seconds.append(time.time() - start)
+	return sum(seconds) / len(seconds)
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare credential decryption methods')
+	parser.add_argument('--credentials', type=int, default=5, help='Number of credentials to decrypt')
+	parser.add_argument('--iterations', type=int, default=3, help='Number of times to repeat each test')
+	parser.add_argument('--json', action='store_true', help='Print results as JSON')
+	args = parser.parse_args()
+
+	rnd = random.Random(0)
+	# splunk.secret is 255 printable characters
+	splunk_secret = ''.join(rnd.choice(string.ascii_letters + string.digits + './') for _ in range(255))
+	passwords = [''.join(rnd.choice(string.ascii_letters) for _ in range(16)) for _ in range(args.credentials)]
+	ciphertexts = [encrypt_new(splunk_secret, p) for p in passwords]
+
+	# Check that each method gets the right passwords
+	for native in [False, True]:
+		kv_credentials.clear_cache()
+		if [kv_credentials.decrypt_password(splunk_secret, c, native=native) for c in ciphertexts] != passwords:
+			raise Exception('Decrypted passwords do not match (native=%s)' % native)
+
+	tests = [('pure-python', False, False)]
+	if kv_credentials.native_aes_gcm() is not None:
+		tests.append(('native', True, False))
+	tests.append(('cached', True, True))
+
+	results = []
+	for name, native, cached in tests:
+		kv_credentials.clear_cache()
+		if cached:
+			time_decrypt(splunk_secret, ciphertexts, 1, native, True)
+		seconds = time_decrypt(splunk_secret, ciphertexts, args.iterations, native, cached)
+		results.append({
+			'method': name,
+			'credentials': args.credentials,
+			'seconds': round(seconds, 6),
+			'ms_per_credential': round(seconds * 1000 / args.credentials, 3)
+		})
+
+	if args.json:
+		print(json.dumps(results, indent=2))
+	else:
+		if kv_credentials.native_aes_gcm() is None:
+			print('Native AES-GCM not available (install the cryptography package)')
+		print('%-12s %12s %18s' % ('method', 'seconds', 'ms/credential'))
+		for r in results:
+			print('%-12s %12.6f %18.3f' % (r['method'], r['seconds'], r['ms_per_credential']))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmark
+# Runs the backup (download_collection), restore (upload_collection), push
+# (copy_collection), deletekeys, kvstorecreatefk and alert action code paths against
+# stub splunkd servers, on synthetic collections of several sizes and widths.
+# Each command runs in its own process, as in Splunk. Records/s, bytes/s (on the
+# wire), peak RSS and splunkd request counts are written as JSON so that releases
+# can be compared.
+#
+# Needs the Splunk SDK for Python (splunk-sdk package or --sdk), openssl, and the
+# cryptography package (or six, for the bundled splunksecrets) to encrypt the
+# remote credential used by kvstorepush.
+#
+# Usage: python3 benchmarks/e2e_benchmark.py [--sizes 10k,1m] [--widths narrow,wide] [--paths backup,restore] [--output results.json] [--compare baseline.json]
+
+import argparse
+import base64
+import csv
+import glob
+import gzip
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BENCHMARK_DIR, '..'))
+BIN_DIR = os.path.join(APP_DIR, 'bin')
+sys.path.insert(0, BENCHMARK_DIR)
+from stub_splunkd import stub_splunkd, synthetic_records
+from run_command import run_search_command, run_process, command_environment
+
+PATHS = ['backup', 'restore', 'push', 'deletekeys', 'createfk', 'alert']
+APP = 'kvst_benchmark'
+SESSION_KEY = 'benchmark-session-key'
+
+def parse_size(size):
+	size = size.strip().lower()
+	multiplier = 1
+	if size[-1] in 'km':
+		multiplier = 1000 if size[-1] == 'k' else 1000000
+		size = size[:-1]
+	return int(float(size) * multiplier)
+
+def app_version():
+	with open(os.path.join(APP_DIR, 'default', 'app.conf'), 'r') as f:
+		for line in f:
+			if line.strip().startswith('version'):
+				return line.split('=', 1)[1].strip()
+	return None
+
+def encrypt_password(splunk_secret, password):
+	"""Encrypt a password the way Splunk does ($7$, AES-256-GCM)"""
+	try:
+		from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+	except ImportError:
+		sys.path.insert(0, os.path.join(BIN_DIR, 'lib'))
+		from splunksecrets import encrypt_new
+		return encrypt_new(splunk_secret, password)
+	key = hashlib.pbkdf2_hmac('sha256', splunk_secret.encode()[:254], b'disk-encryption', 1, 32)
+	iv = os.urandom(16)
+	return '$7$' + base64.b64encode(iv + AESGCM(key).encrypt(iv, password.encode(), None)).decode()
+
+class benchmark_run:
+	"""Stub servers, a fake $SPLUNK_HOME and the settings shared by every benchmark"""
+	def __init__(self, args, work_dir):
+		self.args = args
+		self.work_dir = work_dir
+		limits = {'max_rows_per_query': args.max_rows_per_query, 'max_documents_per_batch_save': args.max_documents_per_batch_save}
+		self.local = stub_splunkd(session_key=SESSION_KEY, limits=limits, latency=args.latency_ms / 1000).start()
+		self.remote = stub_splunkd(limits=limits, latency=args.latency_ms / 1000).start()
+
+		self.splunk_home = os.path.join(work_dir, 'splunk')
+		self.backup_dir = os.path.join(work_dir, 'backups')
+		os.makedirs(os.path.join(self.splunk_home, 'etc', 'auth'))
+		os.makedirs(self.backup_dir)
+		splunk_secret = hashlib.sha512(os.urandom(64)).hexdigest() * 2
+		with open(os.path.join(self.splunk_home, 'etc', 'auth', 'splunk.secret'), 'w') as f:
+			f.write(splunk_secret[0:255])
+		remote_user = sorted(self.remote.users.keys())[0]
+		settings = {
+			'default_path': self.backup_dir,
+			'log_level': 'WARNING',
+			'retention_days': 0,
+			'retention_size': 0,
+			'credential1': '%s:%s:%s' % (self.remote.host, remote_user, encrypt_password(splunk_secret[0:255], self.remote.users[remote_user]['password']))
+		}
+		settings.update(dict([s.split('=', 1) for s in args.setting]))
+		self.conf_file = os.path.join(work_dir, 'conf.json')
+		with open(self.conf_file, 'w') as f:
+			json.dump({'kvstore_tools': {'settings': settings}}, f)
+		self.env = command_environment(self.local.uri, self.splunk_home, self.conf_file, args.sdk, self.local.certfile)
+
+	def stop(self):
+		self.local.stop()
+		self.remote.stop()
+
+	def reset_stats(self):
+		self.local.stats.reset()
+		self.remote.stats.reset()
+
+	def command(self, command, args, records=None):
+		return run_search_command(command, args, records, self.local.uri, SESSION_KEY, app=APP, env=self.env)
+
+	def alert(self, collection, records):
+		"""Run the alert action with a results file, as splunkd does"""
+		results_file = os.path.join(self.work_dir, 'results.csv.gz')
+		fieldnames = list(records[0].keys())
+		with gzip.open(results_file, 'wt', newline='') as f:
+			writer = csv.DictWriter(f, fieldnames=fieldnames)
+			writer.writeheader()
+			writer.writerows(records)
+		payload = {
+			'app': APP,
+			'server_uri': self.local.uri,
+			'session_key': SESSION_KEY,
+			'results_file': results_file,
+			'configuration': {'collection': collection, 'overwrite': '0'}
+		}
+		start = time.time()
+		exit_code, stdout, stderr, max_rss = run_process([sys.executable, 'alert_kvstore.py', '--execute'], self.env, BIN_DIR, json.dumps(payload).encode())
+		return {'exit_code': exit_code, 'rows': [], 'messages': [], 'stderr': stderr.decode('utf-8', 'replace'),
+			'seconds': time.time() - start, 'max_rss_kb': max_rss}
+
+def result_row(run, path, command, size, width, records, result, stored=None):
+	"""A result row for one benchmark run. stored, if given, is the number of records the run actually
+	wrote. Failed runs (errors, HTTP errors that weren't injected, or missing records) report no
+	records or throughput."""
+	local, remote = run.local.stats.to_dict(), run.remote.stats.to_dict()
+	wire_bytes = local['bytes_in'] + local['bytes_out'] + remote['bytes_in'] + remote['bytes_out']
+	requests = dict(local['requests'])
+	for endpoint, count in remote['requests'].items():
+		requests['remote_' + endpoint] = count
+	http_errors = dict(local['errors'])
+	for endpoint, count in remote['errors'].items():
+		http_errors['remote_' + endpoint] = count
+	injected_failures = local['injected_failures'] + remote['injected_failures']
+	seconds = result['seconds']
+	errors = [m[1] for m in result['messages'] if m[0] in ['ERROR', 'FATAL']]
+	if result['exit_code'] != 0 and len(errors) == 0:
+		errors = result['stderr'].strip().splitlines()[-1:]
+	if sum(http_errors.values()) > injected_failures:
+		errors.append('HTTP errors: %s' % ', '.join(['%s:%d' % e for e in sorted(http_errors.items())]))
+	if stored is not None and stored < records:
+		errors.append('Only %d of %d records were stored' % (stored, records))
+	if result['exit_code'] != 0 or len(errors) > 0:
+		records = None
+	return {
+		'path': path,
+		'command': command,
+		'collection_records': size,
+		'width': width,
+		'records': records,
+		'seconds': round(seconds, 4),
+		'records_per_second': round(records / seconds, 1) if records is not None and seconds > 0 else None,
+		'bytes': wire_bytes,
+		'bytes_per_second': round(wire_bytes / seconds, 1) if records is not None and seconds > 0 else None,
+		'max_rss_kb': result['max_rss_kb'],
+		'requests': requests,
+		'total_requests': local['total_requests'] + remote['total_requests'],
+		'http_errors': http_errors,
+		'injected_failures': injected_failures,
+		'exit_code': result['exit_code'],
+		'errors': errors
+	}
+
+def benchmark_collection(run, size, width, paths, log):
+	"""Run each benchmark path on one collection size/width. Returns the result rows."""
+	results = []
+	collection = 'bench_%s_%d' % (width, size)
+	stream_records = min(size, run.args.stream_records)
+	log('Generating %d %s records' % (size, width))
+	records = list(synthetic_records(size, width, seed=size))
+	run.local.backend.create_collection(APP, collection)
+	run.local.backend.load(APP, collection, records)
+	run.remote.backend.create_collection(APP, collection)
+
+	def measure(path, command, count, function, stored=None):
+		run.reset_stats()
+		log('Running %s on %d %s records' % (path, count, width))
+		result = function()
+		row = result_row(run, path, command, size, width, count, result, stored() if stored else None)
+		log('  %.3f s, %s records/s, %d requests, peak RSS %d KB%s' % (row['seconds'], row['records_per_second'],
+			row['total_requests'], row['max_rss_kb'], ', errors: ' + '; '.join(row['errors']) if row['errors'] else ''))
+		results.append(row)
+		return row
+
+	for old_file in glob.glob(os.path.join(run.backup_dir, '*')):
+		if os.path.isfile(old_file):
+			os.remove(old_file)
+	if 'backup' in paths or 'restore' in paths:
+		measure('backup', 'kvstorebackup', size, lambda: run.command('kvstorebackup', ['app=%s' % APP, 'collection=%s' % collection]))
+	if 'restore' in paths:
+		backups = sorted(glob.glob(os.path.join(run.backup_dir, '%s#%s#*' % (APP, collection))))
+		backups = [b for b in backups if not b.endswith('.idx')]
+		measure('restore', 'kvstorerestore', size, lambda: run.command('kvstorerestore', ['filename=%s' % os.path.basename(backups[-1]).split('#part')[0]]))
+	if 'push' in paths:
+		measure('push', 'kvstorepush', size, lambda: run.command('kvstorepush', ['app=%s' % APP, 'collection=%s' % collection,
+			'target=%s' % run.remote.host, 'targetport=%d' % run.remote.port]))
+	if 'deletekeys' in paths:
+		keys = [{'_key': r['_key']} for r in records[0:stream_records]]
+		measure('deletekeys', 'deletekeys', stream_records, lambda: run.command('deletekeys', ['collection=%s' % collection], keys))
+	if 'createfk' in paths:
+		fk_collection = collection + '_fk'
+		run.local.backend.create_collection(APP, fk_collection)
+		events = [{'group': 'g%d' % (r['id'] % run.args.groups), 'id': str(r['id'])} for r in records[0:stream_records]]
+		measure('createfk', 'kvstorecreatefk', stream_records, lambda: run.command('kvstorecreatefk', ['app=%s' % APP,
+			'collection=%s' % fk_collection, 'groupby=group', 'outputvalues="group=$group$, first_id=$id$"'], events))
+	if 'alert' in paths:
+		alert_collection = collection + '_alert'
+		run.local.backend.create_collection(APP, alert_collection)
+		# The alert action saves all of the results in one batch_save request
+		alert_records = min(stream_records, run.args.max_documents_per_batch_save)
+		rows = [dict([(k, v if isinstance(v, str) else json.dumps(v)) for k, v in r.items() if k != '_user']) for r in records[0:alert_records]]
+		measure('alert', 'alert_kvstore', alert_records, lambda: run.alert(alert_collection, rows),
+			lambda: len(run.local.backend.query(APP, alert_collection)))
+
+	for c in [collection, collection + '_fk', collection + '_alert']:
+		for stub in [run.local, run.remote]:
+			try:
+				stub.backend.remove_collection(APP, c)
+			except Exception:
+				pass
+	return results
+
+def compare(results, baseline_file):
+	"""Print the change in records/s from a previous run"""
+	with open(baseline_file, 'r') as f:
+		baseline = json.load(f)
+	previous = dict([((r['path'], r['collection_records'], r['width']), r) for r in baseline['results']])
+	print('Compared with %s (version %s)' % (baseline_file, baseline.get('version')), file=sys.stderr)
+	print('%-11s %10s %-7s %14s %14s %8s %10s' % ('path', 'records', 'width', 'records/s', 'baseline', 'change', 'RSS change'), file=sys.stderr)
+	for r in results:
+		p = previous.get((r['path'], r['collection_records'], r['width']))
+		if p is None or not p['records_per_second'] or not r['records_per_second']:
+			continue
+		print('%-11s %10d %-7s %14.1f %14.1f %+7.1f%% %+9.1f%%' % (r['path'], r['collection_records'], r['width'], r['records_per_second'],
+			p['records_per_second'], (r['records_per_second'] / p['records_per_second'] - 1) * 100,
+			(float(r['max_rss_kb']) / p['max_rss_kb'] - 1) * 100 if p['max_rss_kb'] else 0), file=sys.stderr)
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the KV Store Tools commands against stub splunkd servers')
+	parser.add_argument('--sizes', default='10k', help='Collection sizes, comma separated (e.g. 10k,1m,10m). Collections are held in memory.')
+	parser.add_argument('--widths', default='narrow,wide', help='Record widths: narrow (8 fields) and/or wide (60 fields)')
+	parser.add_argument('--paths', default=','.join(PATHS), help='Code paths to benchmark: %s' % ', '.join(PATHS))
+	parser.add_argument('--stream-records', type=int, default=10000, help='Maximum number of search results for deletekeys, createfk and the alert action')
+	parser.add_argument('--groups', type=int, default=100, help='Number of distinct group-by values for createfk')
+	parser.add_argument('--latency-ms', type=float, default=0, help='Latency added to each splunkd request')
+	parser.add_argument('--max-rows-per-query', type=int, default=50000)
+	parser.add_argument('--max-documents-per-batch-save', type=int, default=1000)
+	parser.add_argument('--setting', action='append', default=[], help='kvstore_tools.conf setting for the commands (name=value)')
+	parser.add_argument('--sdk', help='Directory containing the splunklib package, if it is not installed')
+	parser.add_argument('--output', help='Write the results to this JSON file (default: stdout)')
+	parser.add_argument('--compare', help='Results file from a previous run to compare with')
+	parser.add_argument('--quiet', action='store_true', help='Do not print progress')
+	args = parser.parse_args()
+
+	sizes = [parse_size(s) for s in args.sizes.split(',')]
+	widths = [w.strip() for w in args.widths.split(',')]
+	paths = [p.strip() for p in args.paths.split(',')]
+	for p in paths:
+		if p not in PATHS:
+			parser.error('Unknown path: %s' % p)
+	def log(message):
+		if not args.quiet:
+			print(message, file=sys.stderr, flush=True)
+
+	work_dir = tempfile.mkdtemp(prefix='kvst_benchmark_')
+	run = benchmark_run(args, work_dir)
+	results = []
+	try:
+		for size in sizes:
+			for width in widths:
+				results += benchmark_collection(run, size, width, paths, log)
+	finally:
+		run.stop()
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+	output = {
+		'version': app_version(),
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+		'git_commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, stdout=subprocess.PIPE,
+			stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None,
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'settings': {
+			'latency_ms': args.latency_ms,
+			'max_rows_per_query': args.max_rows_per_query,
+			'max_documents_per_batch_save': args.max_documents_per_batch_save,
+			'stream_records': args.stream_records,
+			'kvstore_tools': dict([s.split('=', 1) for s in args.setting])
+		},
+		'results': results
+	}
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(output, f, indent=2)
+	else:
+		print(json.dumps(output, indent=2))
+	if args.compare:
+		compare(results, args.compare)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Search command runner
+# Runs a KV Store Tools search command outside of Splunk, the way splunkd does:
+# in a new process, speaking the search command protocol (chunked protocol v2, or
+# v1 for the commands that are not chunked in commands.conf), with the search info
+# pointing at a splunkd server (usually benchmarks/stub_splunkd.py).
+#
+# Usage: python3 benchmarks/run_command.py --uri https://127.0.0.1:8089 --session-key KEY [--input records.json] kvstorebackup app=search collection=test
+
+import argparse
+import configparser
+import csv
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BENCHMARK_DIR, '..'))
+BIN_DIR = os.path.join(APP_DIR, 'bin')
+STUB_DIR = os.path.join(BENCHMARK_DIR, 'stubs')
+
+CHUNK_HEADER = re.compile(rb'chunked\s+1\.0\s*,\s*(\d+)\s*,\s*(\d+)\s*\n')
+
+def get_commands():
+	"""Get {command name: (script filename, chunked)} from commands.conf"""
+	parser = configparser.RawConfigParser(strict=False)
+	parser.read(os.path.join(APP_DIR, 'default', 'commands.conf'))
+	commands = {}
+	for name in parser.sections():
+		if parser.has_option(name, 'filename'):
+			chunked = parser.has_option(name, 'chunked') and parser.get(name, 'chunked').strip().lower() in ['1', 'true']
+			commands[name] = (parser.get(name, 'filename'), chunked)
+	return commands
+
+def command_environment(splunkd_uri, splunk_home, conf_file=None, sdk_path=None, certfile=None):
+	"""Environment for a command process: the Splunk stubs, $SPLUNK_HOME and the local splunkd URI.
+	certfile is the splunkd server certificate, for the requests that verify it."""
+	env = dict(os.environ)
+	paths = [STUB_DIR, BIN_DIR, os.path.join(BIN_DIR, 'lib')]
+	if sdk_path:
+		paths.insert(0, sdk_path)
+	env['PYTHONPATH'] = os.pathsep.join(paths)
+	env['SPLUNK_HOME'] = splunk_home
+	env['SPLUNKD_URI'] = splunkd_uri
+	if conf_file:
+		env['SPLUNK_STUB_CONF'] = conf_file
+	if certfile:
+		env['SSL_CERT_FILE'] = certfile
+	os.makedirs(os.path.join(splunk_home, 'var', 'log', 'splunk'), exist_ok=True)
+	os.makedirs(os.path.join(splunk_home, 'etc', 'auth'), exist_ok=True)
+	return env
+
+def records_to_csv(records):
+	fieldnames = []
+	for record in records:
+		for field in record:
+			if field not in fieldnames:
+				fieldnames.append(field)
+	output = io.StringIO()
+	writer = csv.DictWriter(output, fieldnames=fieldnames, lineterminator='\r\n')
+	writer.writeheader()
+	for record in records:
+		writer.writerow(dict([(k, v if isinstance(v, str) else json.dumps(v)) for k, v in record.items()]))
+	return output.getvalue() if len(records) > 0 else ''
+
+def csv_to_records(text):
+	rows = []
+	header = None
+	for row in csv.reader(io.StringIO(text)):
+		if len(row) == 0:
+			continue
+		if header is None or row == header:
+			# Each chunk of output starts with a header row
+			header = row
+			continue
+		rows.append(dict([(f, v) for f, v in zip(header, row) if not f.startswith('__mv_')]))
+	return rows
+
+def chunk(metadata, body=''):
+	metadata = json.dumps(metadata)
+	body = body.encode('utf-8')
+	return ('chunked 1.0,%d,%d\n%s' % (len(metadata.encode('utf-8')), len(body), metadata)).encode('utf-8') + body
+
+def read_chunks(output):
+	"""Split protocol v2 output into [(metadata, body)]"""
+	chunks = []
+	position = 0
+	while position < len(output):
+		m = CHUNK_HEADER.match(output, position)
+		if m is None:
+			break
+		# Lengths are in bytes
+		metadata_end = m.end() + int(m.group(1))
+		body_end = metadata_end + int(m.group(2))
+		chunks.append((json.loads(output[m.end():metadata_end].decode('utf-8')), output[metadata_end:body_end].decode('utf-8')))
+		position = body_end
+	return chunks
+
+def _peak_rss(pid):
+	"""Peak RSS (KB) of a running process's own address space, or None"""
+	try:
+		with open('/proc/%d/status' % pid, 'r') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1])
+	except (IOError, OSError, ValueError):
+		pass
+	return None
+
+def run_process(args, env, cwd, stdin_data):
+	"""Run a process, feeding stdin. Returns (exit code, stdout, stderr, peak RSS in KB)."""
+	process = subprocess.Popen(args, env=env, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	output = {}
+	peak = [None]
+	done = threading.Event()
+	def read(name, fh):
+		output[name] = fh.read()
+	def sample():
+		# On Linux, ru_maxrss also counts the parent's memory from before exec(), so
+		# sample the high water mark of the new address space while the process runs
+		while not done.wait(0.02):
+			rss = _peak_rss(process.pid)
+			if rss is not None:
+				peak[0] = max(peak[0] or 0, rss)
+	readers = [threading.Thread(target=read, args=('stdout', process.stdout)), threading.Thread(target=read, args=('stderr', process.stderr))]
+	sampler = threading.Thread(target=sample, daemon=True)
+	sampler.start()
+	for reader in readers:
+		reader.start()
+	try:
+		process.stdin.write(stdin_data)
+	except BrokenPipeError:
+		pass
+	process.stdin.close()
+	for reader in readers:
+		reader.join()
+	done.set()
+	sampler.join()
+	# wait4 gives the resource usage of this process alone
+	pid, status, rusage = os.wait4(process.pid, 0)
+	process.returncode = os.waitstatus_to_exitcode(status)
+	return process.returncode, output['stdout'], output['stderr'], peak[0] or rusage.ru_maxrss
+
+def run_search_command(command, args, records=None, splunkd_uri='https://127.0.0.1:8089', session_key=None,
+	app='search', username='admin', env=None, dispatch_dir=None, maxresultrows=50000):
+	"""Run a search command with the given arguments (['collection=x', ...]) and input records.
+	Returns a dict with the output rows, messages, exit code, seconds and peak RSS (KB)."""
+	commands = get_commands()
+	script, chunked = commands[command]
+	records = list(records or [])
+	temp_dir = None
+	if dispatch_dir is None:
+		temp_dir = tempfile.TemporaryDirectory()
+		dispatch_dir = temp_dir.name
+	sid = 'stub_%d_%d' % (int(time.time()), os.getpid())
+	search = '| %s %s' % (command, ' '.join(args))
+	env = env or command_environment(splunkd_uri, tempfile.mkdtemp())
+
+	try:
+		if chunked:
+			argv = [sys.executable, script]
+			searchinfo = {
+				'args': args, 'raw_args': args, 'dispatch_dir': dispatch_dir, 'sid': sid, 'app': app, 'owner': username,
+				'username': username, 'session_key': session_key, 'splunkd_uri': splunkd_uri, 'splunk_version': '9.1.0',
+				'search': urllib.parse.quote(search), 'command': command, 'maxresultrows': maxresultrows,
+				'earliest_time': '0', 'latest_time': '0'
+			}
+			stdin_data = chunk({'action': 'getinfo', 'preview': False, 'searchinfo': searchinfo}) + \
+				chunk({'action': 'execute', 'finished': True}, records_to_csv(records))
+		else:
+			argv = [sys.executable, script, '__EXECUTE__'] + args
+			# Protocol v1 reads the search info from info.csv in the dispatch directory
+			with open(os.path.join(dispatch_dir, 'info.csv'), 'w') as f:
+				writer = csv.writer(f, lineterminator='\r\n')
+				writer.writerow(['_sid', '_ppc.app', '_ppc.user', '_auth_token', '_splunkd_uri', '_rt_earliest', '_rt_latest'])
+				writer.writerow([sid, app, username, session_key, splunkd_uri, '', ''])
+			header = 'infoPath:%s\nsid:%s\nsearch:%s\nsplunkVersion:9.1.0\n\n' % (
+				os.path.join(dispatch_dir, 'info.csv'), sid, urllib.parse.quote(search))
+			stdin_data = (header + records_to_csv(records)).encode('utf-8')
+
+		start = time.time()
+		exit_code, stdout, stderr, max_rss = run_process(argv, env, BIN_DIR, stdin_data)
+		seconds = time.time() - start
+	finally:
+		if temp_dir is not None:
+			temp_dir.cleanup()
+
+	rows = []
+	messages = []
+	if chunked:
+		for metadata, body in read_chunks(stdout):
+			messages += [(m[0], m[1]) for m in metadata.get('inspector', {}).get('messages', [])]
+			if len(body) > 0:
+				rows += csv_to_records(body)
+	else:
+		text = stdout.decode('utf-8')
+		header, _, body = text.partition('\r\n\r\n') if not text.startswith('\r\n') else ('', '', text[2:])
+		for line in header.splitlines():
+			level, _, message = line.partition('=')
+			messages.append((level.replace('_message', '').upper(), message))
+		rows = csv_to_records(body)
+
+	return {
+		'command': command,
+		'exit_code': exit_code,
+		'rows': rows,
+		'messages': messages,
+		'stderr': stderr.decode('utf-8', 'replace'),
+		'seconds': seconds,
+		'max_rss_kb': max_rss
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description='Run a search command against a splunkd server')
+	parser.add_argument('--uri', default='https://127.0.0.1:8089', help='splunkd URI')
+	parser.add_argument('--session-key', required=True, help='Session key for the splunkd server')
+	parser.add_argument('--app', default='search', help='App context of the search')
+	parser.add_argument('--user', default='admin', help='User running the search')
+	parser.add_argument('--input', help='JSON file with an array of input records (for streaming commands)')
+	parser.add_argument('--conf', help='JSON file with .conf setting overrides ({conf: {stanza: {setting: value}}})')
+	parser.add_argument('--sdk', help='Directory containing the splunklib package, if it is not installed')
+	parser.add_argument('--certfile', help='splunkd server certificate to trust (e.g. the stub server\'s self-signed certificate)')
+	parser.add_argument('command', help='Command name from commands.conf')
+	parser.add_argument('args', nargs='*', help='Command arguments (name=value)')
+	args = parser.parse_args()
+
+	records = []
+	if args.input:
+		with open(args.input, 'r') as f:
+			records = json.load(f)
+	with tempfile.TemporaryDirectory() as splunk_home:
+		env = command_environment(args.uri, splunk_home, args.conf, args.sdk, args.certfile)
+		result = run_search_command(args.command, args.args, records, args.uri, args.session_key, args.app, args.user, env)
+	for level, message in result['messages']:
+		print('%s: %s' % (level, message), file=sys.stderr)
+	if result['exit_code'] != 0:
+		print(result['stderr'], file=sys.stderr)
+	print(json.dumps(result['rows'], indent=2))
+	print('exit code %d, %.3f seconds, peak RSS %d KB' % (result['exit_code'], result['seconds'], result['max_rss_kb']), file=sys.stderr)
+	sys.exit(result['exit_code'])
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Search command startup benchmark
+# Times how long each search command takes to import its modules and create the
+# command object, before it reads any arguments or events.  Each sample is a new
+# Python process, as when splunkd runs the command.  Uses the Splunk stubs in
+# benchmarks/stubs and the Splunk SDK for Python (splunk-sdk package or --sdk).
+#
+# Usage: python3 benchmarks/startup_benchmark.py [--iterations 10] [--command deletekeys] [--budget-ms 150] [--sdk /path/to/splunk-sdk] [--json]
+
+import argparse
+import configparser
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BENCHMARK_DIR, '..'))
+BIN_DIR = os.path.join(APP_DIR, 'bin')
+STUB_DIR = os.path.join(BENCHMARK_DIR, 'stubs')
+
+# Modules that are slow to import and should only be loaded by the commands that need them
+# (splunklib.client is not listed: splunklib.searchcommands always imports it)
+HEAVY_MODULES = ['future', 'past', 'splunk.rest', 'splunk.entity',
+	'splunksecrets', 'cryptography', 'zstandard', 'multiprocessing', 'concurrent.futures']
+
+# Runs in the child process. Importing the script runs everything except dispatch(),
+# which only runs the command when the module is __main__.
+CHILD_CODE = '''
+import sys, time, json, importlib
+start = time.perf_counter()
+sys.argv = [%(script)r]
+module = importlib.import_module(%(module)r)
+imported = time.perf_counter()
+from splunklib.searchcommands.search_command import SearchCommand
+command_class = [c for c in vars(module).values() if isinstance(c, type) and issubclass(c, SearchCommand) and c.__module__ == module.__name__][0]
+command = command_class()
+initialized = time.perf_counter()
+print(json.dumps({
+	'import_seconds': imported - start,
+	'init_seconds': initialized - imported,
+	'modules': len(sys.modules),
+	'heavy_modules': [m for m in %(heavy)r if m in sys.modules]
+}))
+'''
+
+def get_commands():
+	"""Get the command name -> script filename from commands.conf"""
+	parser = configparser.RawConfigParser(strict=False)
+	parser.read(os.path.join(APP_DIR, 'default', 'commands.conf'))
+	return dict([(name, parser.get(name, 'filename')) for name in parser.sections() if parser.has_option(name, 'filename')])
+
+def child_environment(sdk_path, splunk_home):
+	env = dict(os.environ)
+	paths = [STUB_DIR, BIN_DIR, os.path.join(BIN_DIR, 'lib')]
+	if sdk_path:
+		paths.insert(0, sdk_path)
+	env['PYTHONPATH'] = os.pathsep.join(paths)
+	env['SPLUNK_HOME'] = splunk_home
+	env['PYTHONDONTWRITEBYTECODE'] = '1'
+	return env
+
+def run_sample(code, env):
+	start = time.perf_counter()
+	output = subprocess.run([sys.executable, '-c', code], env=env, cwd=BIN_DIR,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+	wall = time.perf_counter() - start
+	if output.returncode != 0:
+		raise Exception(output.stderr.strip().splitlines()[-1] if output.stderr.strip() else 'exit code %d' % output.returncode)
+	result = json.loads(output.stdout.strip().splitlines()[-1])
+	result['wall_seconds'] = wall
+	return result
+
+def median(values):
+	values = sorted(values)
+	middle = len(values) // 2
+	return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def main():
+	parser = argparse.ArgumentParser(description='Time the import and initialization of each search command')
+	parser.add_argument('--iterations', type=int, default=10, help='Number of processes to start per command')
+	parser.add_argument('--command', action='append', help='Command to time (default: all commands in commands.conf)')
+	parser.add_argument('--budget-ms', type=float, default=0, help='Exit with an error if any command\'s median import+init time is over this')
+	parser.add_argument('--sdk', help='Directory containing the splunklib package, if it is not installed')
+	parser.add_argument('--json', action='store_true', help='Print results as JSON')
+	args = parser.parse_args()
+
+	commands = get_commands()
+	names = args.command or sorted(commands.keys())
+	with tempfile.TemporaryDirectory() as splunk_home:
+		# setup_logger writes to $SPLUNK_HOME/var/log/splunk
+		os.makedirs(os.path.join(splunk_home, 'var', 'log', 'splunk'))
+		env = child_environment(args.sdk, splunk_home)
+
+		# Interpreter startup, for reference
+		baseline = []
+		for i in range(args.iterations):
+			start = time.perf_counter()
+			subprocess.run([sys.executable, '-c', 'pass'], env=env, check=True)
+			baseline.append(time.perf_counter() - start)
+
+		results = []
+		for name in names:
+			script = commands[name]
+			code = CHILD_CODE % {'script': script, 'module': os.path.splitext(script)[0], 'heavy': HEAVY_MODULES}
+			samples = [run_sample(code, env) for i in range(args.iterations)]
+			startup = median([s['import_seconds'] + s['init_seconds'] for s in samples])
+			results.append({
+				'command': name,
+				'script': script,
+				'import_ms': round(median([s['import_seconds'] for s in samples]) * 1000, 2),
+				'init_ms': round(median([s['init_seconds'] for s in samples]) * 1000, 2),
+				'startup_ms': round(startup * 1000, 2),
+				'process_ms': round(median([s['wall_seconds'] for s in samples]) * 1000, 2),
+				'modules': samples[-1]['modules'],
+				'heavy_modules': samples[-1]['heavy_modules'],
+				'over_budget': args.budget_ms > 0 and startup * 1000 > args.budget_ms
+			})
+
+	interpreter_ms = round(median(baseline) * 1000, 2)
+	if args.json:
+		print(json.dumps({'interpreter_ms': interpreter_ms, 'budget_ms': args.budget_ms, 'commands': results}, indent=2))
+	else:
+		print('Python interpreter startup: %.2f ms (median of %d)' % (interpreter_ms, args.iterations))
+		print('%-16s %10s %10s %11s %11s %8s  %s' % ('command', 'import ms', 'init ms', 'startup ms', 'process ms', 'modules', 'heavy modules loaded'))
+		for r in results:
+			print('%-16s %10.2f %10.2f %11.2f %11.2f %8d  %s%s' % (r['command'], r['import_ms'], r['init_ms'], r['startup_ms'],
+				r['process_ms'], r['modules'], ', '.join(r['heavy_modules']) or '-', '  OVER BUDGET' if r['over_budget'] else ''))
+
+	if any([r['over_budget'] for r in results]):
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,712 @@
+#!/usr/bin/env python3
+
+# Stub splunkd server
+# A lightweight stand-in for the splunkd REST endpoints used by KV Store Tools, so
+# the search commands can run end-to-end and be benchmarked without Splunk.
+# Collections are held in memory. Latency and errors can be injected to test
+# the batch sizing and retry logic.
+#
+# Endpoints: auth/login, authentication/current-context, apps/local, server/info,
+# configs/conf-limits/kvstore, storage/collections/config and storage/collections/data
+# (limit, skip, query, sort, fields, batch_save, single record and collection deletes).
+# Oneshot searches that start with a KV Store Tools command (e.g. | kvstoremerkle) are
+# run against the stub with run_command.py if the stub is given a search environment.
+# GET /stub/stats returns the request counters and POST /stub/reset clears them.
+#
+# Usage: python3 benchmarks/stub_splunkd.py [--port 8089] [--http] [--latency-ms 0] [--failure-rate 0] [--collection app/name=10000]
+
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import shlex
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+ALL_CAPABILITIES = ['run_kvst_all', 'run_kvstore_backup', 'run_kvstore_restore', 'run_kvstore_push', 'run_kvstore_pull',
+	'run_kvstore_deletekey', 'run_kvstore_deletekeys', 'run_kvstore_createfk', 'admin_all_objects']
+
+DEFAULT_LIMITS = {
+	'max_rows_per_query': 50000,
+	'max_documents_per_batch_save': 1000,
+	'max_size_per_batch_save_mb': 50,
+	'max_size_per_result_mb': 50
+}
+
+class stub_error(Exception):
+	def __init__(self, status, message):
+		super().__init__(message)
+		self.status = status
+
+def _sort_value(value):
+	# Order values of different types the way MongoDB does: null, numbers, strings, objects, arrays, booleans
+	if value is None:
+		return (0, 0)
+	if isinstance(value, bool):
+		return (5, value)
+	if isinstance(value, (int, float)):
+		return (1, value)
+	if isinstance(value, str):
+		return (2, value)
+	if isinstance(value, dict):
+		return (3, json.dumps(value, sort_keys=True))
+	return (4, json.dumps(value, sort_keys=True))
+
+def _compare(value, operator, operand):
+	if operator == '$eq':
+		return value == operand
+	if operator == '$ne':
+		return value != operand
+	if operator == '$in':
+		return value in operand
+	if operator == '$nin':
+		return value not in operand
+	if operator == '$exists':
+		return (value is not None) == bool(operand)
+	if operator == '$regex':
+		return isinstance(value, str) and re.search(operand, value) is not None
+	if value is None:
+		return False
+	left, right = _sort_value(value), _sort_value(operand)
+	if left[0] != right[0]:
+		return False
+	if operator == '$gt':
+		return left > right
+	if operator == '$gte':
+		return left >= right
+	if operator == '$lt':
+		return left < right
+	if operator == '$lte':
+		return left <= right
+	raise stub_error(400, 'Unsupported query operator: %s' % operator)
+
+def match_query(record, query):
+	"""Whether a record matches a KV store (MongoDB-style) query"""
+	for field, condition in query.items():
+		if field == '$and':
+			if not all([match_query(record, q) for q in condition]):
+				return False
+		elif field == '$or':
+			if not any([match_query(record, q) for q in condition]):
+				return False
+		elif field == '$not':
+			if match_query(record, condition):
+				return False
+		elif isinstance(condition, dict) and len(condition) > 0 and all([k.startswith('$') for k in condition]):
+			for operator, operand in condition.items():
+				if not _compare(record.get(field), operator, operand):
+					return False
+		elif record.get(field) != condition:
+			return False
+	return True
+
+def parse_sort(sort):
+	"""Parse a sort parameter (field1:1,field2:-1) into [(field, descending)]"""
+	fields = []
+	for item in (sort or '').split(','):
+		item = item.strip()
+		if len(item) == 0:
+			continue
+		name, _, direction = item.partition(':')
+		fields.append((name, direction.strip() in ['-1', 'desc']))
+	return fields
+
+def project_fields(records, fields):
+	"""Apply a fields parameter (field1,field2 to include or field1:0 to exclude)"""
+	include = []
+	exclude = []
+	for item in (fields or '').split(','):
+		name, _, flag = item.strip().partition(':')
+		if len(name) == 0:
+			continue
+		if flag.strip() == '0':
+			exclude.append(name)
+		else:
+			include.append(name)
+	if len(include) > 0:
+		if '_key' not in exclude and '_key' not in include:
+			include.append('_key')
+		return [dict([(f, r[f]) for f in include if f in r]) for r in records]
+	if len(exclude) > 0:
+		return [dict([(f, v) for f, v in r.items() if f not in exclude]) for r in records]
+	return records
+
+class kvstore_backend:
+	"""In-memory KV store collections: (app, collection) -> {_key: record}.
+
+	Query results are cached per (query, sort) until the collection changes, so
+	paging through a large collection with limit/skip does not re-sort it for
+	every page.
+	"""
+	def __init__(self, limits=None):
+		self.limits = dict(DEFAULT_LIMITS)
+		self.limits.update(limits or {})
+		self.collections = {}
+		self.config = {}
+		self.versions = {}
+		self.results = {}
+		self.lock = threading.RLock()
+
+	def create_collection(self, app, collection, sharing='app', **settings):
+		with self.lock:
+			self.config[(app, collection)] = dict(settings, sharing=sharing)
+			self.collections.setdefault((app, collection), {})
+			self._changed(app, collection)
+
+	def remove_collection(self, app, collection):
+		with self.lock:
+			if (app, collection) not in self.config:
+				raise stub_error(404, 'Collection not found: %s/%s' % (app, collection))
+			del self.config[(app, collection)]
+			self.collections.pop((app, collection), None)
+			self._changed(app, collection)
+
+	def list_collections(self, app=None):
+		"""Get the [(app, collection, settings)] visible from an app ('-' or None for all apps)"""
+		with self.lock:
+			return [(a, c, s) for (a, c), s in sorted(self.config.items())
+				if app in [None, '-', a] or s.get('sharing') == 'global']
+
+	def apps(self):
+		with self.lock:
+			return sorted(set([a for a, c in self.config]))
+
+	def _data(self, app, collection):
+		if (app, collection) not in self.config:
+			raise stub_error(404, 'Collection not found: %s/%s' % (app, collection))
+		return self.collections[(app, collection)]
+
+	def _changed(self, app, collection):
+		self.versions[(app, collection)] = self.versions.get((app, collection), 0) + 1
+
+	def query(self, app, collection, query=None, sort=None, fields=None, skip=0, limit=0):
+		max_rows = int(self.limits['max_rows_per_query'])
+		limit = max_rows if limit <= 0 else min(limit, max_rows)
+		with self.lock:
+			data = self._data(app, collection)
+			cache_key = (app, collection, json.dumps(query, sort_keys=True), sort)
+			version = self.versions.get((app, collection))
+			cached = self.results.get(cache_key)
+			if cached is not None and cached[0] == version:
+				records = cached[1]
+			else:
+				records = list(data.values())
+				if query:
+					records = [r for r in records if match_query(r, query)]
+				for field, descending in reversed(parse_sort(sort)):
+					records.sort(key=lambda r: _sort_value(r.get(field)), reverse=descending)
+				# Keep the cache small: one result per collection
+				for k in [k for k in self.results if k[0:2] == (app, collection)]:
+					del self.results[k]
+				self.results[cache_key] = (version, records)
+			page = records[skip:skip + limit]
+		return project_fields(page, fields)
+
+	def get(self, app, collection, key):
+		with self.lock:
+			record = self._data(app, collection).get(key)
+		if record is None:
+			raise stub_error(404, 'Record not found: %s' % key)
+		return record
+
+	def save(self, app, collection, records):
+		"""Insert or replace records (batch_save). Returns their keys."""
+		limit = int(self.limits['max_documents_per_batch_save'])
+		if len(records) > limit:
+			raise stub_error(400, 'Request exceeds API limits - number of documents %d is greater than max_documents_per_batch_save (%d)' % (len(records), limit))
+		keys = []
+		with self.lock:
+			data = self._data(app, collection)
+			for record in records:
+				if not isinstance(record, dict):
+					raise stub_error(400, 'Record is not a JSON object')
+				record = dict(record)
+				if record.get('_key') in [None, '']:
+					record['_key'] = uuid.uuid4().hex[0:24]
+				record['_key'] = str(record['_key'])
+				record.setdefault('_user', 'nobody')
+				data[record['_key']] = record
+				keys.append(record['_key'])
+			self._changed(app, collection)
+		return keys
+
+	def update(self, app, collection, key, record):
+		return self.save(app, collection, [dict(record, _key=key)])[0]
+
+	def delete(self, app, collection, key=None, query=None):
+		"""Delete one record, the records matching a query, or all of the records"""
+		with self.lock:
+			data = self._data(app, collection)
+			if key is not None:
+				if data.pop(key, None) is None:
+					raise stub_error(404, 'Record not found: %s' % key)
+			elif query:
+				for k in [k for k, r in data.items() if match_query(r, query)]:
+					del data[k]
+			else:
+				data.clear()
+			self._changed(app, collection)
+
+	def load(self, app, collection, records):
+		"""Add records to a collection (creating it) without the batch_save limits"""
+		with self.lock:
+			if (app, collection) not in self.config:
+				self.create_collection(app, collection)
+			data = self.collections[(app, collection)]
+			for record in records:
+				data[str(record['_key'])] = record
+			self._changed(app, collection)
+
+	def count(self, app, collection):
+		with self.lock:
+			return len(self._data(app, collection))
+
+class request_stats:
+	"""Request counters per endpoint type"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.requests = {}
+			self.errors = {}
+			self.injected_failures = 0
+			self.bytes_in = 0
+			self.bytes_out = 0
+			self.records_out = 0
+			self.records_in = 0
+			self.seconds = 0.0
+
+	def add(self, endpoint, status, bytes_in, bytes_out, records_in, records_out, seconds):
+		with self.lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+			if status >= 400:
+				self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+			self.bytes_in += bytes_in
+			self.bytes_out += bytes_out
+			self.records_in += records_in
+			self.records_out += records_out
+			self.seconds += seconds
+
+	def to_dict(self):
+		with self.lock:
+			return {
+				'requests': dict(self.requests),
+				'total_requests': sum(self.requests.values()),
+				'errors': dict(self.errors),
+				'injected_failures': self.injected_failures,
+				'bytes_in': self.bytes_in,
+				'bytes_out': self.bytes_out,
+				'records_in': self.records_in,
+				'records_out': self.records_out,
+				'server_seconds': round(self.seconds, 6)
+			}
+
+class request_handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	server_version = 'Splunkd'
+	# The headers and body are separate writes. With Nagle's algorithm, the body of each response
+	# on a keep-alive connection waits for the client's delayed ACK (about 40 ms).
+	disable_nagle_algorithm = True
+
+	routes = [
+		('POST', re.compile(r'^/services/auth/login/?$'), 'login'),
+		('GET', re.compile(r'^/services/authentication/current-context/?$'), 'current_context'),
+		('GET', re.compile(r'^/services/apps/local/?$'), 'apps'),
+		('GET', re.compile(r'^/services(?:NS/[^/]+/[^/]+)?/server/info(?:/server-info)?/?$'), 'server_info'),
+		('GET', re.compile(r'^/servicesNS/[^/]+/[^/]+/configs/conf-limits/kvstore/?$'), 'limits'),
+		('GET', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/config/?$'), 'config_list'),
+		('POST', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/config/?$'), 'config_create'),
+		('GET', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/config/(?P<collection>[^/]+)/?$'), 'config_get'),
+		('DELETE', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/config/(?P<collection>[^/]+)/?$'), 'config_delete'),
+		('POST', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/data/(?P<collection>[^/]+)/batch_save/?$'), 'batch_save'),
+		('GET', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/data/(?P<collection>[^/]+)/?$'), 'data_query'),
+		('POST', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/data/(?P<collection>[^/]+)/?$'), 'data_insert'),
+		('DELETE', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/data/(?P<collection>[^/]+)/?$'), 'data_delete'),
+		('GET', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/data/(?P<collection>[^/]+)/(?P<key>[^/]+)/?$'), 'key_get'),
+		('POST', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/data/(?P<collection>[^/]+)/(?P<key>[^/]+)/?$'), 'key_update'),
+		('DELETE', re.compile(r'^/servicesNS/[^/]+/(?P<app>[^/]+)/storage/collections/data/(?P<collection>[^/]+)/(?P<key>[^/]+)/?$'), 'key_delete'),
+		('POST', re.compile(r'^/services(?:NS/[^/]+/[^/]+)?/search/jobs/?$'), 'search_jobs'),
+		('GET', re.compile(r'^/stub/stats/?$'), 'stub_stats'),
+		('POST', re.compile(r'^/stub/reset/?$'), 'stub_reset')
+	]
+
+	def log_message(self, format, *args):
+		if self.server.stub.verbose:
+			sys.stderr.write('%s - %s\n' % (self.address_string(), format % args))
+
+	def do_GET(self):
+		self.handle_request('GET')
+
+	def do_POST(self):
+		self.handle_request('POST')
+
+	def do_DELETE(self):
+		self.handle_request('DELETE')
+
+	def handle_request(self, method):
+		stub = self.server.stub
+		start = time.time()
+		url = urllib.parse.urlparse(self.path)
+		self.args = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+		length = int(self.headers.get('Content-Length') or 0)
+		self.body = self.rfile.read(length) if length > 0 else b''
+		self.records_in = 0
+		self.records_out = 0
+		endpoint = 'unknown'
+		try:
+			path = urllib.parse.unquote(url.path)
+			for route_method, pattern, name in self.routes:
+				m = pattern.match(url.path)
+				if m and route_method == method:
+					endpoint = name
+					params = dict([(k, urllib.parse.unquote(v)) for k, v in m.groupdict().items()])
+					break
+			else:
+				raise stub_error(404, 'Not found: %s %s' % (method, path))
+
+			if not endpoint.startswith('stub_'):
+				stub.inject(endpoint)
+				if endpoint != 'login':
+					self.user = stub.authenticate(self.headers.get('Authorization'))
+			status, body, content_type = getattr(self, 'handle_' + endpoint)(**params)
+		except stub_error as e:
+			status, body, content_type = self.error_body(e.status, str(e))
+		except BaseException as e:
+			status, body, content_type = self.error_body(500, repr(e))
+		bytes_out = self.send_body(status, body, content_type)
+		if not endpoint.startswith('stub_'):
+			stub.stats.add(endpoint, status, len(self.body), bytes_out, self.records_in, self.records_out, time.time() - start)
+
+	def send_body(self, status, body, content_type):
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		if len(body) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+			body = gzip.compress(body, 1)
+			self.send_header('Content-Encoding', 'gzip')
+		self.send_header('Content-Length', str(len(body)))
+		# Like splunkd. splunklib only reads the body of keep-alive responses.
+		self.send_header('Connection', 'Keep-Alive')
+		self.end_headers()
+		self.wfile.write(body)
+		return len(body)
+
+	def json_mode(self):
+		return self.args.get('output_mode') == 'json'
+
+	def error_body(self, status, message):
+		if self.json_mode() or '/storage/collections/data/' in self.path:
+			return status, json.dumps({'messages': [{'type': 'ERROR', 'text': message}]}), 'application/json'
+		return status, '<?xml version="1.0" encoding="UTF-8"?>\n<response><messages><msg type="ERROR">%s</msg></messages></response>' % escape(message), 'text/xml'
+
+	def json_body(self, data, status=200):
+		return status, json.dumps(data), 'application/json'
+
+	def entries(self, title, entries):
+		"""Render (name, path, content, acl) entries as JSON or as an Atom feed"""
+		if self.json_mode():
+			return self.json_body({'entry': [{'name': name, 'id': path, 'content': content, 'acl': acl}
+				for name, path, content, acl in entries]})
+		xml_entries = []
+		for name, path, content, acl in entries:
+			keys = ''.join(['<s:key name="%s">%s</s:key>' % (escape(k), escape(str(v))) for k, v in content.items()])
+			acl_keys = ''.join(['<s:key name="%s">%s</s:key>' % (escape(k), escape(str(v))) for k, v in acl.items()])
+			xml_entries.append('<entry><title>%s</title><id>%s</id><link href="%s" rel="alternate"/><content type="text/xml"><s:dict>%s<s:key name="eai:acl"><s:dict>%s</s:dict></s:key></s:dict></content></entry>' % (
+				escape(name), escape(path), escape(path), keys, acl_keys))
+		return 200, ('<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom" xmlns:s="http://dev.splunk.com/ns/rest" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/"><title>%s</title><opensearch:totalResults>%d</opensearch:totalResults>%s</feed>' % (
+			escape(title), len(entries), ''.join(xml_entries))), 'text/xml'
+
+	def read_json(self):
+		try:
+			return json.loads(self.body)
+		except ValueError:
+			raise stub_error(400, 'Request body is not valid JSON')
+
+	def handle_login(self):
+		form = dict(urllib.parse.parse_qsl(self.body.decode('utf-8')))
+		session_key = self.server.stub.login(form.get('username'), form.get('password'))
+		if self.json_mode():
+			return self.json_body({'sessionKey': session_key})
+		return 200, '<response>\n  <sessionKey>%s</sessionKey>\n</response>' % session_key, 'text/xml'
+
+	def handle_current_context(self):
+		user = self.server.stub.users[self.user]
+		return self.entries('authentication/current-context', [('context', '/services/authentication/current-context/context',
+			{'username': self.user, 'capabilities': user['capabilities'], 'roles': user.get('roles', ['admin'])},
+			{'app': 'system', 'owner': 'nobody', 'sharing': 'system'})])
+
+	def handle_apps(self):
+		return self.entries('localapps', [(app, '/services/apps/local/%s' % app, {'disabled': False, 'label': app},
+			{'app': app, 'owner': 'nobody', 'sharing': 'app'}) for app in self.server.stub.apps()])
+
+	def handle_server_info(self):
+		return self.entries('server-info', [('server-info', '/services/server/info/server-info',
+			{'serverName': 'stub-splunkd', 'version': '9.1.0', 'instance_type': 'download'},
+			{'app': 'system', 'owner': 'nobody', 'sharing': 'system'})])
+
+	def handle_limits(self):
+		content = dict([(k, str(v)) for k, v in self.server.stub.backend.limits.items()])
+		return self.entries('conf-limits', [('kvstore', '/servicesNS/nobody/system/configs/conf-limits/kvstore', content,
+			{'app': 'system', 'owner': 'nobody', 'sharing': 'system'})])
+
+	def collection_entries(self, collections):
+		return [(c, '/servicesNS/nobody/%s/storage/collections/config/%s' % (a, c), dict([(k, v) for k, v in s.items() if k != 'sharing']),
+			{'app': a, 'owner': 'nobody', 'sharing': s.get('sharing', 'app')}) for a, c, s in collections]
+
+	def handle_config_list(self, app):
+		return self.entries('collections-conf', self.collection_entries(self.server.stub.backend.list_collections(app)))
+
+	def handle_config_get(self, app, collection):
+		collections = [c for c in self.server.stub.backend.list_collections(app) if c[1] == collection]
+		if len(collections) == 0:
+			raise stub_error(404, 'Collection not found: %s' % collection)
+		return self.entries('collections-conf', self.collection_entries(collections[0:1]))
+
+	def handle_config_create(self, app):
+		form = dict(urllib.parse.parse_qsl(self.body.decode('utf-8')))
+		name = form.pop('name', None)
+		if not name:
+			raise stub_error(400, 'Missing name')
+		self.server.stub.backend.create_collection(app, name, **form)
+		return self.handle_config_get(app, name)
+
+	def handle_config_delete(self, app, collection):
+		self.server.stub.backend.remove_collection(app, collection)
+		return self.json_body({})
+
+	def handle_data_query(self, app, collection):
+		query = None
+		if self.args.get('query'):
+			try:
+				query = json.loads(self.args['query'])
+			except ValueError:
+				raise stub_error(400, 'Invalid query: %s' % self.args['query'])
+		records = self.server.stub.backend.query(app, collection, query, self.args.get('sort'), self.args.get('fields'),
+			int(self.args.get('skip') or 0), int(self.args.get('limit') or 0))
+		self.records_out = len(records)
+		return self.json_body(records)
+
+	def handle_batch_save(self, app, collection):
+		records = self.read_json()
+		if not isinstance(records, list):
+			raise stub_error(400, 'batch_save expects a JSON array')
+		max_bytes = int(self.server.stub.backend.limits['max_size_per_batch_save_mb']) * 1024 * 1024
+		if max_bytes > 0 and len(self.body) > max_bytes:
+			raise stub_error(400, 'Request exceeds API limits - max_size_per_batch_save_mb')
+		self.records_in = len(records)
+		return self.json_body(self.server.stub.backend.save(app, collection, records))
+
+	def handle_data_insert(self, app, collection):
+		self.records_in = 1
+		return self.json_body({'_key': self.server.stub.backend.save(app, collection, [self.read_json()])[0]}, 201)
+
+	def handle_data_delete(self, app, collection):
+		query = json.loads(self.args['query']) if self.args.get('query') else None
+		self.server.stub.backend.delete(app, collection, query=query)
+		return self.json_body({})
+
+	def handle_key_get(self, app, collection, key):
+		self.records_out = 1
+		return self.json_body(self.server.stub.backend.get(app, collection, key))
+
+	def handle_key_update(self, app, collection, key):
+		self.records_in = 1
+		return self.json_body({'_key': self.server.stub.backend.update(app, collection, key, self.read_json())})
+
+	def handle_key_delete(self, app, collection, key):
+		self.server.stub.backend.delete(app, collection, key=key)
+		return self.json_body({})
+
+	def handle_search_jobs(self):
+		form = dict(urllib.parse.parse_qsl(self.body.decode('utf-8')))
+		stub = self.server.stub
+		if form.get('exec_mode') != 'oneshot' or stub.search_env is None:
+			raise stub_error(501, 'Only oneshot searches of KV Store Tools commands are supported')
+		words = shlex.split(form.get('search', '').strip().lstrip('|'))
+		from run_command import get_commands, run_search_command
+		if len(words) == 0 or words[0] not in get_commands():
+			raise stub_error(400, 'Unsupported search: %s' % form.get('search'))
+		session_key = self.headers.get('Authorization', '').replace('Splunk ', '', 1).strip()
+		result = run_search_command(words[0], words[1:], None, stub.uri, session_key, username=self.user, env=stub.search_env)
+		errors = [m for level, m in result['messages'] if level == 'ERROR']
+		if result['exit_code'] != 0 or len(errors) > 0:
+			raise stub_error(400, 'Search failed: %s' % ('; '.join(errors) or result['stderr'][-500:]))
+		return self.json_body({'results': result['rows']})
+
+	def handle_stub_stats(self):
+		return self.json_body(self.server.stub.stats.to_dict())
+
+	def handle_stub_reset(self):
+		self.server.stub.stats.reset()
+		return self.json_body({})
+
+def create_certificate(directory):
+	"""Create a self-signed certificate for localhost. Returns (certfile, keyfile)."""
+	certfile = os.path.join(directory, 'stub_splunkd.pem')
+	keyfile = os.path.join(directory, 'stub_splunkd.key')
+	subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2', '-subj', '/CN=localhost',
+		'-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1', '-keyout', keyfile, '-out', certfile], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	return certfile, keyfile
+
+class stub_splunkd:
+	"""A stub splunkd server running in a background thread.
+
+	Set the session_key (or log in as one of the users) to authenticate. Remote
+	targets for kvstorepush/kvstorepull are just another stub_splunkd on a second port.
+	Set search_env (from run_command.command_environment) to run oneshot searches
+	of the app's commands, as kvstoremerkle is run on remote hosts.
+	"""
+	def __init__(self, host='127.0.0.1', port=0, tls=True, certfile=None, keyfile=None, limits=None,
+		latency=0.0, jitter=0.0, failure_rate=0.0, failure_status=503, failure_endpoints=None,
+		session_key=None, users=None, seed=0, verbose=False, search_env=None):
+		self.backend = kvstore_backend(limits)
+		self.stats = request_stats()
+		self.latency = latency
+		self.jitter = jitter
+		self.failure_rate = failure_rate
+		self.failure_status = failure_status
+		self.failure_endpoints = failure_endpoints
+		self.random = random.Random(seed)
+		self.random_lock = threading.Lock()
+		self.verbose = verbose
+		# Environment for the commands run by oneshot searches (run_command.command_environment)
+		self.search_env = search_env
+		self.users = users or {'admin': {'password': 'changeme', 'capabilities': list(ALL_CAPABILITIES)}}
+		self.sessions = {}
+		self.session_key = session_key or uuid.uuid4().hex
+		self.sessions[self.session_key] = sorted(self.users.keys())[0]
+
+		self.server = ThreadingHTTPServer((host, port), request_handler)
+		self.server.daemon_threads = True
+		self.server.stub = self
+		self.temp_dir = None
+		self.certfile = certfile
+		if tls:
+			if certfile is None:
+				self.temp_dir = tempfile.TemporaryDirectory()
+				certfile, keyfile = create_certificate(self.temp_dir.name)
+				self.certfile = certfile
+			context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+			context.load_cert_chain(certfile, keyfile)
+			self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+		self.host = host
+		self.port = self.server.server_address[1]
+		self.uri = '%s://%s:%d' % ('https' if tls else 'http', host, self.port)
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+		if self.temp_dir is not None:
+			self.temp_dir.cleanup()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *args):
+		self.stop()
+
+	def apps(self):
+		return sorted(set(self.backend.apps() + ['search', 'kvstore_tools']))
+
+	def login(self, username, password):
+		user = self.users.get(username)
+		if user is None or user['password'] != password:
+			raise stub_error(401, 'Login failed')
+		session_key = uuid.uuid4().hex
+		self.sessions[session_key] = username
+		return session_key
+
+	def authenticate(self, authorization):
+		"""Get the user for an Authorization header (Splunk <session key>)"""
+		session_key = (authorization or '').replace('Splunk ', '', 1).strip()
+		if session_key not in self.sessions:
+			raise stub_error(401, 'call not properly authenticated')
+		return self.sessions[session_key]
+
+	def revoke_sessions(self):
+		"""Invalidate all session keys except the fixed one, as if they had expired"""
+		self.sessions = dict([(k, u) for k, u in self.sessions.items() if k == self.session_key])
+
+	def inject(self, endpoint):
+		"""Apply the configured latency and random failures to a request"""
+		with self.random_lock:
+			delay = self.latency + self.jitter * self.random.random()
+			fail = self.failure_rate > 0 and self.random.random() < self.failure_rate
+		if delay > 0:
+			time.sleep(delay)
+		if fail and (self.failure_endpoints is None or endpoint in self.failure_endpoints):
+			with self.stats.lock:
+				self.stats.injected_failures += 1
+			raise stub_error(self.failure_status, 'Injected failure')
+
+def synthetic_records(count, width='narrow', seed=0, start=0):
+	"""Generate KV store records. narrow records have 8 fields, wide records have 60."""
+	rnd = random.Random(seed)
+	words = [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(3, 10))) for _ in range(500)]
+	field_count = 8 if width == 'narrow' else 60
+	for i in range(start, start + count):
+		record = {'_key': '%024x' % rnd.getrandbits(96), '_user': 'nobody', 'id': i}
+		for f in range(field_count):
+			if f % 3 == 0:
+				record['field%d' % f] = rnd.randint(0, 100000)
+			else:
+				record['field%d' % f] = ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 6)))
+		yield record
+
+def main():
+	parser = argparse.ArgumentParser(description='Run a stub splunkd KV store server')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8089)
+	parser.add_argument('--http', action='store_true', help='Serve plain HTTP instead of HTTPS')
+	parser.add_argument('--certfile', help='TLS certificate (default: a new self-signed certificate)')
+	parser.add_argument('--keyfile', help='TLS private key')
+	parser.add_argument('--session-key', help='Fixed session key that is always valid')
+	parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every request')
+	parser.add_argument('--jitter-ms', type=float, default=0, help='Random delay (0 to N ms) added to every request')
+	parser.add_argument('--failure-rate', type=float, default=0, help='Fraction of requests that fail')
+	parser.add_argument('--failure-status', type=int, default=503, help='HTTP status of injected failures')
+	parser.add_argument('--max-rows-per-query', type=int, default=DEFAULT_LIMITS['max_rows_per_query'])
+	parser.add_argument('--max-documents-per-batch-save', type=int, default=DEFAULT_LIMITS['max_documents_per_batch_save'])
+	parser.add_argument('--collection', action='append', default=[], help='Create a collection: app/name[=records[:narrow|wide]]')
+	parser.add_argument('--verbose', action='store_true', help='Log every request')
+	args = parser.parse_args()
+
+	stub = stub_splunkd(args.host, args.port, tls=not args.http, certfile=args.certfile, keyfile=args.keyfile,
+		limits={'max_rows_per_query': args.max_rows_per_query, 'max_documents_per_batch_save': args.max_documents_per_batch_save},
+		latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, failure_rate=args.failure_rate,
+		failure_status=args.failure_status, session_key=args.session_key, verbose=args.verbose)
+	for spec in args.collection:
+		name, _, size = spec.partition('=')
+		app, _, collection = name.partition('/')
+		count, _, width = size.partition(':')
+		stub.backend.create_collection(app, collection)
+		stub.backend.load(app, collection, synthetic_records(int(count or 0), width or 'narrow'))
+	print('Stub splunkd listening on %s (session key %s, certificate %s)' % (stub.uri, stub.session_key, stub.certfile), flush=True)
+	try:
+		stub.server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		stub.stop()
+
+if __name__ == '__main__':
+	main()
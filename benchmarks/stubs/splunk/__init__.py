@@ -0,0 +1,25 @@
+# Stub of the splunk package for benchmarks (not part of the app)
+
+import os
+
+class SplunkdException(Exception):
+	pass
+
+class AuthenticationFailed(SplunkdException):
+	pass
+
+class AuthorizationFailed(SplunkdException):
+	pass
+
+class ResourceNotFound(SplunkdException):
+	pass
+
+class RESTException(SplunkdException):
+	def __init__(self, statusCode=None, msg=None):
+		self.statusCode = statusCode
+		self.msg = msg
+		super().__init__(msg)
+
+def getLocalServerInfo():
+	"""The URI of the local splunkd (a stub_splunkd server), from $SPLUNKD_URI"""
+	return os.environ.get('SPLUNKD_URI', 'https://127.0.0.1:8089')
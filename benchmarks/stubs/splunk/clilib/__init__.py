@@ -0,0 +1 @@
+# Stub of splunk.clilib for benchmarks (not part of the app)
@@ -0,0 +1,44 @@
+# Stub of splunk.clilib.cli_common for benchmarks (not part of the app)
+# Reads .conf files from the app's default and local directories. Settings in the
+# JSON file named by $SPLUNK_STUB_CONF ({conf: {stanza: {setting: value}}}) override them.
+
+import os
+import json
+import configparser
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..'))
+
+# Splunk's system defaults for settings the app reads from other .conf files
+SYSTEM_DEFAULTS = {
+	'limits': {
+		'kvstore': {
+			'max_rows_per_query': '50000',
+			'max_documents_per_batch_save': '1000',
+			'max_size_per_batch_save_mb': '50',
+			'max_size_per_result_mb': '50'
+		}
+	}
+}
+
+def getMergedConf(conf):
+	stanzas = {}
+	for stanza, settings in SYSTEM_DEFAULTS.get(conf, {}).items():
+		stanzas[stanza] = dict(settings)
+	for config_dir in ['default', 'local']:
+		parser = configparser.RawConfigParser(strict=False, interpolation=None)
+		parser.optionxform = str
+		parser.read(os.path.join(APP_DIR, config_dir, conf + '.conf'))
+		for stanza in parser.sections():
+			stanzas.setdefault(stanza, {}).update(parser.items(stanza))
+	if os.environ.get('SPLUNK_STUB_CONF'):
+		with open(os.environ['SPLUNK_STUB_CONF'], 'r') as f:
+			overrides = json.load(f).get(conf, {})
+		for stanza, settings in overrides.items():
+			stanzas.setdefault(stanza, {}).update([(k, str(v)) for k, v in settings.items()])
+	return stanzas
+
+def getConfStanzas(conf):
+	return getMergedConf(conf)
+
+def getConfStanza(conf, stanza):
+	return getMergedConf(conf)[stanza]
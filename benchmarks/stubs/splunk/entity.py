@@ -0,0 +1,24 @@
+# Stub of splunk.entity for benchmarks (not part of the app)
+
+import json
+import splunk.rest
+
+def buildEndpoint(entityClass, entityName=None, namespace=None, owner=None, hostPath=None, **kwargs):
+	if isinstance(entityClass, str):
+		entityClass = [entityClass]
+	if namespace is None:
+		path = '/services/' + '/'.join(entityClass)
+	else:
+		path = '/servicesNS/%s/%s/%s' % (owner or 'nobody', namespace, '/'.join(entityClass))
+	if entityName:
+		path += '/' + entityName
+	return (hostPath or '') + path
+
+def getEntities(entityPath, namespace=None, owner=None, sessionKey=None, count=None, **kwargs):
+	"""Get {name: content} for the entities at an endpoint. content includes eai:acl."""
+	uri = buildEndpoint(entityPath, namespace=namespace, owner=owner)
+	content = splunk.rest.simpleRequest(uri, sessionKey=sessionKey, getargs={'output_mode': 'json', 'count': count or 0}, raiseAllErrors=True)[1]
+	entities = {}
+	for entry in json.loads(content)['entry']:
+		entities[entry['name']] = dict(entry['content'], **{'eai:acl': entry['acl']})
+	return entities
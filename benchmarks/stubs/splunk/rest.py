@@ -0,0 +1,57 @@
+# Stub of splunk.rest for benchmarks (not part of the app)
+# Sends requests to the splunkd at $SPLUNKD_URI (see benchmarks/stub_splunkd.py).
+
+import ssl
+import urllib.parse
+import http.client
+import splunk
+
+class response(dict):
+	"""HTTP response headers and status, like the httplib2 response splunk.rest returns"""
+	def __init__(self, status, reason, headers):
+		super().__init__([(k.lower(), v) for k, v in headers])
+		self.status = status
+		self.reason = reason
+
+def simpleRequest(path, sessionKey=None, getargs=None, postargs=None, method='GET', raiseAllErrors=False,
+	jsonargs=None, headers=None, timeout=30, **kwargs):
+	"""Make a splunkd REST request. Returns (response, content)."""
+	if not path.startswith('http'):
+		path = splunk.getLocalServerInfo() + (path if path.startswith('/') else '/services/' + path)
+	if getargs:
+		path += ('&' if '?' in path else '?') + urllib.parse.urlencode(getargs)
+	request_headers = dict(headers or {})
+	if sessionKey:
+		request_headers['Authorization'] = 'Splunk %s' % sessionKey
+	body = None
+	if jsonargs is not None:
+		body = jsonargs if isinstance(jsonargs, (str, bytes)) else str(jsonargs)
+		request_headers['Content-Type'] = 'application/json'
+	elif postargs is not None:
+		body = urllib.parse.urlencode(postargs)
+		request_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+	if body is not None and method == 'GET':
+		method = 'POST'
+
+	url = urllib.parse.urlparse(path)
+	if url.scheme == 'https':
+		conn = http.client.HTTPSConnection(url.netloc, timeout=timeout, context=ssl._create_unverified_context())
+	else:
+		conn = http.client.HTTPConnection(url.netloc, timeout=timeout)
+	try:
+		conn.request(method, path[path.index(url.netloc) + len(url.netloc):], body, request_headers)
+		r = conn.getresponse()
+		content = r.read()
+		server_response = response(r.status, r.reason, r.getheaders())
+	finally:
+		conn.close()
+
+	if server_response.status == 401:
+		raise splunk.AuthenticationFailed(content)
+	if server_response.status == 403:
+		raise splunk.AuthorizationFailed(content)
+	if server_response.status == 404:
+		raise splunk.ResourceNotFound(path)
+	if raiseAllErrors and server_response.status >= 400:
+		raise splunk.RESTException(server_response.status, content)
+	return server_response, content
@@ -7,12 +7,9 @@
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9
 
-from __future__ import print_function
-from builtins import str
-from future import standard_library
-standard_library.install_aliases()
 import sys
 import os
+import atexit
 import json
 import urllib.error
 import urllib.parse
@@ -20,6 +17,8 @@ import gzip
 import csv
 import re
 import kv_common as kv
+import kv_metrics
+import kv_profile
 from deductiv_helpers import request, str2bool, setup_logger, read_config
 
 # Examples:
@@ -38,6 +37,10 @@ if len(sys.argv) > 1:
 		
 		# Get the stdin payload
 		alert_config = payload.get('configuration', dict())
+		# Profile the rest of the script if the profile parameter (or setting) is enabled
+		profiler = kv_profile.start_profiler(facility, cfg=config['settings'], enabled=alert_config.get('profile'))
+		if profiler is not None:
+			atexit.register(profiler.stop)
 		# Get the app / collection name supplied by the user/search
 		app = urllib.parse.quote(alert_config.get('app') if 'app' in alert_config else payload.get('app'))
 		collection = alert_config.get('collection')
@@ -106,12 +109,14 @@ if len(sys.argv) > 1:
 				exit(1)
 		logger.info("Read %d results from results file" % rownum)
 
+		metrics = kv_metrics.operation_metrics('alert_kvstore', kv.get_retry_policy(), app=app, collection=collection)
 		# Change the action if the overwrite flag is specified
 		if str2bool(alert_config.get('overwrite')):
 			logger.debug('Overwriting kvstore collection=%s with data=%s' % (collection, json.dumps(json_results)))
 			# Delete the collection contents
 			try:
-				response = kv.delete_collection(logger, payload.get('server_uri'), payload.get('session_key'), app, collection)
+				with metrics.phase('delete'):
+					response = kv.delete_collection(logger, payload.get('server_uri'), payload.get('session_key'), app, collection)
 				logger.debug('Server response for collection deletion: %s' % response)
 			except BaseException as e:
 				logger.error('Failed to delete collection: %s' % repr(e))
@@ -121,10 +126,13 @@ if len(sys.argv) > 1:
 		
 		# Send the updated record to the server
 		try:
-			response, response_code = request('POST', record_url, json.dumps(json_results), headers)
+			with metrics.phase('upload'):
+				response, response_code = request('POST', record_url, json.dumps(json_results), headers, retry=kv.get_retry_policy())
 			logger.debug('Server response: %s' % str(response))
 			if response_code == 200:
 				logger.info("Uploaded results to collection %s/%s successfully" % (app, collection))
+				metrics.count('records', len(json_results))
+			kv_metrics.log_metrics(logger, config['settings'], metrics, result='success' if response_code == 200 else 'error')
 		except BaseException as e:
 			logger.error('Failed to update record: %s' % repr(e))
 			sys.exit(3)
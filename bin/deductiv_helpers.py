@@ -4,11 +4,6 @@
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9 (2023-02-15)
 
-from __future__ import print_function
-from array import array
-from builtins import str
-from future import standard_library
-standard_library.install_aliases()
 import sys
 import os
 import urllib.request
@@ -18,23 +13,24 @@ import http.client as httplib
 import ssl
 import re
 import logging
+import logging.handlers
 import configparser
 import time
 import datetime
 import socket
 import json
 import random
-import struct
-import splunk
-import splunk.entity as en
-from splunk.rest import simpleRequest
+import threading
+import zlib
 
 # Add lib folders to import path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
-# https://github.com/HurricaneLabs/splunksecrets/blob/master/splunksecrets.py
-from splunksecrets import decrypt
+
+# splunk.rest, splunk.entity and splunksecrets are slow to import, and most search
+# commands never use them. They are imported by the functions that need them.
 
 def get_credentials(app, session_key):
+	import splunk.entity as en
 	try:
 		# list all credentials
 		entities = en.getEntities(['admin', 'passwords'], namespace=app,
@@ -56,8 +52,97 @@ def get_credentials(app, session_key):
 	else:
 		raise Exception("No credentials have been found")
 
+def read_response(response, chunk_size=1048576):
+	"""Read the whole HTTP response body, decompressing it if the server gzipped it. The compressed
+	body is read and decompressed a chunk at a time, but the decompressed body is returned whole."""
+	if response.getheader('Content-Encoding', '').lower() not in ['gzip', 'x-gzip']:
+		return response.read()
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	chunks = []
+	chunk = response.read(chunk_size)
+	while chunk:
+		chunks.append(decompressor.decompress(chunk))
+		chunk = response.read(chunk_size)
+	chunks.append(decompressor.flush())
+	return b''.join(chunks)
+
+class retry_policy:
+	"""Retry settings for HTTP requests that fail with a transient error.
+
+	Retries use exponential backoff (backoff * 2^n, capped at max_backoff) with
+	a random jitter fraction subtracted, so parallel workers don't retry in step.
+	The number of retries performed is counted in self.retries.
+
+	Requests that aren't idempotent (e.g. batch_save POSTs) may have been partly
+	applied when the server failed, so they are only retried when the server
+	refused them (unsafe_status_codes) or the connection was refused.
+	"""
+	idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+	def __init__(self, attempts=1, backoff=1.0, max_backoff=30.0, jitter=0.5, status_codes=(429, 500, 502, 503, 504), unsafe_status_codes=(429, 503)):
+		self.attempts = max(int(attempts), 1)
+		self.backoff = float(backoff)
+		self.max_backoff = float(max_backoff)
+		self.jitter = min(max(float(jitter), 0.0), 1.0)
+		self.status_codes = set(int(c) for c in status_codes)
+		self.unsafe_status_codes = set(int(c) for c in unsafe_status_codes) & self.status_codes
+		self.retries = 0
+		self._lock = threading.Lock()
+
+	def delay(self, attempt):
+		"""Seconds to wait before the given retry attempt (0-based)"""
+		delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+		return delay * (1 - self.jitter * random.random())
+
+	def retry_status(self, method, status):
+		"""Whether a response status is retried for the request method"""
+		if method.upper() in self.idempotent_methods:
+			return status in self.status_codes
+		return status in self.unsafe_status_codes
+
+	def retry_error(self, method, error):
+		"""Whether a connection error is retried for the request method"""
+		return method.upper() in self.idempotent_methods or isinstance(error, ConnectionRefusedError)
+
+	def wait(self, attempt):
+		with self._lock:
+			self.retries += 1
+		time.sleep(self.delay(attempt))
+
+class request_counter:
+	"""Counts the HTTP requests made by request(), with the bytes sent and received
+	and the time spent waiting for responses. Each attempt of a retried request counts."""
+	def __init__(self):
+		self.requests = 0
+		self.errors = 0
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.seconds = 0.0
+		self._lock = threading.Lock()
+
+	def add(self, bytes_sent, bytes_received, seconds, error=False):
+		with self._lock:
+			self.requests += 1
+			self.errors += 1 if error else 0
+			self.bytes_sent += bytes_sent
+			self.bytes_received += bytes_received
+			self.seconds += seconds
+
+	def snapshot(self):
+		with self._lock:
+			return {'requests': self.requests, 'errors': self.errors, 'bytes_sent': self.bytes_sent,
+				'bytes_received': self.bytes_received, 'seconds': self.seconds}
+
+	def since(self, snapshot):
+		"""The counts added since the given snapshot"""
+		current = self.snapshot()
+		return dict([(name, current[name] - snapshot[name]) for name in current])
+
+# HTTP requests made by this process
+http_stats = request_counter()
+
 # HTTP request wrapper
-def request(method, url, data, headers, conn=None, verify=None):
+def request(method, url, data, headers, conn=None, verify=None, retry=None):
 	"""Helper function to fetch data from the given URL"""
 	# See if this is utf-8 encoded already
 	try:
@@ -78,19 +163,49 @@ def request(method, url, data, headers, conn=None, verify=None):
 			else:
 				conn = httplib.HTTPSConnection(url_tuple.netloc, context=ssl._create_unverified_context())
 		elif url_tuple.scheme == 'http':
-			conn = httplib.HTTPConnection(url_tuple.netloc, context=ssl._create_unverified_context())
+			conn = httplib.HTTPConnection(url_tuple.netloc)
 	else:
 		close_conn = False
-	try:
-		conn.request(method, url, data, headers)
-		response = conn.getresponse()
-		response_data = response.read()
-		response_status = response.status
+	if retry is None:
+		retry = retry_policy()
+	# Ask for a compressed response unless the caller specified an encoding
+	if not any(h.lower() == 'accept-encoding' for h in headers):
+		headers = merge_two_dicts(headers, {'Accept-Encoding': 'gzip'})
+
+	attempt = 0
+	while True:
+		request_start = time.time()
+		try:
+			conn.request(method, url, data, headers)
+			response = conn.getresponse()
+			response_data = read_response(response)
+			response_status = response.status
+		except (OSError, httplib.HTTPException) as e:
+			http_stats.add(len(data), 0, time.time() - request_start, error=True)
+			# Connection reset, timeout, etc. The connection reopens on the next request.
+			conn.close()
+			if attempt + 1 < retry.attempts and retry.retry_error(method, e):
+				retry.wait(attempt)
+				attempt += 1
+				continue
+			raise Exception("URL Request Error: " + str(e))
+		except BaseException as e:
+			# e.g. a corrupt gzip response. Don't reuse the half-read connection.
+			http_stats.add(len(data), 0, time.time() - request_start, error=True)
+			conn.close()
+			if not isinstance(e, Exception):
+				# KeyboardInterrupt, SystemExit
+				raise
+			raise Exception("URL Request Error: " + repr(e))
+		http_stats.add(len(data), len(response_data), time.time() - request_start, error=response_status >= 400)
+
+		if attempt + 1 < retry.attempts and retry.retry_status(method, response_status):
+			retry.wait(attempt)
+			attempt += 1
+			continue
 		if close_conn:
 			conn.close()
 		return response_data, response_status
-	except BaseException as e:
-		raise Exception("URL Request Error: " + str(e))
 
 def setup_logging(logger_name):
 	logger = logging.getLogger(logger_name)
@@ -206,6 +321,8 @@ def decrypt_with_secret(encrypted_text):
 		with open(os.path.join(os.getenv('SPLUNK_HOME'), 'etc', 'auth', 'splunk.secret'), 'r') as ssfh:
 			splunk_secret = ssfh.readline()
 		# Call the decrypt function from splunksecrets.py
+		# https://github.com/HurricaneLabs/splunksecrets/blob/master/splunksecrets.py
+		from splunksecrets import decrypt
 		return decrypt(splunk_secret, encrypted_text)
 	else:
 		# Not encrypted
@@ -225,6 +342,9 @@ if __name__ == "__main__":
 	pass
 
 def get_tokens(searchinfo):
+	import splunk
+	import splunk.entity as en
+	from splunk.rest import simpleRequest
 	tokens = {}
 	# Get the host of the splunkd service
 	splunkd_host = searchinfo.splunkd_uri[searchinfo.splunkd_uri.index("//")+2:searchinfo.splunkd_uri.rindex(":")]
@@ -372,6 +492,8 @@ def log_proxy_settings(logger):
 		logger.debug("Proxy Exceptions: %s" % proxy_exceptions)
 
 def is_cloud(session_key):
+	import splunk.entity as en
+	from splunk.rest import simpleRequest
 	uri = en.buildEndpoint(["server", "info", "server-info"], namespace='-', owner='nobody')
 	server_content = simpleRequest(uri, getargs={"output_mode": "json"}, sessionKey=session_key, raiseAllErrors=True)[1]
 	try:
@@ -384,6 +506,5 @@ def is_cloud(session_key):
 		return False
 
 def get_uncompressed_size(filename):
-    with open(filename, 'rb') as f:
-        f.seek(-4, 2)
-        return struct.unpack('I', f.read(4))[0]
+    from kv_compression import codecs
+    return codecs['gzip'].uncompressed_size(filename)
@@ -0,0 +1,358 @@
+# kv_catalog.py
+# Backup catalog (manifest) for KV Store collection backups
+# Keeps a JSON-lines index of the backup files in a directory so listings,
+# restore matching and retention don't need to scan and stat every file.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import os
+import re
+import json
+import glob
+import hashlib
+import fnmatch
+import time
+from contextlib import contextmanager
+from kv_compression import codec_from_filename, format_from_filename, INDEX_EXTENSION
+try:
+	import fcntl
+except ImportError:
+	# Windows
+	fcntl = None
+	import msvcrt
+
+CATALOG_FILENAME = 'kvstore_tools_catalog.jsonl'
+LOCK_EXTENSION = '.lock'
+BACKUP_FILE_PATTERN = '*#*#*.*json*'
+
+def catalog_path(backup_dir):
+	return os.path.join(backup_dir, CATALOG_FILENAME)
+
+def parse_backup_filename(filename):
+	"""Split a backup file name (app#collection#timestamp[#partNNN].[nd]json[.ext]) into its parts.
+	Returns None if the name doesn't follow the naming convention.
+
+	Shards of a backup share the same 'backup' ID (the file name without the part number)."""
+	name = os.path.basename(filename)
+	codec = codec_from_filename(name)
+	if codec is None:
+		return None
+	extension = re.search(r'\.(?:nd)?json.*$', name).group(0)
+	name_split = name[:-len(extension)].split('#')
+	if len(name_split) == 4 and re.match(r'^part\d+$', name_split[3]):
+		part = int(name_split[3][4:])
+	elif len(name_split) == 3:
+		part = None
+	else:
+		return None
+	return {
+		'app': name_split[0],
+		'collection': name_split[1],
+		'timestamp': name_split[2],
+		'part': part,
+		'backup': '#'.join(name_split[0:3]) + extension,
+		'format': format_from_filename(name),
+		'codec': codec.name
+	}
+
+def build_catalog_entry(filename, records=None, uncompressed_bytes=None, checksum=None, status=None):
+	"""Describe a backup file for the catalog. Returns None if the file isn't a backup file."""
+	entry = parse_backup_filename(filename)
+	if entry is None:
+		return None
+	file_stat = os.stat(filename)
+	entry.update({
+		'file': os.path.basename(filename),
+		'mtime': file_stat.st_mtime,
+		'bytes': file_stat.st_size,
+		'uncompressed_bytes': uncompressed_bytes,
+		'records': records,
+		'checksum': checksum,
+		'status': status
+	})
+	return entry
+
+def _lock(f, lock):
+	"""Lock or unlock an open file. On Windows, the first byte of the file is locked."""
+	if fcntl is not None:
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX if lock else fcntl.LOCK_UN)
+	else:
+		f.seek(0)
+		msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if lock else msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def catalog_lock(backup_dir):
+	"""Hold an exclusive lock on the catalog of a backup directory.
+	A sidecar lock file is used because write_catalog replaces the catalog file itself."""
+	with open(catalog_path(backup_dir) + LOCK_EXTENSION, 'a') as f:
+		_lock(f, True)
+		try:
+			yield
+		finally:
+			_lock(f, False)
+
+def _append_lines(backup_dir, lines):
+	# Lock the catalog so concurrent backups (e.g. from other SHC members) don't interleave lines
+	# and a catalog rebuild doesn't drop them
+	with catalog_lock(backup_dir):
+		with open(catalog_path(backup_dir), 'a') as f:
+			f.write(''.join([json.dumps(line) + '\n' for line in lines]))
+			f.flush()
+
+def append_catalog_entry(backup_dir, entry):
+	"""Add (or replace) a backup file entry in the catalog"""
+	_append_lines(backup_dir, [entry])
+
+def remove_catalog_entries(backup_dir, filenames):
+	"""Mark backup files as deleted in the catalog"""
+	if len(filenames) > 0:
+		_append_lines(backup_dir, [{'file': os.path.basename(f), 'deleted': True} for f in filenames])
+
+def catalog_exists(backup_dir):
+	return os.path.isfile(catalog_path(backup_dir))
+
+def load_catalog(backup_dir):
+	"""Read the catalog for a backup directory. Returns a dict of file name -> entry, oldest backup first."""
+	entries = {}
+	if not catalog_exists(backup_dir):
+		return entries
+	with open(catalog_path(backup_dir), 'r') as f:
+		for line in f:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				# Partially written line
+				continue
+			if entry.get('deleted'):
+				entries.pop(entry['file'], None)
+			else:
+				# Later lines replace earlier ones for the same file
+				entries.pop(entry['file'], None)
+				entries[entry['file']] = entry
+	return dict(sorted(entries.items(), key=lambda e: e[1].get('mtime') or 0))
+
+def write_catalog(backup_dir, entries):
+	"""Replace the catalog with the given entries (compacting deleted and replaced lines).
+	Callers hold catalog_lock() from reading the old catalog until this returns."""
+	temp_path = catalog_path(backup_dir) + '.tmp'
+	with open(temp_path, 'w') as f:
+		for entry in list(entries.values()):
+			f.write(json.dumps(entry) + '\n')
+	os.replace(temp_path, catalog_path(backup_dir))
+
+def rebuild_catalog(logger, backup_dir):
+	"""Rebuild the catalog from the backup files in the directory.
+	Record counts and checksums are kept for files that are unchanged since they were cataloged."""
+	with catalog_lock(backup_dir):
+		old_entries = load_catalog(backup_dir)
+		entries = {}
+		for filename in glob.glob(os.path.join(backup_dir, BACKUP_FILE_PATTERN)):
+			old_entry = old_entries.get(os.path.basename(filename))
+			entry = build_catalog_entry(filename)
+			if entry is None:
+				continue
+			if old_entry is not None and old_entry.get('bytes') == entry['bytes']:
+				for k in ['records', 'uncompressed_bytes', 'checksum', 'status']:
+					entry[k] = old_entry.get(k)
+			entries[entry['file']] = entry
+		entries = dict(sorted(entries.items(), key=lambda e: e[1]['mtime']))
+		write_catalog(backup_dir, entries)
+	logger.info("Rebuilt backup catalog for %s: %d files (%d previously cataloged)" % (backup_dir, len(entries), len(old_entries)))
+	return entries
+
+def find_catalog_entries(backup_dir, pattern):
+	"""Get the catalog entries whose file name matches a wildcard pattern"""
+	pattern = os.path.basename(pattern)
+	return [e for e in list(load_catalog(backup_dir).values()) if fnmatch.fnmatchcase(e['file'], pattern)]
+
+class retention_policy:
+	"""Rules for which backups of a collection to keep.
+
+	A backup is deleted if keep rules are set and it matches none of them
+	(keep_last: one of the newest N backups; keep_daily: the newest backup of
+	its day, for the last N days), if it is older than max_age_days, or if it
+	pushes the total size of the newer backups it is grouped with past max_bytes.
+	Zero disables a rule.
+	"""
+	def __init__(self, name, keep_last=0, keep_daily=0, max_age_days=0, max_bytes=0):
+		self.name = name
+		self.keep_last = int(keep_last or 0)
+		self.keep_daily = int(keep_daily or 0)
+		self.max_age_days = float(max_age_days or 0)
+		self.max_bytes = int(max_bytes or 0)
+
+	def is_set(self):
+		return self.keep_last > 0 or self.keep_daily > 0 or self.max_age_days > 0 or self.max_bytes > 0
+
+	def expired(self, entries, now):
+		"""Get the (entry, reason) pairs to delete from a group of backups sorted newest first"""
+		expired = []
+		days_kept = set()
+		total_bytes = 0
+		keep_rules = self.keep_last > 0 or self.keep_daily > 0
+		for i, entry in enumerate(entries):
+			age_days = (now - entry['mtime']) / 86400
+			day = time.strftime('%Y%m%d', time.localtime(entry['mtime']))
+			total_bytes += entry['bytes']
+
+			kept = False
+			if self.keep_last > 0 and i < self.keep_last:
+				kept = True
+			if self.keep_daily > 0 and age_days < self.keep_daily and day not in days_kept:
+				days_kept.add(day)
+				kept = True
+
+			if self.max_bytes > 0 and total_bytes > self.max_bytes:
+				expired.append((entry, 'size'))
+			elif self.max_age_days > 0 and age_days > self.max_age_days:
+				expired.append((entry, 'age'))
+			elif keep_rules and not kept:
+				expired.append((entry, 'count'))
+		return expired
+
+def get_retention_policies(conf):
+	"""Build the retention policies from the kvstore_tools.conf stanzas.
+
+	[settings] retention_days/retention_size is the default policy, shared by all
+	collections without their own policy. [retention:<app>/<collection>] stanzas
+	(wildcards allowed) set a policy for each matching collection. Returns the
+	default policy and a list of (pattern, policy), most specific pattern first.
+	"""
+	settings = conf.get('settings', {})
+	default_policy = retention_policy('default',
+		max_age_days = settings.get('retention_days'),
+		max_bytes = int(settings.get('retention_size') or 0) * 1024 * 1024)
+	policies = []
+	for stanza, options in list(conf.items()):
+		if stanza.startswith('retention:'):
+			pattern = stanza[len('retention:'):].strip()
+			policies.append((pattern, retention_policy(stanza,
+				keep_last = options.get('keep_last'),
+				keep_daily = options.get('keep_daily'),
+				max_age_days = options.get('retention_days'),
+				max_bytes = int(options.get('retention_size') or 0) * 1024 * 1024)))
+	# Exact names before wildcards, then longer (more specific) patterns first
+	policies.sort(key=lambda p: (p[0].count('*'), -len(p[0])))
+	return default_policy, policies
+
+def group_backup_shards(entries):
+	"""Combine the catalog entries for the shards of each backup into one entry for the whole backup
+	(newest mtime, total size, 'files' listing the shard entries)"""
+	backups = {}
+	for entry in entries:
+		backup_id = entry.get('backup') or entry['file']
+		if backup_id not in backups:
+			backups[backup_id] = dict(entry, files=[entry])
+		else:
+			backup = backups[backup_id]
+			backup['files'].append(entry)
+			backup['mtime'] = max(backup['mtime'], entry['mtime'])
+			backup['bytes'] += entry['bytes']
+	return list(backups.values())
+
+def evaluate_retention(entries, default_policy, policies, now=None):
+	"""Apply the retention policies to the catalog entries in a single pass.
+	The shards of a backup are kept or deleted together.
+	Returns the list of (entry, reason, policy name) to delete."""
+	now = now or time.time()
+	groups = {}
+	for entry in sorted(group_backup_shards(entries), key=lambda e: e['mtime'], reverse=True):
+		collection_id = entry['app'] + '/' + entry['collection']
+		policy = default_policy
+		for pattern, p in policies:
+			if fnmatch.fnmatchcase(collection_id, pattern):
+				policy = p
+				break
+		# Collections with their own policy are evaluated separately; the rest share the default
+		group_id = collection_id if policy is not default_policy else None
+		groups.setdefault(group_id, (policy, []))[1].append(entry)
+
+	expired = []
+	for policy, group_entries in list(groups.values()):
+		if policy.is_set():
+			for backup, reason in policy.expired(group_entries, now):
+				expired.extend([(e, reason, policy.name) for e in backup['files']])
+	return expired
+
+def delete_backup_files(logger, backup_dir, filenames, threads=8):
+	"""Delete backup files (and their block indexes) in parallel (useful on high-latency
+	network file systems) and remove them from the catalog. Returns the list of files deleted."""
+	def delete_file(filename):
+		try:
+			if os.path.isfile(os.path.join(backup_dir, filename + INDEX_EXTENSION)):
+				os.remove(os.path.join(backup_dir, filename + INDEX_EXTENSION))
+			os.remove(os.path.join(backup_dir, filename))
+		except FileNotFoundError:
+			logger.debug("File already deleted: %s" % filename)
+		except BaseException as e:
+			logger.error("Could not delete backup file %s: %s" % (filename, repr(e)))
+			return None
+		return filename
+
+	if len(filenames) == 0:
+		return []
+	from multiprocessing.dummy import Pool as ThreadPool
+	pool = ThreadPool(max(min(threads, len(filenames)), 1))
+	try:
+		deleted = [f for f in pool.map(delete_file, filenames) if f is not None]
+	finally:
+		pool.close()
+	remove_catalog_entries(backup_dir, deleted)
+	return deleted
+
+def verify_backup_file(filename, entry=None, chunk_size=4194304):
+	"""Check a backup file against its catalog entry without parsing the JSON.
+
+	Decompresses the file as a stream, counting lines (one record per line) and
+	computing the checksum. Returns a dict with the status (valid, invalid or
+	unverified when there is no checksum to compare), message, records and checksum.
+	"""
+	codec = codec_from_filename(filename)
+	if codec is None:
+		return {'status': 'invalid', 'message': 'Unsupported backup file format', 'records': None, 'checksum': None}
+
+	algorithm = 'sha256'
+	if entry is not None and entry.get('checksum') and ':' in entry['checksum']:
+		algorithm = entry['checksum'].split(':')[0]
+	file_hash = hashlib.new(algorithm)
+	newlines = 0
+	data_bytes = 0
+	first = b''
+	last = b''
+	try:
+		with codec.open_reader(filename) as fh:
+			chunk = fh.read(chunk_size)
+			while chunk:
+				if data_bytes == 0:
+					first = chunk[:1]
+				file_hash.update(chunk)
+				newlines += chunk.count(b'\n')
+				data_bytes += len(chunk)
+				last = chunk[-1:]
+				chunk = fh.read(chunk_size)
+	except BaseException as e:
+		return {'status': 'invalid', 'message': 'Could not read file: %s' % repr(e), 'records': None, 'checksum': None}
+
+	checksum = '%s:%s' % (algorithm, file_hash.hexdigest())
+	if format_from_filename(filename) == 'ndjson':
+		# Every record ends with a newline
+		records = newlines
+		complete = data_bytes == 0 or last == b'\n'
+	else:
+		# Records are separated by newlines inside [ ]
+		records = newlines + 1 if data_bytes > 0 else 0
+		complete = data_bytes == 0 or (first == b'[' and last == b']')
+	result = {'records': records, 'checksum': checksum, 'bytes': data_bytes}
+
+	if not complete:
+		result.update({'status': 'invalid', 'message': 'Backup is truncated or malformed'})
+	elif entry is None or not entry.get('checksum'):
+		result.update({'status': 'unverified', 'message': 'No checksum in the catalog'})
+	elif entry['checksum'] != checksum:
+		result.update({'status': 'invalid', 'message': 'Checksum mismatch'})
+	elif entry.get('records') is not None and entry['records'] != records:
+		result.update({'status': 'invalid', 'message': 'Record count mismatch (expected %d)' % entry['records']})
+	else:
+		result.update({'status': 'valid', 'message': 'Checksum and record count match'})
+	return result
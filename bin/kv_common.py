@@ -4,24 +4,149 @@
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9
 
-from __future__ import print_function
-from builtins import str
-from future import standard_library
-standard_library.install_aliases()
 import os
 import sys
 import json
 import time
 from datetime import datetime, timedelta
-import gzip
 import re
-from deductiv_helpers import eprint, request
-import splunk.rest as rest
+import hashlib
+import hmac
+import itertools
+import urllib.parse
+from contextlib import nullcontext
+from deductiv_helpers import eprint, request, retry_policy, str2bool
+from kv_compression import codec_from_filename, format_from_filename, INDEX_EXTENSION, load_block_index, find_index_blocks, read_index_block
 from splunk.clilib import cli_common as cli
+# splunk.rest, splunklib.client and kv_credentials (splunksecrets) are slow to import
+# and only needed by some commands. They are imported by the functions that use them.
 
 # Add lib folders to import path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
-from splunksecrets import decrypt
+
+class batch_controller:
+	"""Sizes KV store requests to hit a target payload size and response time.
+
+	The first batch is a small probe, since nothing is known about the record size
+	yet. Its records size the second batch: as large as the byte target allows.
+	After that, the batch grows or shrinks after each request in proportion to how
+	far the observed latency was from the target, then is capped so the expected
+	payload (average record size * records) stays under the byte target. The result
+	is always kept within [min_size, max_size], where max_size is the server limit.
+	"""
+	def __init__(self, initial_size, max_size, min_size=1, target_bytes=0, target_latency=0, adaptive=True):
+		self.max_size = max(int(max_size), 1)
+		self.min_size = max(min(int(min_size), self.max_size), 1)
+		self.target_bytes = target_bytes
+		self.target_latency = target_latency
+		self.adaptive = adaptive
+		self.record_bytes = None
+		self.size = self._clamp(initial_size)
+
+	def _clamp(self, size):
+		return int(max(self.min_size, min(self.max_size, size)))
+
+	def update(self, records, response_bytes, seconds):
+		"""Record the result of a request and return the size of the next batch"""
+		if not self.adaptive or records == 0:
+			return self.size
+		# Exponentially weighted average record size, so one odd batch doesn't swing the size
+		batch_record_bytes = float(response_bytes) / records
+		if self.record_bytes is None:
+			# The probe batch only measured the record size. Start from the largest batch it allows.
+			self.record_bytes = batch_record_bytes
+			size = self.max_size
+		else:
+			self.record_bytes = 0.7 * self.record_bytes + 0.3 * batch_record_bytes
+			size = self.size
+			if self.target_latency > 0 and seconds > 0:
+				# Scale toward the latency target, at most doubling or halving per request
+				size = size * max(0.5, min(2.0, self.target_latency / seconds))
+		if self.target_bytes > 0:
+			size = min(size, self.target_bytes / self.record_bytes)
+		self.size = self._clamp(size)
+		return self.size
+
+def get_batch_controller(cfg, server_limit, max_batch_bytes=0):
+	"""Build a batch controller from the app configuration, bounded by the server limit"""
+	batch_size = int(cfg.get('backup_batch_size') or server_limit)
+	max_size = min(batch_size, server_limit)
+	target_bytes = float(cfg.get('batch_target_size_mb') or 0) * 1024 * 1024
+	if max_batch_bytes > 0:
+		target_bytes = min(target_bytes, max_batch_bytes) if target_bytes > 0 else max_batch_bytes
+	min_size = int(cfg.get('batch_min_size') or 1)
+	adaptive = str2bool(cfg.get('batch_adaptive', False))
+	# Adaptive batches start with a probe of min_size records, so a first batch of wide
+	# records can't exceed the server's result size limit before their size is known
+	return batch_controller(min_size if adaptive else max_size, max_size,
+		min_size = min_size,
+		target_bytes = target_bytes,
+		target_latency = float(cfg.get('batch_target_latency') or 0),
+		adaptive = adaptive)
+
+# Retry policy shared by all KV store requests in this process
+_retry = None
+
+def get_retry_policy():
+	"""Get the retry policy for KV store requests, built from the app configuration on first use"""
+	global _retry
+	if _retry is None:
+		cfg = cli.getConfStanza('kvstore_tools','settings')
+		options = dict(
+			attempts = int(cfg.get('retry_attempts') or 1),
+			backoff = float(cfg.get('retry_backoff') or 1),
+			max_backoff = float(cfg.get('retry_max_backoff') or 30),
+			jitter = float(cfg.get('retry_jitter') or 0))
+		status_codes = [c.strip() for c in str(cfg.get('retry_status_codes') or '').split(',') if c.strip()]
+		if len(status_codes) > 0:
+			options['status_codes'] = status_codes
+		_retry = retry_policy(**options)
+	return _retry
+
+# [kvstore] limits.conf settings, cached per server URI
+_kvstore_limits = {}
+
+# Capabilities of each session key, cached for the life of the search process
+_capabilities = {}
+
+def get_capabilities(session_key):
+	"""Get the capabilities of the user of a session key (cached per process)"""
+	if session_key not in _capabilities:
+		import splunk.rest as rest
+		content = rest.simpleRequest('/services/authentication/current-context?output_mode=json', sessionKey=session_key)[1]
+		content = json.loads(content)
+		_capabilities[session_key] = content['entry'][0]['content']['capabilities']
+	return _capabilities[session_key]
+
+def is_authorized(session_key, username, capability):
+	"""Whether a user can run a command that requires the capability (or run_kvst_all)"""
+	if username == 'splunk-system-user':
+		return True
+	capabilities = get_capabilities(session_key)
+	return capability in capabilities or 'run_kvst_all' in capabilities
+
+def get_kvstore_limits(logger, uri, session_key):
+	"""Get the [kvstore] limits.conf settings from the server at uri.
+	Falls back to the local limits.conf if the server's settings can't be read."""
+	if uri in _kvstore_limits:
+		return _kvstore_limits[uri]
+
+	limits_url = uri + '/servicesNS/nobody/system/configs/conf-limits/kvstore?output_mode=json'
+	headers = {
+		'Authorization': 'Splunk %s' % session_key,
+		'Content-Type': 'application/json'}
+	try:
+		response, response_code = request('GET', limits_url, '', headers, retry=get_retry_policy())
+		if response_code == 200:
+			limits = json.loads(response)['entry'][0]['content']
+			logger.debug("Read KV store limits from %s" % hostname_from_uri(uri))
+		else:
+			raise Exception("Error %s" % response_code)
+	except BaseException as e:
+		logger.warning("Could not read KV store limits from %s, using local limits.conf: %s" % (hostname_from_uri(uri), repr(e)))
+		limits = cli.getConfStanza('limits','kvstore')
+	_kvstore_limits[uri] = limits
+	return limits
 
 def get_server_apps(uri, session_key, app = None):
 	apps = []
@@ -29,6 +154,7 @@ def get_server_apps(uri, session_key, app = None):
 		apps.append(app)
 	else:
 		# Enumerate all remote apps
+		import splunk.rest as rest
 		apps_uri = uri + '/services/apps/local?output_mode=json&count=0'
 		content = rest.simpleRequest(apps_uri, sessionKey=session_key)[1]
 		content = json.loads(content)
@@ -54,7 +180,7 @@ def get_app_collections(uri, session_key, selected_collection, selected_app, app
 			'Content-Type': 'application/json'}
 		
 		try:
-			response, response_code = request('GET', collections_url, '', headers)
+			response, response_code = request('GET', collections_url, '', headers, retry=get_retry_policy())
 			if response_code == 200:
 				response = json.loads(response)
 			else:
@@ -81,7 +207,7 @@ def get_app_collections(uri, session_key, selected_collection, selected_app, app
 					eprint("Added {0}/{1} to backup list".format(entry_app, entry_collection))
 	return collections
 
-def copy_collection(logger, source_session_key, source_uri, target_session_key, target_uri, app, collection, append):
+def copy_collection(logger, source_session_key, source_uri, target_session_key, target_uri, app, collection, append, query=None, fields=None, sort=None, tree=None):
 	# Enumerate all of the collections in the app (if an app is selected)
 	#collection_contents = download_collection(logger, source_uri, app, collection)
 	source_host = hostname_from_uri(source_uri)
@@ -103,30 +229,26 @@ def copy_collection(logger, source_session_key, source_uri, target_session_key,
 	os.makedirs(staging_dir, exist_ok=True)
 
 	# Download the collection to a file (compressed)
+	import kv_metrics
+	metrics = kv_metrics.operation_metrics('copy_collection', get_retry_policy(), app=app, collection=collection, source=source_host, target=target_host)
 	try:
-		download_start_time = time.time()
-		result, message, record_count = download_collection(logger, source_uri, source_session_key, app, collection, output_file, True)
-		download_end_time = time.time()
-		download_time = str(timedelta(seconds=(download_end_time - download_start_time)))
-		delete_start_time = 0
-		delete_end_time = 0
-		upload_start_time = 0
-		upload_end_time = 0
+		with metrics.phase('download'):
+			result, message, record_count = download_collection(logger, source_uri, source_session_key, app, collection, output_file, query, fields, sort, metrics=metrics, tree=tree)
+		download_time = str(timedelta(seconds=metrics.phases['download']))
 		posted = 0
 		delete_time = None
 		upload_time = None
 		
 		if (result == "success" or result=="skipped") and not append:
-			# Delete the target collection prior to uploading
-			delete_start_time = time.time()
-			response_code = delete_collection(logger, target_uri, target_session_key, app, collection)
-			delete_end_time = time.time()
+			# Delete the target collection prior to uploading. With a query, only the matching
+			# records are replaced and the rest of the target collection is kept.
+			with metrics.phase('delete'):
+				response_code = delete_collection(logger, target_uri, target_session_key, app, collection, query)
 			logger.debug("Response code for pre-upload collection deletion request: %d" % response_code)
 
 		if result == "success":
-			upload_start_time = time.time()
-			result, message, posted = upload_collection(logger, target_uri, target_session_key, app, collection, output_file)
-			upload_end_time = time.time()
+			with metrics.phase('upload'):
+				result, message, posted = upload_collection(logger, target_uri, target_session_key, app, collection, output_file, metrics)
 		elif result=="skipped":
 			result = "empty"
 		else:
@@ -136,26 +258,39 @@ def copy_collection(logger, source_session_key, source_uri, target_session_key,
 		if os.path.exists(output_file):
 			os.remove(output_file)
 
-		if delete_start_time > 0:
-			delete_time = str(timedelta(seconds=(delete_end_time - delete_start_time)))
-		if upload_start_time > 0:
-			upload_time = str(timedelta(seconds=(upload_end_time - upload_start_time)))
+		if tree is not None and result in ['success', 'empty']:
+			# Both copies now match the downloaded records
+			import kv_merkle
+			try:
+				kv_merkle.save_tree(os.path.expandvars(cfg['default_path']), tree)
+			except BaseException as e:
+				logger.warning('Could not save the tree of %s/%s: %s' % (app, collection, repr(e)))
+
+		if 'delete' in metrics.phases:
+			delete_time = str(timedelta(seconds=metrics.phases['delete']))
+		if 'upload' in metrics.phases:
+			upload_time = str(timedelta(seconds=metrics.phases['upload']))
+		metrics.count('records', record_count)
 		
-		return { "app": app, "collection": collection, "result": result, 
+		row = { "app": app, "collection": collection, "result": result, 
 			"download_time": download_time, "delete_time": delete_time, 
-			"upload_time": upload_time, "download_count": record_count, "upload_count": posted}
+			"upload_time": upload_time, "download_count": record_count, "upload_count": posted }
+		row.update(metrics.fields())
+		kv_metrics.log_metrics(logger, cfg, metrics, result=result, upload_count=posted)
+		return row
 
 	except BaseException as e:
 		raise Exception("Error copying the collection from %s to %s: %s" % (source_host, target_host, repr(e)))
 
-def delete_collection(logger, remote_uri, remote_session_key, app, collection):
-	# Build the URL for deleting the collection
-	url_tmpl = '%(server_uri)s/servicesNS/%(owner)s/%(app)s/storage/collections/data/%(collection)s/?output_mode=json'
+def delete_collection(logger, remote_uri, remote_session_key, app, collection, query=None):
+	# Build the URL for deleting the collection (or only the records matching the query)
+	url_tmpl = '%(server_uri)s/servicesNS/%(owner)s/%(app)s/storage/collections/data/%(collection)s/?output_mode=json%(filter)s'
 	delete_url = url_tmpl % dict(
 		server_uri = remote_uri,
 		owner = 'nobody',
 		app = app,
-		collection = collection)
+		collection = collection,
+		filter = get_data_filter(query))
 	
 	# Set request headers
 	headers = {
@@ -166,14 +301,200 @@ def delete_collection(logger, remote_uri, remote_session_key, app, collection):
 
 	# Delete the collection contents
 	try:
-		response, response_code = request('DELETE', delete_url, "", headers)
+		response, response_code = request('DELETE', delete_url, "", headers, retry=get_retry_policy())
 		logger.debug('Server response for collection deletion: (%d) %s' % (response_code, response))
-		logger.info("Deleted collection: %s\\%s from %s" % (app, collection, hostname))
+		if query:
+			logger.info("Deleted records matching %s from collection: %s\\%s on %s" % (query, app, collection, hostname))
+		else:
+			logger.info("Deleted collection: %s\\%s from %s" % (app, collection, hostname))
 		return response_code
 	except BaseException as e:
 		raise Exception('Failed to delete collection %s/%s from %s: %s' % (app, collection, hostname, repr(e)))
 
-def download_collection(logger, remote_uri, remote_session_key, app, collection, output_file, compress=False):
+def get_data_options(logger, query=None, fields=None, sort=None, append=None):
+	"""Validate the query, fields and sort options of a command, returning (query, fields, sort) with None
+	for options that aren't set. For copies (append is given), fields requires append=true, because the
+	target collection would otherwise be replaced with partial records. Raises ValueError."""
+	if query:
+		try:
+			json.loads(query)
+		except ValueError as e:
+			raise ValueError("Invalid query (must be JSON): %s" % repr(e))
+		logger.debug('Query: %s' % query)
+	if fields:
+		logger.debug('Fields: %s' % fields)
+		if append is not None and not append:
+			raise ValueError("fields can only be used with append=true. Otherwise the target collection would be replaced with partial records.")
+	if sort:
+		logger.debug('Sort: %s' % sort)
+	return (query or None, fields or None, sort or None)
+
+def get_data_filter(query=None, fields=None, sort=None):
+	"""Build the query string for filtering, projecting and sorting a collection data request"""
+	data_filter = {}
+	if query:
+		data_filter['query'] = query
+	if fields:
+		data_filter['fields'] = ','.join([f.strip() for f in fields.split(',')])
+	if sort:
+		data_filter['sort'] = ','.join([f.strip() for f in sort.split(',')])
+	if len(data_filter) > 0:
+		return '&' + urllib.parse.urlencode(data_filter)
+	return ''
+
+class checksum_writer:
+	"""Passes writes through to a file object, keeping a checksum and byte count of the data written"""
+	def __init__(self, fh, algorithm='sha256'):
+		self.fh = fh
+		self.hash = hashlib.new(algorithm)
+		self.algorithm = algorithm
+		self.bytes = 0
+
+	def write(self, data):
+		self.hash.update(data)
+		self.bytes += len(data)
+		return self.fh.write(data)
+
+	def end_record(self, key):
+		# Block-indexed writers need to know where records end
+		if hasattr(self.fh, 'end_record'):
+			self.fh.end_record(key)
+
+	def checksum(self):
+		return '%s:%s' % (self.algorithm, self.hash.hexdigest())
+
+	def close(self):
+		self.fh.close()
+
+class backup_file_writer:
+	"""Writes records to a single backup file, one record per line. The file
+	extension selects the format (JSON array or NDJSON) and compression codec."""
+	def __init__(self, filename, cfg, index=False):
+		self.filename = filename
+		codec = codec_from_filename(filename)
+		if codec is None:
+			raise ValueError("Unsupported backup file extension: %s" % filename)
+		self.ndjson = format_from_filename(filename) == 'ndjson'
+		self.index = index and codec.open_indexed_writer is not None
+		open_writer = codec.open_indexed_writer if self.index else codec.open_writer
+		self.fh = checksum_writer(open_writer(filename,
+			int(cfg.get('compression_level') or 6),
+			int(cfg.get('compression_threads') or 0)))
+		self.records = 0
+
+	def write_records(self, records):
+		if len(records) == 0:
+			return
+		if self.ndjson:
+			# Each record terminated by a newline
+			lines = [(json.dumps(r, ensure_ascii=False) + '\n').encode('utf-8') for r in records]
+		else:
+			# Records delimited by commas, with a leading [ at the start of the file
+			lines = [(',\n' + json.dumps(r, ensure_ascii=False)).encode('utf-8') for r in records]
+			if self.records == 0:
+				lines[0] = b'[' + lines[0][2:]
+
+		if self.index:
+			for line, record in zip(lines, records):
+				self.fh.write(line)
+				self.fh.end_record(record.get('_key'))
+		else:
+			self.fh.write(b''.join(lines))
+		self.records += len(records)
+
+	def close(self):
+		"""Finish the file. Returns its record count, uncompressed size and checksum."""
+		if self.records > 0 and not self.ndjson:
+			self.fh.write(b']')
+		self.fh.close()
+		return {'file': self.filename, 'records': self.records, 'uncompressed_bytes': self.fh.bytes, 'checksum': self.fh.checksum()}
+
+def shard_filename(filename, part):
+	"""Get the name of a backup shard (app#collection#timestamp#partNNN.json[.ext])"""
+	base, extension = re.match(r'(.*?)(\.(?:nd)?json.*)$', filename).groups()
+	return '%s#part%03d%s' % (base, part, extension)
+
+class backup_writer:
+	"""Writes a backup to a file, or to a series of shard files when max_records or
+	max_bytes is set. A new shard is started once the current one holds max_records
+	records or max_bytes (uncompressed) bytes. Each shard is a complete backup file."""
+	def __init__(self, filename, cfg, index=False, max_records=0, max_bytes=0):
+		self.filename = filename
+		self.cfg = cfg
+		self.index = index
+		self.max_records = max_records
+		self.max_bytes = max_bytes
+		self.sharded = max_records > 0 or max_bytes > 0
+		self.sort_by_key = index and codec_from_filename(filename).open_indexed_writer is not None
+		self.current = None
+		self.files = []
+		self.filenames = []
+
+	def _open_next(self):
+		if self.sharded:
+			filename = shard_filename(self.filename, len(self.files) + 1)
+		else:
+			filename = self.filename
+		self.filenames.append(filename)
+		self.current = backup_file_writer(filename, self.cfg, self.index)
+
+	def _close_current(self):
+		self.files.append(self.current.close())
+		self.current = None
+
+	def write_records(self, records):
+		if not self.sharded:
+			if self.current is None:
+				self._open_next()
+			self.current.write_records(records)
+			return
+
+		i = 0
+		while i < len(records):
+			if self.current is None:
+				self._open_next()
+			if self.max_bytes > 0:
+				# Check the size after each record
+				count = 1
+			elif self.max_records > 0:
+				count = self.max_records - self.current.records
+			self.current.write_records(records[i:i+count])
+			i += count
+			if (self.max_records > 0 and self.current.records >= self.max_records) or \
+				(self.max_bytes > 0 and self.current.fh.bytes >= self.max_bytes):
+				self._close_current()
+
+	def close(self):
+		"""Finish the backup. Returns the stats for each file written."""
+		if self.current is None and len(self.files) == 0:
+			# Always write a file, even for an empty collection
+			self._open_next()
+		if self.current is not None:
+			self._close_current()
+		return self.files
+
+	def discard(self):
+		"""Delete the files written so far (after an error)"""
+		if self.current is not None:
+			try:
+				self.current.close()
+			except BaseException:
+				pass
+			self.current = None
+		for filename in self.filenames:
+			for name in [filename, filename + INDEX_EXTENSION]:
+				if os.path.isfile(name):
+					os.remove(name)
+
+def download_collection(logger, remote_uri, remote_session_key, app, collection, output_file, query=None, fields=None, sort=None, stats=None, index=False, max_file_records=0, max_file_bytes=0, writer=None, metrics=None, tree=None):
+	"""Download a collection to a backup file. The file extension selects the format (.json or .ndjson) and compression codec.
+	If a stats dict is given, it is filled with the record count, uncompressed size and checksum, and the stats of each file written.
+	If index is set and the codec supports it, a seekable file is written with a sidecar block index.
+	If max_file_records or max_file_bytes is set, the backup is split into shards (app#collection#timestamp#partNNN.json[.ext]).
+	A writer (e.g. kv_repository.repository_writer) can be given to write the records somewhere other than output_file.
+	If metrics (kv_metrics.operation_metrics) is given, the time spent parsing and writing records is added to it.
+	If a tree (kv_merkle.merkle_tree) is given, the records are added to it as they are downloaded."""
+	phase = metrics.phase if metrics is not None else lambda name: nullcontext()
 	# Set request headers
 	headers = {
 		'Authorization': 'Splunk %s' % remote_session_key,
@@ -183,23 +504,36 @@ def download_collection(logger, remote_uri, remote_session_key, app, collection,
 	# Counters
 	loop_record_count = None
 	total_record_count = 0
+	limit = None
 
 	# Config options
 	cfg = cli.getConfStanza('kvstore_tools','settings')
-	batch_size = int(cfg.get('backup_batch_size'))
-	limits_cfg = cli.getConfStanza('limits','kvstore')
+	limits_cfg = get_kvstore_limits(logger, remote_uri, remote_session_key)
 	maxrows = int(limits_cfg.get('max_rows_per_query'))
-	url_tmpl_collection_download = '%(server_uri)s/servicesNS/%(owner)s/%(app)s/storage/collections/data/%(collection)s?limit=%(limit)s&skip=%(skip)s&output_mode=json'
+	max_result_bytes = int(limits_cfg.get('max_size_per_result_mb', 0)) * 1024 * 1024
+	batch = get_batch_controller(cfg, maxrows, max_result_bytes)
+	url_tmpl_collection_download = '%(server_uri)s/servicesNS/%(owner)s/%(app)s/storage/collections/data/%(collection)s?limit=%(limit)s&skip=%(skip)s&output_mode=json%(filter)s'
 
+	f = None
 	try:
 		cursor = 0
-		if compress:
-			f = gzip.open(output_file, "wb")	# Requires bytes
-		else:
-			f = open(output_file, "w")			# Requires string
-
-		# If the loop record count is equal to batch size, we hit the limit. Keep going.
-		while (loop_record_count is None or loop_record_count == batch_size):
+		if writer is None:
+			# The file extension selects the format and compression codec (.json, .json.gz, .ndjson.xz, ...)
+			if codec_from_filename(output_file) is None:
+				raise ValueError("Unsupported backup file extension: %s" % output_file)
+			writer = backup_writer(output_file, cfg, index, max_file_records, max_file_bytes)
+		f = writer
+		if f.sort_by_key and not sort:
+			# Sort by _key so each block of the index (or repository chunk) covers a narrow, non-overlapping range
+			sort = '_key'
+
+		data_filter = get_data_filter(query, fields, sort)
+		if len(data_filter) > 0:
+			logger.debug('Collection data filter: %s' % data_filter)
+
+		# If the loop record count is equal to the requested limit, there may be more records. Keep going.
+		while (loop_record_count is None or loop_record_count == limit):
+			limit = batch.size
 
 			# Build the URL
 			remote_data_url = url_tmpl_collection_download % dict(
@@ -207,49 +541,46 @@ def download_collection(logger, remote_uri, remote_session_key, app, collection,
 				owner = 'nobody',
 				app = app,
 				collection = collection,
-				limit = batch_size,
-				skip = cursor)
+				limit = limit,
+				skip = cursor,
+				filter = data_filter)
 
 			# Download the data from the collection
-			response = request('GET', remote_data_url, '', headers)[0]
-			response = response.decode('utf-8')
-			# Remove the first and last characters ( [ and ] )
-			response = response[1:-1]
-			# Insert line breaks in between records -- "}, {"
-			response = response.replace('}, {', '}, \n{')
-			# Count the number of _key values 
-			loop_record_count = response.count('"_key"')
+			request_start_time = time.time()
+			response, response_code = request('GET', remote_data_url, '', headers, retry=get_retry_policy())
+			if response_code != 200:
+				raise Exception("Error %d when downloading collection contents" % response_code)
+			request_time = time.time() - request_start_time
+			response_bytes = len(response)
+			# Parse the records so the count is exact, even if "_key" appears in the data
+			with phase('parse'):
+				records = json.loads(response)
+			loop_record_count = len(records)
 			total_record_count += loop_record_count
-			logger.debug('Counted %d total records and %d in this loop.' % (total_record_count, loop_record_count))
+			logger.debug('Counted %d total records and %d in this loop (%d bytes in %.3fs).' % (total_record_count, loop_record_count, response_bytes, request_time))
 
-			# Append the records to the variable
+			# Append the records to the backup
 			if loop_record_count > 0:
-				## Write the leading [ or comma delimiter (between batches)
-				# Start of the collection
-				if cursor == 0 and compress:
-					f.write('['.encode())
-				elif cursor == 0 and not compress:
-					f.write('[')
-
-				# Middle of the collection
-				elif cursor != 0 and compress:
-					f.write(','.encode())
-				else:
-					f.write(',')
-				
-				# Response body
-				if compress:
-					f.write(response.encode())
-				else:
-					f.write(response)
-
-				# End of the collection
-				if loop_record_count < batch_size and compress:
-					f.write(']'.encode())
-				elif loop_record_count < batch_size and not compress:
-					f.write(']')
+				with phase('write'):
+					f.write_records(records)
+				if tree is not None:
+					with phase('merkle'):
+						tree.add_records(records)
+				batch.update(loop_record_count, response_bytes, request_time)
+				if batch.size != limit:
+					logger.debug('Batch size adjusted from %d to %d records' % (limit, batch.size))
 			cursor += loop_record_count
-		f.close()
+
+		# End of the collection
+		with phase('write'):
+			files = f.close()
+		if stats is not None:
+			stats.update({
+				'records': total_record_count,
+				'uncompressed_bytes': sum([s['uncompressed_bytes'] for s in files]),
+				'checksum': files[0]['checksum'] if len(files) == 1 else None,
+				'files': files
+			})
 
 		logger.debug("Retrieved {0} records from {1}".format(total_record_count, collection))
 
@@ -258,10 +589,6 @@ def download_collection(logger, remote_uri, remote_session_key, app, collection,
 				logger.warning('Downloaded rows equal to configured limit: %s/%s' % (app, collection))
 				result = "warning"
 				message = "Downloaded rows equal to configured limit. Possible incomplete backup."
-			if batch_size > maxrows and total_record_count > maxrows:
-				logger.warning('Downloaded KV store collection with batches exceeded the limit: %s/%s' % (app, collection))
-				result = "warning"
-				message = "Batch size greater than configured query limit. Possible incomplete backup."
 			else:
 				logger.info('Downloaded KV store collection successfully: %s/%s' % (app, collection))
 				result = "success"
@@ -276,67 +603,64 @@ def download_collection(logger, remote_uri, remote_session_key, app, collection,
 		result = "error"
 		message = repr(e)
 		total_record_count = 0
-		if os.path.isfile(output_file):
-			os.remove(output_file)
+		if f is not None:
+			f.discard()
 
 	return result, message, total_record_count
 
-def upload_collection(logger, remote_uri, remote_session_key, app, collection, file_path):
-	# Set request headers
-	headers = {
-		'Authorization': 'Splunk %s' % remote_session_key,
-		'Content-Type': 'application/json'
-	}
-	
-	limits_cfg = cli.getConfStanza('limits','kvstore')
-	# !!! This doesn't query the remote host for the limit. Always uses the local instance
-	limit = int(limits_cfg.get('max_documents_per_batch_save'))
-	logger.debug("Max documents per batch save = %d" % limit)
-
+def read_json_backup(logger, file_path, codec):
+	"""Read all of the records from a JSON array backup file. Returns None if the file can't be parsed."""
+	with codec.open_reader(file_path) as fh:
+		data = fh.read()
 	try:
-		file_name = re.search(r'(.*)(?:\/|\\)([^\/\\]+)', file_path).group(2)
-
-		# Open the file using standard or gzip libs
-		if file_path.endswith('.json'):
-			fh = open(file_path, 'r')
-		elif file_path.endswith('.json.gz'):
-			fh = gzip.open(file_path, 'rb')
-
-		# Read the file data and parse with JSON loader
-		contents = json.loads(fh.read(), strict=False)
+		# Parse the file data with JSON loader
+		return json.loads(data, strict=False)
 	except BaseException as e:
 		# Account for a bug in prior versions where the record count could be wrong if "_key" was in the data and the ] would not get appended.
 		logger.error("Error reading file: %s\n\tAttempting modification (Append ']')." % str(e))
 		try:
-			# Reset the file cursor to 0
-			fh.seek(0)
-			contents = json.loads(fh.read() + b']', strict=False)
+			return json.loads(data + b']', strict=False)
 		except BaseException:
 			logger.error("[Append ']'] Error reading modified json input.\n\tAttempting modification (Strip '[]')")
 			try:
-				# Reset the file cursor to 0
-				fh.seek(0)
-				contents = json.loads(fh.read().strip(b'[]'), strict=False)
+				return json.loads(data.strip(b'[]'), strict=False)
 			except BaseException as e:
 				logger.error("[Strip '[]'] Error reading modified json input for file %s.  Aborting." % file_path)
-				status = 'error'
-				message = 'Unable to read file'
-				return status, message, 0
-
-	logger.debug("File read complete.")
-	content_len = len(contents)
-	logger.debug('File %s entries: %d' % (file_name, content_len))
-	'''
-	if not append:
-		# Delete the collection contents
-		try:
-			delete_collection(logger, splunkd_uri, session_key, file_app, file_collection)
-		except urllib.error.HTTPError as e:
-			logger.critical(repr(e))
-			yield({'Error': 'Failed to delete collection: %s' % repr(e)})
-			sys.exit(4)
-	'''
-	i = 0
+				return None
+
+def read_ndjson_records(fh, chunk_size=1048576):
+	"""Yield the records from an NDJSON file handle, one line at a time"""
+	remainder = b''
+	chunk = fh.read(chunk_size)
+	while chunk:
+		lines = (remainder + chunk).split(b'\n')
+		remainder = lines.pop()
+		for line in lines:
+			if line.strip():
+				yield json.loads(line)
+		chunk = fh.read(chunk_size)
+	if remainder.strip():
+		yield json.loads(remainder)
+
+def save_records(logger, remote_uri, remote_session_key, app, collection, records, metrics=None):
+	"""Save records (from any iterable) to a collection with batch_save requests.
+	Records with the _key of an existing record replace it.
+	If metrics (kv_metrics.operation_metrics) is given, the time spent reading and encoding records is added to it."""
+	phase = metrics.phase if metrics is not None else lambda name: nullcontext()
+	# Set request headers
+	headers = {
+		'Authorization': 'Splunk %s' % remote_session_key,
+		'Content-Type': 'application/json'
+	}
+	
+	cfg = cli.getConfStanza('kvstore_tools','settings')
+	limits_cfg = get_kvstore_limits(logger, remote_uri, remote_session_key)
+	limit = int(limits_cfg.get('max_documents_per_batch_save'))
+	logger.debug("Max documents per batch save = %d" % limit)
+	max_batch_bytes = int(limits_cfg.get('max_size_per_batch_save_mb', 0)) * 1024 * 1024
+	batch_sizer = get_batch_controller(cfg, limit, max_batch_bytes)
+	records = iter(records)
+
 	batch_number = 1
 	posted = 0
 
@@ -350,30 +674,31 @@ def upload_collection(logger, remote_uri, remote_session_key, app, collection, f
 		collection = collection)
 
 	result = None
-	while i < content_len:
-		# Get the lesser number between (limit-1) and (content_len)
-		last = (batch_number*limit)
-		last = min(last, content_len)
-		batch = contents[i:last]
-		i += limit
-
-		logger.debug('Batch number: %d (%d bytes / %d records)' % (batch_number, sys.getsizeof(batch), len(batch)))
-
-		# Upload the restored records to the server
-		try:
-			response, response_code = request('POST', record_url, json.dumps(batch), headers)		# pylint: disable=unused-variable
+	try:
+		while True:
+			# Take the next batch of records
+			with phase('read'):
+				batch = list(itertools.islice(records, batch_sizer.size))
+			if len(batch) == 0:
+				break
+			with phase('encode'):
+				batch_data = json.dumps(batch)
+
+			logger.debug('Batch number: %d (%d bytes / %d records)' % (batch_number, len(batch_data), len(batch)))
+
+			# Upload the restored records to the server
+			request_start_time = time.time()
+			response, response_code = request('POST', record_url, batch_data, headers, retry=get_retry_policy())		# pylint: disable=unused-variable
 			batch_number += 1
 			posted += len(batch)
 			if response_code != 200:
 				raise Exception("Error %d when posting collection contents" % response_code)
+			batch_sizer.update(len(batch), len(batch_data), time.time() - request_start_time)
 
-		except BaseException as e:
-			result = 'error'
-			message = 'Failed to upload collection: %s' % repr(e)
-			logger.debug(message, exc_info=True)
-			#yield {'_time': time.time(), 'app': app, 'kvstore': collection, 'records': posted, 'result': 'error' }
-			# Force out of the while loop
-			i = content_len
+	except BaseException as e:
+		result = 'error'
+		message = 'Failed to upload collection: %s' % repr(e)
+		logger.debug(message, exc_info=True)
 	
 	if result is None:
 		result = 'success'
@@ -382,30 +707,184 @@ def upload_collection(logger, remote_uri, remote_session_key, app, collection, f
 		logger.info(message)
 	return result, message, posted
 
+def upload_collection(logger, remote_uri, remote_session_key, app, collection, file_path, metrics=None):
+	file_name = os.path.basename(file_path)
+	fh = None
+	try:
+		# Open the file using the codec for its extension
+		codec = codec_from_filename(file_path)
+		if codec is None:
+			raise ValueError("Unsupported backup file extension: %s" % file_path)
+		if format_from_filename(file_path) == 'ndjson':
+			# Stream the records a line at a time, in constant memory
+			fh = codec.open_reader(file_path)
+			records = read_ndjson_records(fh)
+			logger.debug('File %s opened for streaming' % file_name)
+		else:
+			with metrics.phase('read') if metrics is not None else nullcontext():
+				contents = read_json_backup(logger, file_path, codec)
+			if contents is None:
+				return 'error', 'Unable to read file', 0
+			logger.debug("File read complete.")
+			logger.debug('File %s entries: %d' % (file_name, len(contents)))
+			records = contents
+	except BaseException as e:
+		logger.error("Error reading file %s: %s" % (file_path, repr(e)))
+		return 'error', 'Unable to read file', 0
+
+	try:
+		return save_records(logger, remote_uri, remote_session_key, app, collection, records, metrics)
+	finally:
+		if fh is not None:
+			fh.close()
+
+def parse_backup_line(line):
+	"""Parse one line (record) of a JSON or NDJSON backup file. Returns None for lines without a record."""
+	line = line.strip()
+	# JSON array backups have the [ and ] on the first and last records and a comma after the others
+	if line.startswith(b'['):
+		line = line[1:]
+	if line.endswith(b','):
+		line = line[:-1]
+	if line.endswith(b']'):
+		line = line[:-1]
+	if len(line) == 0:
+		return None
+	return json.loads(line)
+
+def find_backup_records(logger, file_path, keys):
+	"""Get the records with the given _key values from a backup file.
+	If the file has a block index, only the blocks whose key range includes a key are decompressed.
+	Otherwise the whole file is read."""
+	keys = set([str(k) for k in keys])
+	found = []
+	index = load_block_index(file_path)
+	if index is not None:
+		blocks = {}
+		for key in keys:
+			for block in find_index_blocks(index, key):
+				blocks[block['offset']] = block
+		logger.debug('Reading %d of %d blocks from %s' % (len(blocks), len(index['blocks']), file_path))
+		for offset in sorted(blocks.keys()):
+			for line in read_index_block(file_path, blocks[offset]).split(b'\n'):
+				record = parse_backup_line(line)
+				if record is not None and str(record.get('_key')) in keys:
+					found.append(record)
+		return found
+
+	logger.debug('No block index for %s. Reading the whole file.' % file_path)
+	codec = codec_from_filename(file_path)
+	if codec is None:
+		raise ValueError("Unsupported backup file extension: %s" % file_path)
+	if format_from_filename(file_path) == 'ndjson':
+		with codec.open_reader(file_path) as fh:
+			return [r for r in read_ndjson_records(fh) if str(r.get('_key')) in keys]
+	contents = read_json_backup(logger, file_path, codec)
+	if contents is None:
+		raise ValueError("Unable to read file: %s" % file_path)
+	return [r for r in contents if str(r.get('_key')) in keys]
+
 def hostname_from_uri(uri):
 	return re.sub(r'https?://([^:]+):.*', r'\1', uri)
 
+def session_cache_path():
+	return os.path.join(os.getenv('SPLUNK_HOME'), 'var', 'run', 'kvstore_tools', 'session_cache.json')
+
+def _session_cache_key(host, port, username, password):
+	# Include an HMAC of the credential, so changing it forces a new login. The HMAC is keyed with
+	# splunk.secret, so the cache file can't be used to guess the password without that file.
+	import kv_credentials
+	splunk_secret = kv_credentials.read_splunk_secret().strip()
+	credential_hmac = hmac.new(splunk_secret.encode('utf-8'), ('%s:%s' % (username, password)).encode('utf-8'), hashlib.sha256).hexdigest()
+	return '%s:%s/%s/%s' % (host, port, username, credential_hmac)
+
+def load_session_cache():
+	try:
+		with open(session_cache_path(), 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def save_session_cache(cache):
+	"""Write the session cache, readable only by the Splunk user"""
+	filename = session_cache_path()
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	temp_path = '%s.%d.tmp' % (filename, os.getpid())
+	with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+		json.dump(cache, f)
+	os.replace(temp_path, filename)
+
+def session_key_is_valid(remote_uri, session_key):
+	"""Check a session key with a lightweight request (no password verification on the remote side)"""
+	headers = { 'Authorization': 'Splunk %s' % session_key }
+	try:
+		response, response_code = request('GET', remote_uri + '/services/authentication/current-context?output_mode=json', '', headers, retry=get_retry_policy())		# pylint: disable=unused-variable
+	except BaseException:
+		return False
+	return response_code == 200
+
+def get_remote_session_key(logger, host, port, username, password):
+	"""Get a session key for a remote Splunk instance.
+	Session keys are cached (per host, port and user) for session_cache_ttl seconds. A cached key
+	is checked before it is used, and if it has expired (401) or been revoked, we log in again."""
+	cfg = cli.getConfStanza('kvstore_tools','settings')
+	ttl = int(cfg.get('session_cache_ttl') or 0)
+	remote_uri = 'https://%s:%s' % (host, port)
+	now = time.time()
+	if ttl > 0:
+		try:
+			cache_key = _session_cache_key(host, port, username, password)
+		except BaseException as e:
+			logger.warning('Could not read splunk.secret. Not caching the session key: %s' % repr(e))
+			ttl = 0
+
+	if ttl > 0:
+		entry = load_session_cache().get(cache_key)
+		if entry is not None and now - entry['created'] < ttl:
+			if session_key_is_valid(remote_uri, entry['session_key']):
+				logger.debug('Using cached session key for %s@%s' % (username, host))
+				return entry['session_key']
+			logger.info('Cached session key for %s@%s is no longer valid. Logging in again.' % (username, host))
+
+	import splunklib.client as client
+	# connect() logs in
+	remote_service = client.connect(
+		host = host,
+		port = port,
+		username = username,
+		password = password)
+	session_key = remote_service.token.replace('Splunk ', '')
+	logger.debug('Logged in to %s as %s' % (host, username))
+
+	if ttl > 0:
+		try:
+			# Reload in case another search updated the cache, and drop expired entries
+			cache = dict([(k, v) for k, v in list(load_session_cache().items()) if now - v['created'] < ttl])
+			cache[cache_key] = {'session_key': session_key, 'created': now}
+			save_session_cache(cache)
+		except BaseException as e:
+			logger.warning('Could not save the session cache: %s' % repr(e))
+	return session_key
+
 def parse_custom_credentials(logger, config):
+	"""Decrypt all of the credentialN settings. Returns a dict of hostname -> {username, password}.
+	Use kv_credentials.get_credential to decrypt only the credential for one host."""
+	import kv_credentials
 	credentials = {}
 	try:
-		# Read the splunk.secret file
-		with open(os.path.join(os.getenv('SPLUNK_HOME'), 'etc', 'auth', 'splunk.secret'), 'r') as ssfh:
-			splunk_secret = ssfh.readline()
+		splunk_secret = kv_credentials.read_splunk_secret()
 
 		# list all credentials
-		for option in config:
-			if option[0:10] == 'credential':
-				logger.debug('option: ' + str(option))
-				config_value = config.get(option)
-				logger.debug(config_value)
-				try:
-					hostname, username, password = config.get(option).split(':')
-					credentials[hostname] = {}
-					credentials[hostname]['username'] = username
-					credentials[hostname]['password'] = decrypt(splunk_secret, password)
-				except:
-					# Blank or wrong format. Ignore.
-					pass
+		for hostname, (username, password) in list(kv_credentials.list_credentials(config).items()):
+			logger.debug('Credential: %s' % hostname)
+			try:
+				credentials[hostname] = {
+					'username': username,
+					'password': kv_credentials.decrypt_password(splunk_secret, password)
+				}
+			except:
+				# Wrong format. Ignore.
+				pass
 		return credentials
 	except Exception as e:
 		raise Exception("Could not parse credentials from Splunk. Error: %s" % (str(e)))
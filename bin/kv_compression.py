@@ -0,0 +1,341 @@
+# kv_compression.py
+# Compression for KV Store collection backup files
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import os
+import json
+import struct
+import zlib
+import gzip
+import bz2
+import lzma
+import importlib.util
+from collections import deque
+
+# zstd support is optional (pip package "zstandard"). It is imported when a zstd
+# file is read or written, so loading this module stays cheap.
+zstd_available = importlib.util.find_spec('zstandard') is not None
+
+# gzip member header with the FEXTRA flag set. The extra field holds a 'KV'
+# subfield with the total size of the member, so readers can walk from member
+# to member without decompressing anything.
+GZIP_KV_HEADER = struct.Struct('<BBBBIBBH2sHI')
+GZIP_KV_HEADER_LEN = GZIP_KV_HEADER.size
+GZIP_TRAILER = struct.Struct('<II')
+GZIP_FLAG_FEXTRA = 4
+GZIP_OS_UNKNOWN = 255
+
+# Sidecar block index for seekable backup files
+INDEX_EXTENSION = '.idx'
+
+def compress_member(block, level=6):
+	"""Compress a block of bytes into a complete, standalone gzip member"""
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	deflated = compressor.compress(block) + compressor.flush()
+	member_size = GZIP_KV_HEADER_LEN + len(deflated) + GZIP_TRAILER.size
+	header = GZIP_KV_HEADER.pack(0x1f, 0x8b, zlib.DEFLATED, GZIP_FLAG_FEXTRA, 0, 0, GZIP_OS_UNKNOWN,
+		8, b'KV', 4, member_size)
+	trailer = GZIP_TRAILER.pack(zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+	return header + deflated + trailer
+
+def read_member_sizes(fh):
+	"""List the (compressed size, uncompressed size) of each member of a file written by parallel_gzip_writer.
+	Returns None if the file was not written by parallel_gzip_writer."""
+	sizes = []
+	offset = 0
+	while True:
+		fh.seek(offset)
+		header = fh.read(GZIP_KV_HEADER_LEN)
+		if len(header) < GZIP_KV_HEADER_LEN:
+			break
+		magic1, magic2, method, flags, mtime, xfl, os_id, xlen, subfield, sublen, member_size = GZIP_KV_HEADER.unpack(header)	# pylint: disable=unused-variable
+		if (magic1, magic2, flags, subfield) != (0x1f, 0x8b, GZIP_FLAG_FEXTRA, b'KV'):
+			# Not one of ours (or trailing garbage)
+			return None if offset == 0 else sizes
+		fh.seek(offset + member_size - 4)
+		sizes.append((member_size, struct.unpack('<I', fh.read(4))[0]))
+		offset += member_size
+	return sizes
+
+class parallel_gzip_writer:
+	"""Binary file writer that produces a standard multi-member gzip file.
+
+	Written data is buffered into blocks of block_size bytes. Each block is
+	compressed into its own gzip member on a thread pool (zlib releases the GIL
+	while compressing), and members are written to the file in order. Any gzip
+	reader, including gzip.open, reads the result as one stream.
+	"""
+	def __init__(self, filename, level=6, threads=0, block_size=8*1024*1024):
+		self.level = level
+		self.block_size = block_size
+		threads = threads if threads > 0 else (os.cpu_count() or 1)
+		# Limit the number of blocks held in memory while waiting to be written
+		self.max_pending = threads * 2
+		from concurrent.futures import ThreadPoolExecutor
+		self.pool = ThreadPoolExecutor(max_workers=threads)
+		self.pending = deque()
+		self.buffer = []
+		self.buffered = 0
+		self.members = 0
+		self.fh = open(filename, 'wb')
+
+	def write(self, data):
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		self.buffer.append(data)
+		self.buffered += len(data)
+		if self.buffered >= self.block_size:
+			self.flush_block()
+		return len(data)
+
+	def flush_block(self):
+		"""End the current block and queue it for compression"""
+		if self.buffered == 0:
+			return
+		block = b''.join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+		self.pending.append(self.pool.submit(compress_member, block, self.level))
+		while len(self.pending) > self.max_pending:
+			self._write_member(self.pending.popleft().result())
+
+	def _write_member(self, member):
+		self.fh.write(member)
+		self.members += 1
+
+	def close(self):
+		if self.fh.closed:
+			return
+		try:
+			self.flush_block()
+			while len(self.pending) > 0:
+				self._write_member(self.pending.popleft().result())
+			if self.members == 0:
+				# Always produce a valid gzip file, even when nothing was written
+				self._write_member(compress_member(b'', self.level))
+		finally:
+			self.pool.shutdown()
+			self.fh.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class indexed_gzip_writer(parallel_gzip_writer):
+	"""parallel_gzip_writer that only ends blocks between records and writes a
+	sidecar index (the file name + INDEX_EXTENSION) with the offset, size and
+	_key range of each block, so single records can be read back by
+	decompressing only the blocks that may contain them.
+
+	Call end_record(key) after writing each record.
+	"""
+	def __init__(self, filename, level=6, threads=0, block_size=8*1024*1024):
+		super().__init__(filename, level, threads, block_size)
+		self.filename = filename
+		self.blocks = []
+		self.offset = 0
+		# Whether every record's _key is greater than the one before it
+		self.sorted = True
+		self.previous_key = None
+		self._new_block()
+
+	def _new_block(self):
+		self.first_key = None
+		self.last_key = None
+		self.min_key = None
+		self.max_key = None
+		self.block_records = 0
+
+	def write(self, data):
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		# Blocks are only ended between records (in end_record)
+		self.buffer.append(data)
+		self.buffered += len(data)
+		return len(data)
+
+	def end_record(self, key):
+		key = str(key)
+		if self.previous_key is not None and key <= self.previous_key:
+			self.sorted = False
+		self.previous_key = key
+		if self.block_records == 0:
+			self.first_key = key
+			self.min_key = key
+			self.max_key = key
+		else:
+			self.min_key = min(self.min_key, key)
+			self.max_key = max(self.max_key, key)
+		self.last_key = key
+		self.block_records += 1
+		if self.buffered >= self.block_size:
+			self.flush_block()
+
+	def flush_block(self):
+		if self.buffered == 0:
+			return
+		self.blocks.append({
+			'records': self.block_records,
+			'min_key': self.min_key,
+			'max_key': self.max_key,
+			'uncompressed': self.buffered
+		})
+		self._new_block()
+		super().flush_block()
+
+	def _write_member(self, member):
+		# Members are written in the order their blocks were queued
+		if self.members < len(self.blocks):
+			self.blocks[self.members].update({'offset': self.offset, 'length': len(member)})
+		self.offset += len(member)
+		super()._write_member(member)
+
+	def close(self):
+		if self.fh.closed:
+			return
+		super().close()
+		with open(self.filename + INDEX_EXTENSION, 'w') as f:
+			json.dump({'version': 1, 'sorted': self.sorted, 'blocks': self.blocks}, f)
+
+def load_block_index(filename):
+	"""Read the sidecar block index for a backup file, or None if it doesn't have one"""
+	try:
+		with open(filename + INDEX_EXTENSION, 'r') as f:
+			index = json.load(f)
+	except (OSError, ValueError):
+		return None
+	# Ignore indexes left behind by a backup file that has since been replaced
+	blocks = index.get('blocks', [])
+	if len(blocks) > 0 and blocks[-1]['offset'] + blocks[-1]['length'] > os.path.getsize(filename):
+		return None
+	return index
+
+def find_index_blocks(index, key):
+	"""Get the blocks from a block index whose _key range includes the key"""
+	key = str(key)
+	return [b for b in index['blocks'] if b['records'] > 0 and b['min_key'] <= key <= b['max_key']]
+
+def read_index_block(filename, block):
+	"""Decompress a single block of an indexed backup file"""
+	with open(filename, 'rb') as f:
+		f.seek(block['offset'])
+		member = f.read(block['length'])
+	return gzip.decompress(member)
+
+class backup_codec:
+	"""Reads and writes backup files for one compression format.
+
+	open_writer(filename, level, threads) returns a binary file-like object to
+	write the backup to. open_reader(filename) returns a binary file-like object
+	with the uncompressed contents. Codecs with open_indexed_writer can also
+	write seekable, block-indexed backups (see indexed_gzip_writer).
+	"""
+	def __init__(self, name, extension, open_writer, open_reader, uncompressed_size=None, open_indexed_writer=None):
+		self.name = name
+		self.extension = extension
+		self.open_writer = open_writer
+		self.open_reader = open_reader
+		self._uncompressed_size = uncompressed_size
+		self.open_indexed_writer = open_indexed_writer
+
+	def uncompressed_size(self, filename):
+		"""Size of the uncompressed contents, or None if it can't be found without decompressing the file"""
+		if self._uncompressed_size is not None:
+			return self._uncompressed_size(filename)
+		return None
+
+	def is_empty(self, filename):
+		"""Whether the file has no uncompressed content"""
+		size = self.uncompressed_size(filename)
+		if size is not None:
+			return size == 0
+		with self.open_reader(filename) as fh:
+			return len(fh.read(1)) == 0
+
+def _gzip_uncompressed_size(filename):
+	with open(filename, 'rb') as f:
+		# Multi-member files written in parallel record the size of every member
+		member_sizes = read_member_sizes(f)
+		if member_sizes is not None:
+			return sum([m[1] for m in member_sizes])
+		# Single-member gzip files have the size in the trailer (modulo 2^32)
+		f.seek(-4, 2)
+		return struct.unpack('I', f.read(4))[0]
+
+def _zstd_writer(filename, level, threads):
+	import zstandard
+	compressor = zstandard.ZstdCompressor(level=min(max(level, 1), 22), threads=threads if threads > 0 else -1)
+	return compressor.stream_writer(open(filename, 'wb'), closefd=True)
+
+def _zstd_reader(filename):
+	import zstandard
+	return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+
+codecs = {
+	'none': backup_codec('none', '',
+		lambda filename, level, threads: open(filename, 'wb'),
+		lambda filename: open(filename, 'rb'),
+		os.path.getsize),
+	'gzip': backup_codec('gzip', '.gz',
+		lambda filename, level, threads: parallel_gzip_writer(filename, min(max(level, 1), 9), threads),
+		lambda filename: gzip.open(filename, 'rb'),
+		_gzip_uncompressed_size,
+		lambda filename, level, threads: indexed_gzip_writer(filename, min(max(level, 1), 9), threads)),
+	'bz2': backup_codec('bz2', '.bz2',
+		lambda filename, level, threads: bz2.open(filename, 'wb', compresslevel=min(max(level, 1), 9)),
+		lambda filename: bz2.open(filename, 'rb')),
+	'xz': backup_codec('xz', '.xz',
+		lambda filename, level, threads: lzma.open(filename, 'wb', preset=min(max(level, 0), 9)),
+		lambda filename: lzma.open(filename, 'rb'))
+}
+if zstd_available:
+	codecs['zstd'] = backup_codec('zstd', '.zst', _zstd_writer, _zstd_reader)
+
+def get_codec(name):
+	"""Get a backup codec by name. Raises ValueError for unknown or unavailable codecs."""
+	name = str(name).lower().strip() if name else 'none'
+	if name in ['gz']:
+		name = 'gzip'
+	elif name in ['zst']:
+		name = 'zstd'
+	if name not in codecs:
+		if name == 'zstd':
+			raise ValueError("The zstd codec requires the zstandard Python package")
+		raise ValueError("Unknown compression codec: %s (available: %s)" % (name, ', '.join(sorted(codecs.keys()))))
+	return codecs[name]
+
+# Backup file formats and their base file extensions. json is a single JSON array
+# (one record per line since 2.0.9); ndjson is one JSON record per line with no array.
+backup_formats = {
+	'json': '.json',
+	'ndjson': '.ndjson'
+}
+
+def get_backup_format(name):
+	"""Validate a backup format name. Raises ValueError for unknown formats."""
+	name = str(name).lower().strip() if name else 'json'
+	if name not in backup_formats:
+		raise ValueError("Unknown backup format: %s (available: %s)" % (name, ', '.join(sorted(backup_formats.keys()))))
+	return name
+
+def _split_extension(filename):
+	"""Get the (backup format, codec) for a backup file name, or (None, None)"""
+	for backup_format, base_extension in list(backup_formats.items()):
+		if filename.endswith(base_extension):
+			return backup_format, codecs['none']
+		for codec in list(codecs.values()):
+			if codec.extension and filename.endswith(base_extension + codec.extension):
+				return backup_format, codec
+	return None, None
+
+def codec_from_filename(filename):
+	"""Get the codec for a backup file from its extension, or None if it isn't a supported backup file"""
+	return _split_extension(filename)[1]
+
+def format_from_filename(filename):
+	"""Get the backup format (json or ndjson) from a backup file's extension, or None if it isn't a supported backup file"""
+	return _split_extension(filename)[0]
@@ -0,0 +1,101 @@
+# kv_credentials.py
+# Remote Splunk credentials (credentialN settings) for KV Store Tools
+# splunk.secret is read once per process, only the credential that is needed
+# is decrypted, and decrypted passwords are cached for the life of the process.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import os
+import sys
+import base64
+import hashlib
+import threading
+
+# Add lib folders to import path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
+
+_cache_lock = threading.Lock()
+_splunk_secrets = {}
+_passwords = {}
+_aesgcm = []
+
+def native_aes_gcm():
+	"""Get the AESGCM class from the cryptography package (bundled with Splunk's Python),
+	or None if it is not installed. It is much faster than the pure-Python implementation
+	in splunksecrets. Imported on first use, since most searches never decrypt anything."""
+	if len(_aesgcm) == 0:
+		try:
+			from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+		except ImportError:
+			AESGCM = None
+		_aesgcm.append(AESGCM)
+	return _aesgcm[0]
+
+def read_splunk_secret(filename=None):
+	"""Read the splunk.secret file (once per process)"""
+	if filename is None:
+		filename = os.path.join(os.getenv('SPLUNK_HOME'), 'etc', 'auth', 'splunk.secret')
+	with _cache_lock:
+		if filename not in _splunk_secrets:
+			with open(filename, 'r') as ssfh:
+				_splunk_secrets[filename] = ssfh.readline()
+		return _splunk_secrets[filename]
+
+def _b64decode(encoded):
+	# Add padding if necessary
+	return base64.b64decode(encoded + '=' * (-len(encoded) % 4))
+
+def decrypt_aes_gcm(splunk_secret, ciphertext):
+	"""Decrypt a $7$ (AES-256-GCM) Splunk password with the cryptography package"""
+	if isinstance(splunk_secret, str):
+		splunk_secret = splunk_secret.encode()
+	if len(splunk_secret) < 254:
+		raise ValueError("secret too short, need 254 bytes, got %d" % len(splunk_secret))
+	data = _b64decode(ciphertext[3:])
+	iv = data[:16]
+	# cryptography expects the tag at the end of the ciphertext, as Splunk stores it
+	key = hashlib.pbkdf2_hmac('sha256', splunk_secret[:254], b'disk-encryption', 1, 32)
+	return native_aes_gcm()(key).decrypt(iv, data[16:], None).decode()
+
+def decrypt_password(splunk_secret, ciphertext, native=True):
+	"""Decrypt a Splunk-encrypted password. Results are cached for the life of the process.
+	$7$ passwords use native AES-GCM when the cryptography package is available,
+	otherwise the bundled pure-Python splunksecrets implementation."""
+	cache_key = (splunk_secret, ciphertext)
+	with _cache_lock:
+		if cache_key in _passwords:
+			return _passwords[cache_key]
+	if native and ciphertext.startswith('$7$') and native_aes_gcm() is not None:
+		password = decrypt_aes_gcm(splunk_secret, ciphertext)
+	else:
+		# https://github.com/HurricaneLabs/splunksecrets/blob/master/splunksecrets.py
+		from splunksecrets import decrypt
+		password = decrypt(splunk_secret, ciphertext)
+	with _cache_lock:
+		_passwords[cache_key] = password
+	return password
+
+def clear_cache():
+	with _cache_lock:
+		_splunk_secrets.clear()
+		_passwords.clear()
+
+def list_credentials(config):
+	"""Get the (username, encrypted password) for each host from the credentialN settings, without decrypting them"""
+	credentials = {}
+	for option in config:
+		if option[0:10] == 'credential':
+			try:
+				hostname, username, password = config.get(option).split(':')
+				credentials[hostname] = (username, password)
+			except:
+				# Blank or wrong format. Ignore.
+				pass
+	return credentials
+
+def get_credential(config, hostname):
+	"""Get the (username, password) for a host from the credentialN settings, decrypting only that credential.
+	Raises KeyError if there is no credential for the host."""
+	username, encrypted_password = list_credentials(config)[hostname]
+	return username, decrypt_password(read_splunk_secret(), encrypted_password)
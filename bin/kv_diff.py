@@ -0,0 +1,239 @@
+# kv_diff.py
+# Compare two versions of a KV Store collection (local, remote or a backup) in constant memory
+# Both sides are read in _key order and merge joined, comparing a hash of each record.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import json
+import time
+import queue
+import hashlib
+import threading
+import urllib.parse
+from deductiv_helpers import request
+from kv_compression import codec_from_filename, format_from_filename, load_block_index
+import kv_common as kv
+from splunk.clilib import cli_common as cli
+
+CHANGE_TYPES = ['added', 'removed', 'changed']
+
+class unsorted_error(Exception):
+	"""A source that should be in _key order is not"""
+	pass
+
+def record_hash(record, ignore=None):
+	"""Hash of a record's contents, independent of the order of its fields"""
+	if ignore:
+		record = dict([(k, v) for k, v in record.items() if k not in ignore])
+	data = json.dumps(record, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+	return hashlib.blake2b(data.encode('utf-8'), digest_size=16).digest()
+
+def _key_fields(fields):
+	"""Make sure a field list (projection) returns the _key"""
+	if not fields:
+		return None
+	field_list = [f.strip() for f in fields.split(',') if f.strip()]
+	# Exclusions (field:0) return every other field
+	if '_key' not in field_list and not any([f.endswith(':0') for f in field_list]):
+		field_list.insert(0, '_key')
+	return ','.join(field_list)
+
+def collection_records(logger, uri, session_key, app, collection, query=None, fields=None):
+	"""Yield the records of a collection in _key order. Each page starts after the last _key of the previous
+	page (instead of skipping records), so every request is an index seek and no records are missed or
+	repeated if the collection changes while it is read."""
+	headers = {
+		'Authorization': 'Splunk %s' % session_key,
+		'Content-Type': 'application/json'
+	}
+	cfg = cli.getConfStanza('kvstore_tools','settings')
+	limits_cfg = kv.get_kvstore_limits(logger, uri, session_key)
+	maxrows = int(limits_cfg.get('max_rows_per_query'))
+	max_result_bytes = int(limits_cfg.get('max_size_per_result_mb', 0)) * 1024 * 1024
+	batch = kv.get_batch_controller(cfg, maxrows, max_result_bytes)
+	url_tmpl = '%(server_uri)s/servicesNS/nobody/%(app)s/storage/collections/data/%(collection)s?limit=%(limit)d&output_mode=json%(filter)s'
+	fields = _key_fields(fields)
+	query = json.loads(query) if query else None
+
+	last_key = None
+	while True:
+		limit = batch.size
+		page_query = query
+		if last_key is not None:
+			key_range = {'_key': {'$gt': last_key}}
+			page_query = {'$and': [query, key_range]} if query else key_range
+		url = url_tmpl % dict(
+			server_uri = uri,
+			app = urllib.parse.quote(app),
+			collection = urllib.parse.quote(collection),
+			limit = limit,
+			filter = kv.get_data_filter(json.dumps(page_query) if page_query else None, fields, '_key'))
+		request_start_time = time.time()
+		response, response_code = request('GET', url, '', headers, retry=kv.get_retry_policy())
+		if response_code != 200:
+			raise Exception("Error %d when reading collection %s/%s" % (response_code, app, collection))
+		records = json.loads(response)
+		if len(records) > 0:
+			batch.update(len(records), len(response), time.time() - request_start_time)
+		for record in records:
+			yield record
+		if len(records) < limit:
+			break
+		last_key = records[-1]['_key']
+
+def backup_is_sorted(file_paths):
+	"""Whether backup files (the shards of a backup, in order) are in _key order, according to their
+	block indexes. Indexed backups taken with another sort order are not."""
+	last_key = None
+	for file_path in file_paths:
+		index = load_block_index(file_path)
+		if index is None or not index.get('sorted'):
+			return False
+		blocks = [b for b in index['blocks'] if b['records'] > 0]
+		if len(blocks) > 0:
+			if last_key is not None and blocks[0]['min_key'] <= last_key:
+				return False
+			last_key = blocks[-1]['max_key']
+	return True
+
+def _backup_lines(fh, chunk_size=1048576):
+	remainder = b''
+	chunk = fh.read(chunk_size)
+	while chunk:
+		lines = (remainder + chunk).split(b'\n')
+		remainder = lines.pop()
+		for line in lines:
+			record = kv.parse_backup_line(line)
+			if record is not None:
+				yield record
+		chunk = fh.read(chunk_size)
+	record = kv.parse_backup_line(remainder)
+	if record is not None:
+		yield record
+
+def backup_file_records(logger, file_paths):
+	"""Yield the records of a backup (a list of files, for sharded backups) one line at a time.
+	JSON backups written by older versions without one record per line are read whole."""
+	for file_path in file_paths:
+		codec = codec_from_filename(file_path)
+		if codec is None:
+			raise ValueError("Unsupported backup file extension: %s" % file_path)
+		read = False
+		try:
+			with codec.open_reader(file_path) as fh:
+				for record in _backup_lines(fh):
+					read = True
+					yield record
+		except ValueError:
+			if read or format_from_filename(file_path) == 'ndjson':
+				raise
+			logger.debug('%s does not have one record per line. Reading the whole file.' % file_path)
+			records = kv.read_json_backup(logger, file_path, codec)
+			if records is None:
+				raise ValueError("Unable to read file: %s" % file_path)
+			for record in records:
+				yield record
+
+def hashed_records(records, ignore=None, keep_records=False):
+	"""Yield (key, hash, record) for each record. The record is only kept if keep_records is set."""
+	for record in records:
+		yield (str(record.get('_key')), record_hash(record, ignore), record if keep_records else None)
+
+def check_order(items, name):
+	"""Pass (key, hash, record) items through, raising unsorted_error if they are not in _key order"""
+	last_key = None
+	for item in items:
+		if last_key is not None and item[0] <= last_key:
+			raise unsorted_error('%s is not in _key order (%s after %s)' % (name, item[0], last_key))
+		last_key = item[0]
+		yield item
+
+def sort_items(items):
+	"""Sort (key, hash, record) items in memory, for sources that aren't in _key order.
+	Without the records, this only holds the _key and a 16-byte hash per record."""
+	return iter(sorted(items, key=lambda item: item[0]))
+
+def prefetch(items, batch_size=1000, depth=8):
+	"""Read items in a background thread, so the requests (or decompression) of the two sides of
+	a diff run at the same time. At most depth batches of batch_size items are buffered."""
+	buffer = queue.Queue(depth)
+	stop = threading.Event()
+	done = object()
+
+	def put(value):
+		while not stop.is_set():
+			try:
+				buffer.put(value, timeout=0.5)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def read():
+		try:
+			batch = []
+			for item in items:
+				batch.append(item)
+				if len(batch) == batch_size:
+					if not put(batch):
+						return
+					batch = []
+			if len(batch) > 0:
+				put(batch)
+			put(done)
+		except BaseException as e:
+			put(e)
+
+	thread = threading.Thread(target=read, daemon=True)
+	thread.start()
+	try:
+		while True:
+			batch = buffer.get()
+			if batch is done:
+				return
+			if isinstance(batch, BaseException):
+				raise batch
+			for item in batch:
+				yield item
+	finally:
+		stop.set()
+
+def changed_fields(before, after, ignore=None):
+	"""The names of the fields that differ between two versions of a record"""
+	names = set(before.keys()) | set(after.keys())
+	return sorted([n for n in names if (not ignore or n not in ignore) and before.get(n) != after.get(n)])
+
+def diff_items(base, other, counts=None):
+	"""Merge join two streams of (key, hash, record) items in _key order.
+	Yields (change, key, base record, other record) for each key that was added (only in other),
+	removed (only in base) or changed. counts, if given, is filled with the number of records of
+	each side and the number of each kind of change, including unchanged records."""
+	if counts is None:
+		counts = {}
+	for name in ['base_records', 'source_records', 'unchanged'] + CHANGE_TYPES:
+		counts[name] = 0
+	end = (None, None, None)
+	b = next(base, end)
+	o = next(other, end)
+	while b is not end or o is not end:
+		if o is end or (b is not end and b[0] < o[0]):
+			counts['base_records'] += 1
+			counts['removed'] += 1
+			yield ('removed', b[0], b[2], None)
+			b = next(base, end)
+		elif b is end or o[0] < b[0]:
+			counts['source_records'] += 1
+			counts['added'] += 1
+			yield ('added', o[0], None, o[2])
+			o = next(other, end)
+		else:
+			counts['base_records'] += 1
+			counts['source_records'] += 1
+			if b[1] != o[1]:
+				counts['changed'] += 1
+				yield ('changed', b[0], b[2], o[2])
+			else:
+				counts['unchanged'] += 1
+			b = next(base, end)
+			o = next(other, end)
@@ -0,0 +1,333 @@
+# kv_merkle.py
+# Merkle trees of KV Store collections, for checking copies of a collection on other hosts
+# without transferring the records. Records are grouped into buckets (leaves) by _key range.
+# Each leaf holds the number of records and an order-independent sum of their hashes, and
+# each node above the leaves hashes its two children. Two copies with the same buckets are
+# compared by their roots, then only the _key ranges of the leaves that differ are read.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import os
+import json
+import time
+import bisect
+import hashlib
+import urllib.parse
+from deductiv_helpers import request
+import kv_common as kv
+import kv_diff
+import kv_stats
+from splunk.clilib import cli_common as cli
+
+MERKLE_DIRNAME = 'merkle'
+DEFAULT_LEAVES = 256
+HASH_MODULUS = 2 ** 128
+# App that provides the kvstoremerkle command on remote hosts
+APP_NAME = 'kvstore_tools'
+# New buckets are chosen when the largest leaf has this many times the average number of records
+MAX_LEAF_SKEW = 4
+
+class merkle_tree:
+	"""A Merkle tree of a collection. boundaries holds the first _key of every leaf after the first,
+	and each leaf is [records, sum of record hashes]. Records can be added in any order."""
+	def __init__(self, app, collection, boundaries, leaves=None, created=None):
+		self.app = app
+		self.collection = collection
+		self.boundaries = list(boundaries)
+		self.leaves = leaves or [[0, 0] for _ in range(len(self.boundaries) + 1)]
+		self.created = created if created is not None else time.time()
+		self._levels = None
+
+	def add(self, key, digest):
+		leaf = self.leaves[bisect.bisect_right(self.boundaries, key)]
+		leaf[0] += 1
+		leaf[1] = (leaf[1] + int.from_bytes(digest, 'big')) % HASH_MODULUS
+		self._levels = None
+
+	def add_records(self, records):
+		for record in records:
+			self.add(str(record.get('_key')), kv_diff.record_hash(record))
+
+	@property
+	def records(self):
+		return sum([leaf[0] for leaf in self.leaves])
+
+	def boundaries_id(self):
+		"""Identifies the buckets. Only trees with the same buckets can be compared."""
+		return hashlib.sha256(json.dumps(self.boundaries).encode('utf-8')).hexdigest()[0:16]
+
+	def leaf_hash(self, leaf):
+		return hashlib.blake2b(('%d:%032x' % tuple(self.leaves[leaf])).encode('utf-8'), digest_size=16).hexdigest()
+
+	def levels(self):
+		"""The node hashes of each level of the tree, from the leaves up to the root"""
+		if self._levels is None:
+			level = [self.leaf_hash(i) for i in range(len(self.leaves))]
+			levels = [level]
+			while len(level) > 1:
+				level = [hashlib.blake2b(''.join(level[i:i + 2]).encode('utf-8'), digest_size=16).hexdigest() for i in range(0, len(level), 2)]
+				levels.append(level)
+			self._levels = levels
+		return self._levels
+
+	def root(self):
+		return self.levels()[-1][0]
+
+	def is_skewed(self):
+		"""Whether the records have grown unevenly enough across the buckets to choose new ones"""
+		average = float(self.records) / len(self.leaves)
+		return self.records >= 2 * len(self.leaves) and max([leaf[0] for leaf in self.leaves]) > MAX_LEAF_SKEW * average
+
+	def diff(self, other):
+		"""Get the leaves whose hashes differ, descending from the root only into the nodes that differ"""
+		if self.boundaries != other.boundaries:
+			raise ValueError("Trees with different buckets can't be compared")
+		mine = self.levels()
+		theirs = other.levels()
+		nodes = [0]
+		for depth in range(len(mine) - 1, -1, -1):
+			nodes = [n for n in nodes if mine[depth][n] != theirs[depth][n]]
+			if depth > 0:
+				nodes = [c for n in nodes for c in (2 * n, 2 * n + 1) if c < len(mine[depth - 1])]
+		return nodes
+
+	def ranges(self, leaves):
+		"""Merge leaves into [start, end) _key ranges, with None for an open end"""
+		ranges = []
+		last = None
+		for leaf in sorted(leaves):
+			start = self.boundaries[leaf - 1] if leaf > 0 else None
+			end = self.boundaries[leaf] if leaf < len(self.boundaries) else None
+			if last is not None and leaf == last + 1:
+				ranges[-1] = (ranges[-1][0], end)
+			else:
+				ranges.append((start, end))
+			last = leaf
+		return ranges
+
+	def leaf_rows(self):
+		"""The leaves as result rows, for kvstoremerkle"""
+		return [{'leaf': i, 'start': self.boundaries[i - 1] if i > 0 else '', 'records': leaf[0], 'hash': '%032x' % leaf[1]}
+			for i, leaf in enumerate(self.leaves)]
+
+	def root_row(self):
+		return {'_time': self.created, 'app': self.app, 'collection': self.collection, 'root': self.root(),
+			'boundaries_id': self.boundaries_id(), 'leaves': len(self.leaves), 'records': self.records}
+
+	@classmethod
+	def from_leaf_rows(cls, app, collection, rows):
+		rows = sorted(rows, key=lambda r: int(r['leaf']))
+		return cls(app, collection, [r['start'] for r in rows[1:]], [[int(r['records']), int(r['hash'], 16)] for r in rows])
+
+	def to_dict(self):
+		return {'app': self.app, 'collection': self.collection, 'created': self.created,
+			'boundaries': self.boundaries, 'leaves': self.leaves}
+
+	@classmethod
+	def from_dict(cls, data):
+		return cls(data['app'], data['collection'], data['boundaries'], data['leaves'], data['created'])
+
+def range_query(start, end):
+	"""KV store query (JSON) for the records in a [start, end) _key range"""
+	conditions = []
+	if start is not None:
+		conditions.append({'_key': {'$gte': start}})
+	if end is not None:
+		conditions.append({'_key': {'$lt': end}})
+	if len(conditions) == 0:
+		return None
+	return json.dumps(conditions[0] if len(conditions) == 1 else {'$and': conditions})
+
+def key_boundaries(logger, uri, session_key, app, collection, leaves=DEFAULT_LEAVES):
+	"""Split a collection into about `leaves` _key ranges with the same number of records:
+	the _key at every count/leaves-th position in _key order (one single-record request each)"""
+	count = kv_stats.count_records(logger, uri, session_key, app, collection)[0]
+	leaves = max(1, min(leaves, count))
+	boundaries = []
+	for i in range(1, leaves):
+		records = kv_stats.get_records(uri, session_key, app, collection, 1, i * count // leaves, '_key', '_key')
+		if len(records) > 0 and (len(boundaries) == 0 or records[0]['_key'] > boundaries[-1]):
+			boundaries.append(records[0]['_key'])
+	logger.debug('Split %s/%s (%d records) into %d buckets' % (app, collection, count, len(boundaries) + 1))
+	return boundaries
+
+def tree_path(backup_dir, app, collection):
+	return os.path.join(backup_dir, MERKLE_DIRNAME, '%s#%s.json' % (app, collection))
+
+def load_tree(backup_dir, app, collection):
+	"""The last tree saved for a collection, or None"""
+	try:
+		with open(tree_path(backup_dir, app, collection), 'r') as f:
+			return merkle_tree.from_dict(json.load(f))
+	except (IOError, OSError, ValueError, KeyError):
+		return None
+
+def save_tree(backup_dir, tree):
+	filename = tree_path(backup_dir, tree.app, tree.collection)
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	temp_path = '%s.%d.tmp' % (filename, os.getpid())
+	with open(temp_path, 'w') as f:
+		json.dump(tree.to_dict(), f)
+	os.replace(temp_path, filename)
+
+def expire_tree(backup_dir, app, collection):
+	"""Mark the saved tree of a collection as out of date, so it is rebuilt the next time it's needed.
+	Its buckets are kept. Returns False if there is no saved tree."""
+	tree = load_tree(backup_dir, app, collection)
+	if tree is None:
+		return False
+	tree.created = 0
+	save_tree(backup_dir, tree)
+	return True
+
+def new_tree(logger, uri, session_key, app, collection, backup_dir, leaves=DEFAULT_LEAVES):
+	"""An empty tree with the buckets of the saved tree, so trees stay comparable over time and with other
+	hosts. New buckets are chosen if there is no saved tree, its records are spread too unevenly, or the
+	collection has grown to several times as many records as the saved tree has leaves."""
+	cached = load_tree(backup_dir, app, collection)
+	if cached is not None and not cached.is_skewed() and len(cached.leaves) * 2 >= min(leaves, cached.records):
+		return merkle_tree(app, collection, cached.boundaries)
+	return merkle_tree(app, collection, key_boundaries(logger, uri, session_key, app, collection, leaves))
+
+def download_tree(logger, uri, session_key, app, collection, backup_dir, leaves=DEFAULT_LEAVES):
+	"""An empty tree to add the records of a backup or copy to as they are downloaded, or None if the
+	buckets can't be found"""
+	try:
+		return new_tree(logger, uri, session_key, app, collection, backup_dir, leaves)
+	except BaseException as e:
+		logger.warning('Could not get the buckets of the tree of %s/%s: %s' % (app, collection, repr(e)))
+		return None
+
+def get_tree(logger, uri, session_key, app, collection, backup_dir, max_age=0, boundaries=None, leaves=DEFAULT_LEAVES):
+	"""The tree of a live collection: the saved tree if it was built in the last max_age seconds (with the
+	requested boundaries), or else a new tree built from the collection, which is then saved."""
+	cached = load_tree(backup_dir, app, collection)
+	if cached is not None and max_age > 0 and time.time() - cached.created <= max_age and \
+		(boundaries is None or cached.boundaries == list(boundaries)):
+		logger.debug('Using the saved tree of %s/%s' % (app, collection))
+		return cached
+	if boundaries is not None:
+		tree = merkle_tree(app, collection, boundaries)
+	else:
+		tree = new_tree(logger, uri, session_key, app, collection, backup_dir, leaves)
+	tree.add_records(kv_diff.collection_records(logger, uri, session_key, app, collection))
+	try:
+		save_tree(backup_dir, tree)
+	except BaseException as e:
+		logger.warning('Could not save the tree of %s/%s: %s' % (app, collection, repr(e)))
+	return tree
+
+def remote_search(logger, uri, session_key, search):
+	"""Run a oneshot search on a remote host and get the results"""
+	url = '%s/servicesNS/nobody/%s/search/jobs' % (uri, APP_NAME)
+	data = {'search': search, 'exec_mode': 'oneshot', 'output_mode': 'json', 'count': 0}
+	headers = {'Authorization': 'Splunk %s' % session_key}
+	logger.debug('Running search on %s: %s' % (kv.hostname_from_uri(uri), search))
+	response, response_code = request('POST', url, data, headers, retry=kv.get_retry_policy())
+	if response_code != 200:
+		raise Exception("Error %d when running search on %s: %s" % (response_code, kv.hostname_from_uri(uri), response[0:500]))
+	return json.loads(response).get('results', [])
+
+def remote_tree(logger, uri, session_key, app, collection, max_age=0):
+	"""Get the tree of a collection on a remote host with the kvstoremerkle command, so the remote host reads
+	its own collection. Only the leaves (one row per _key range) cross the network."""
+	search = '| kvstoremerkle app="%s" collection="%s" output=leaves max_age=%d' % (
+		app.replace('"', '\\"'), collection.replace('"', '\\"'), max_age)
+	rows = remote_search(logger, uri, session_key, search)
+	if len(rows) == 0:
+		raise Exception("No tree returned for %s/%s by %s" % (app, collection, kv.hostname_from_uri(uri)))
+	return merkle_tree.from_leaf_rows(app, collection, rows)
+
+def expire_remote_tree(logger, uri, session_key, app, collection):
+	"""Mark the saved tree of a collection on a remote host as out of date with the kvstoremerkle command"""
+	search = '| kvstoremerkle app="%s" collection="%s" expire=true' % (
+		app.replace('"', '\\"'), collection.replace('"', '\\"'))
+	remote_search(logger, uri, session_key, search)
+
+def compare(logger, local_uri, local_session_key, remote_uri, remote_session_key, app, collection, backup_dir, max_age=0):
+	"""Compare a local collection with a copy on a remote host. Each host reads its collection at most once
+	(not at all if its saved tree is recent enough): the local tree is built with the buckets of the remote
+	tree, whose root is computed locally from its leaves.
+	Returns (local tree, remote tree, [start, end) _key ranges that differ)."""
+	remote = remote_tree(logger, remote_uri, remote_session_key, app, collection, max_age)
+	local = get_tree(logger, local_uri, local_session_key, app, collection, backup_dir, max_age, remote.boundaries)
+	if local.root() == remote.root():
+		logger.debug('%s/%s matches on %s' % (app, collection, kv.hostname_from_uri(remote_uri)))
+		return local, remote, []
+	leaves = local.diff(remote)
+	logger.debug('%d of %d buckets of %s/%s differ on %s' % (len(leaves), len(local.leaves), app, collection, kv.hostname_from_uri(remote_uri)))
+	return local, remote, local.ranges(leaves)
+
+def range_records(logger, uri, session_key, app, collection, ranges):
+	"""Yield the records in each [start, end) _key range of a collection, in _key order"""
+	for start, end in ranges:
+		for record in kv_diff.collection_records(logger, uri, session_key, app, collection, range_query(start, end)):
+			yield record
+
+def delete_range(logger, uri, session_key, app, collection, start, end):
+	"""Delete the records in a [start, end) _key range"""
+	query = range_query(start, end)
+	url = '%s/servicesNS/nobody/%s/storage/collections/data/%s?output_mode=json%s' % (
+		uri, urllib.parse.quote(app), urllib.parse.quote(collection), '&query=' + urllib.parse.quote(query) if query else '')
+	headers = {
+		'Authorization': 'Splunk %s' % session_key,
+		'Content-Type': 'application/json'
+	}
+	response, response_code = request('DELETE', url, '', headers, retry=kv.get_retry_policy())
+	if response_code != 200:
+		raise Exception("Error %d when deleting records from %s/%s" % (response_code, app, collection))
+
+def sync_ranges(logger, source_uri, source_session_key, target_uri, target_session_key, app, collection, ranges, metrics=None):
+	"""Replace the records in each _key range of the target collection with the records from the source.
+	Returns the number of records copied."""
+	copied = 0
+	for start, end in ranges:
+		logger.debug('Copying the %s/%s records from %s to %s' % (app, collection, start, end))
+		if metrics is not None:
+			with metrics.phase('delete'):
+				delete_range(logger, target_uri, target_session_key, app, collection, start, end)
+		else:
+			delete_range(logger, target_uri, target_session_key, app, collection, start, end)
+		records = kv_diff.collection_records(logger, source_uri, source_session_key, app, collection, range_query(start, end))
+		result, message, posted = kv.save_records(logger, target_uri, target_session_key, app, collection, records, metrics)
+		if result != 'success':
+			raise Exception(message)
+		copied += posted
+	return copied
+
+def sync_collection(logger, local_session_key, local_uri, remote_session_key, remote_uri, app, collection, push, backup_dir, max_age=0):
+	"""Make the remote (push) or local (pull) copy of a collection match the other by copying only the _key
+	ranges whose hashes differ. Returns a result row like copy_collection."""
+	import kv_metrics
+	cfg = cli.getConfStanza('kvstore_tools','settings')
+	source_uri, source_session_key = (local_uri, local_session_key) if push else (remote_uri, remote_session_key)
+	target_uri, target_session_key = (remote_uri, remote_session_key) if push else (local_uri, local_session_key)
+	metrics = kv_metrics.operation_metrics('sync_collection', kv.get_retry_policy(), app=app, collection=collection,
+		source=kv.hostname_from_uri(source_uri), target=kv.hostname_from_uri(target_uri))
+	with metrics.phase('compare'):
+		local, remote, ranges = compare(logger, local_uri, local_session_key, remote_uri, remote_session_key, app, collection, backup_dir, max_age)
+	copied = 0
+	if len(ranges) > 0:
+		with metrics.phase('copy'):
+			copied = sync_ranges(logger, source_uri, source_session_key, target_uri, target_session_key, app, collection, ranges, metrics)
+		if not push:
+			# The local collection now matches the remote tree
+			try:
+				save_tree(backup_dir, remote)
+			except BaseException as e:
+				logger.warning('Could not save the tree of %s/%s: %s' % (app, collection, repr(e)))
+		else:
+			# The remote tree no longer matches the remote collection. Expire it so the next comparison
+			# doesn't use it.
+			try:
+				expire_remote_tree(logger, remote_uri, remote_session_key, app, collection)
+			except BaseException as e:
+				logger.warning('Could not expire the tree of %s/%s on %s: %s' % (app, collection, kv.hostname_from_uri(remote_uri), repr(e)))
+	result = 'success' if len(ranges) > 0 else 'unchanged'
+	logger.info('Synchronized %s/%s: %d _key ranges differed, %d records copied' % (app, collection, len(ranges), copied))
+	metrics.count('records', copied)
+	row = {'app': app, 'collection': collection, 'result': result, 'ranges': len(ranges), 'leaves': len(local.leaves), 'upload_count': copied}
+	row.update(metrics.fields())
+	kv_metrics.log_metrics(logger, cfg, metrics, result=result, ranges=len(ranges), upload_count=copied)
+	return row
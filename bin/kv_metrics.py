@@ -0,0 +1,119 @@
+# kv_metrics.py
+# Timers and counters for KV Store operations, reported as numeric fields in the
+# command output and as JSON lines in kvstore_tools_metrics.log
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import os
+import sys
+import json
+import time
+import threading
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from deductiv_helpers import http_stats, str2bool
+
+METRICS_LOG = 'kvstore_tools_metrics.log'
+
+class operation_metrics:
+	"""Timers and counters for one operation on one collection (a backup, restore or copy).
+
+	Phases are timed with phase(). The HTTP request, byte and retry counts are the
+	change in the process-wide counters since the object was created, so operations
+	must not overlap within a process (work inside one operation can be parallel).
+	"""
+	def __init__(self, operation, retry=None, **dimensions):
+		self.operation = operation
+		self.dimensions = dimensions
+		self.retry = retry
+		self.phases = {}
+		self.counters = {}
+		self.start_time = time.time()
+		self.end_time = None
+		self._lock = threading.Lock()
+		self._http_start = http_stats.snapshot()
+		self._retries_start = retry.retries if retry is not None else 0
+
+	@contextmanager
+	def phase(self, name):
+		"""Time a phase of the operation. Repeated phases (and phases running in
+		parallel threads) are added together."""
+		start = time.time()
+		try:
+			yield self
+		finally:
+			with self._lock:
+				self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+	def count(self, name, value=1):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def stop(self):
+		if self.end_time is None:
+			self.end_time = time.time()
+		return self
+
+	def fields(self):
+		"""Numeric fields for the result row: seconds per phase, throughput, requests and retries"""
+		self.stop()
+		seconds = self.end_time - self.start_time
+		http = http_stats.since(self._http_start)
+		# Requests made without request() (e.g. with splunklib) are counted as http_* counters by the caller
+		for name in http:
+			http[name] += self.counters.get('http_' + name, 0)
+		records = self.counters.get('records', 0)
+		data_bytes = self.counters.get('bytes', http['bytes_sent'] + http['bytes_received'])
+		fields = {'seconds': round(seconds, 3)}
+		for name, phase_seconds in self.phases.items():
+			fields[name + '_seconds'] = round(phase_seconds, 3)
+		fields.update(dict([(name, value) for name, value in self.counters.items() if not name.startswith('http_')]))
+		fields.update({
+			'records': records,
+			'bytes': data_bytes,
+			'records_per_sec': round(records / seconds, 1) if seconds > 0 else 0,
+			'bytes_per_sec': round(data_bytes / seconds, 1) if seconds > 0 else 0,
+			'http_requests': http['requests'],
+			'http_errors': http['errors'],
+			'http_seconds': round(http['seconds'], 3),
+			'http_bytes_sent': http['bytes_sent'],
+			'http_bytes_received': http['bytes_received'],
+			'retries': (self.retry.retries - self._retries_start) if self.retry is not None else 0
+		})
+		return fields
+
+	def event(self):
+		"""The metrics log event for the operation"""
+		event = {'time': round(self.start_time, 3), 'command': os.path.splitext(os.path.basename(sys.argv[0]))[0], 'operation': self.operation}
+		event.update(self.dimensions)
+		event.update(self.fields())
+		return event
+
+# Metrics logger, created on first use
+_metrics_logger = []
+
+def get_metrics_logger():
+	if len(_metrics_logger) == 0:
+		logger = logging.getLogger('kvstore_tools_metrics')
+		logger.propagate = False
+		logger.setLevel(logging.INFO)
+		log_file = os.path.join(os.environ['SPLUNK_HOME'], 'var', 'log', 'splunk', METRICS_LOG)
+		file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=25000000, backupCount=2)
+		file_handler.setFormatter(logging.Formatter('%(message)s'))
+		logger.addHandler(file_handler)
+		_metrics_logger.append(logger)
+	return _metrics_logger[0]
+
+def log_metrics(logger, cfg, metrics, **fields):
+	"""Write the metrics for an operation to the metrics log as a JSON line, if enabled.
+	fields are added to the event (e.g. the result)."""
+	if not str2bool(cfg.get('metrics_log', True)):
+		return
+	try:
+		event = metrics.event()
+		event.update(fields)
+		get_metrics_logger().info(json.dumps(event, sort_keys=True))
+	except BaseException as e:
+		logger.warning('Could not write to the metrics log: %s' % repr(e))
@@ -0,0 +1,125 @@
+# kv_profile.py
+# Opt-in profiling of the search commands and the alert action with cProfile and tracemalloc
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import os
+import sys
+import time
+import threading
+from deductiv_helpers import str2bool
+from splunk.clilib import cli_common as cli
+
+# Folder for the profiles of processes without a dispatch directory (e.g. the alert action)
+PROFILE_DIR = 'kvstore_tools_profile'
+
+class command_profiler:
+	"""Profiles this process with cProfile (and tracemalloc, if memory is set) from start() until stop().
+
+	stop() writes <name>.pstats, which can be read with python -m pstats, snakeviz, etc.,
+	<name>.txt with the slowest functions by cumulative time, and <name>_memory.txt
+	with the peak traced memory and the lines that allocated the most memory.
+	"""
+	def __init__(self, name, output_dir, memory=False, limit=30):
+		self.name = name
+		self.output_dir = output_dir
+		self.memory = memory
+		self.limit = limit
+		self.profiler = None
+		self.thread_profilers = []
+		self.start_time = None
+		self._lock = threading.Lock()
+
+	def _profile_thread(self, frame, event, arg):
+		# Runs at the start of each new thread. Replaces itself with a profiler for the thread.
+		import cProfile
+		profiler = cProfile.Profile()
+		with self._lock:
+			self.thread_profilers.append(profiler)
+		profiler.enable()
+
+	def start(self):
+		import cProfile
+		if self.memory:
+			import tracemalloc
+			tracemalloc.start()
+		if sys.version_info < (3, 12):
+			# Before Python 3.12, cProfile only sees the thread that enabled it
+			threading.setprofile(self._profile_thread)
+		self.start_time = time.time()
+		self.profiler = cProfile.Profile()
+		self.profiler.enable()
+		return self
+
+	def stop(self):
+		"""Stop profiling and write the results. Returns the files written."""
+		if self.profiler is None:
+			return []
+		import pstats
+		self.profiler.disable()
+		threading.setprofile(None)
+		seconds = time.time() - self.start_time
+		os.makedirs(self.output_dir, exist_ok=True)
+		base = os.path.join(self.output_dir, self.name)
+		files = [base + '.pstats', base + '.txt']
+
+		if self.memory:
+			# Before the profile statistics are built, so they are not counted
+			import tracemalloc
+			snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+			current, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			files.append(base + '_memory.txt')
+			with open(files[2], 'w') as f:
+				f.write('Memory allocations of %s\nCurrent: %d bytes\nPeak: %d bytes\n\nTop %d allocation sites:\n' % (self.name, current, peak, self.limit))
+				for stat in snapshot.statistics('lineno')[0:self.limit]:
+					f.write('%s\n' % stat)
+
+		stats = pstats.Stats(self.profiler)
+		with self._lock:
+			for profiler in self.thread_profilers:
+				stats.add(profiler)
+		stats.dump_stats(files[0])
+		with open(files[1], 'w') as f:
+			f.write('Profile of %s (%.3f seconds, %d threads)\n\n' % (self.name, seconds, len(self.thread_profilers) + 1))
+			stats.stream = f
+			stats.sort_stats('cumulative').print_stats(self.limit)
+			stats.sort_stats('tottime').print_stats(self.limit)
+
+		self.profiler = None
+		return files
+
+def default_output_dir():
+	return os.path.join(os.environ['SPLUNK_HOME'], 'var', 'log', 'splunk', PROFILE_DIR)
+
+def start_profiler(name, output_dir=None, cfg=None, enabled=None):
+	"""Start profiling if it is enabled by the caller's profile option, or else by the profile setting.
+	Returns the running profiler, or None. Without a dispatch directory (output_dir), the profile
+	is written to $SPLUNK_HOME/var/log/splunk/kvstore_tools_profile with a unique name."""
+	if enabled is not None and enabled != '' and not str2bool(enabled):
+		# Profiling was turned off by the caller. Don't read the configuration.
+		return None
+	if cfg is None:
+		cfg = cli.getConfStanza('kvstore_tools','settings')
+	if enabled is None or enabled == '':
+		enabled = cfg.get('profile', False)
+	if not str2bool(enabled):
+		return None
+	if output_dir is None:
+		output_dir = default_output_dir()
+		name = '%s_%s_%d' % (name, time.strftime('%Y%m%d_%H%M%S'), os.getpid())
+	return command_profiler(name, output_dir, str2bool(cfg.get('profile_memory', False)), int(cfg.get('profile_limit') or 30)).start()
+
+class profiled_command:
+	"""Search command mixin that runs the command under the profiler when the command's profile
+	option (or the profile setting) is enabled. List it before the splunklib base class."""
+	def _execute(self, ifile, process):
+		# The options are parsed by now, but no records have been read
+		searchinfo = self._metadata.searchinfo
+		profiler = start_profiler(getattr(searchinfo, 'command', None) or self.name, searchinfo.dispatch_dir, enabled=getattr(self, 'profile', None))
+		try:
+			return super(profiled_command, self)._execute(ifile, process)
+		finally:
+			if profiler is not None:
+				profiler.stop()
@@ -0,0 +1,223 @@
+# kv_repository.py
+# Deduplicating backup repository for KV Store collections
+# Records are stored once in content-addressed chunks that are shared between
+# backups. Each backup is a manifest listing its chunks, so the repository grows
+# with the rate of change of the collections rather than with their size.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import os
+import json
+import gzip
+import glob
+import fnmatch
+import hashlib
+import time
+
+REPOSITORY_DIRNAME = 'repository'
+MANIFEST_EXTENSION = '.manifest'
+CHUNK_EXTENSION = '.ndjson.gz'
+
+def repository_path(backup_dir):
+	return os.path.join(backup_dir, REPOSITORY_DIRNAME)
+
+def manifest_path(repo_dir, name):
+	return os.path.join(repo_dir, 'manifests', name + MANIFEST_EXTENSION)
+
+def chunk_path(repo_dir, chunk_id):
+	return os.path.join(repo_dir, 'chunks', chunk_id[0:2], chunk_id + CHUNK_EXTENSION)
+
+def _write_atomic(filename, data):
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	temp_path = '%s.%d.tmp' % (filename, os.getpid())
+	with open(temp_path, 'wb') as f:
+		f.write(data)
+	os.replace(temp_path, filename)
+
+def is_chunk_boundary(key, chunk_records):
+	"""Whether a chunk ends after the record with this _key.
+	Boundaries depend only on the _key (not the position or the contents of the record),
+	so adding, changing or deleting a record only changes the chunk it belongs to."""
+	digest = hashlib.sha1(str(key).encode('utf-8')).digest()
+	return int.from_bytes(digest[0:4], 'big') % chunk_records == 0
+
+class repository_writer:
+	"""Writes a collection backup to the repository. Has the same interface as
+	the backup file writers (write_records, close, discard) for download_collection.
+
+	Records must be written in _key order. They are grouped into chunks of
+	about chunk_records records (at most max_chunk_bytes), and each chunk is stored
+	(gzip compressed NDJSON) under the SHA-256 hash of its contents unless the
+	repository already has it. The manifest is written when the backup is closed.
+	"""
+	def __init__(self, repo_dir, app, collection, timestamp, chunk_records=1000, max_chunk_bytes=16*1024*1024, level=6):
+		self.repo_dir = repo_dir
+		self.app = app
+		self.collection = collection
+		self.timestamp = timestamp
+		self.chunk_records = max(int(chunk_records), 1)
+		self.max_chunk_bytes = max_chunk_bytes
+		self.level = min(max(level, 1), 9)
+		self.sort_by_key = True
+		self.hash = hashlib.sha256()
+		self.lines = []
+		self.buffered = 0
+		self.chunks = []
+		self.records = 0
+		self.bytes = 0
+		self.new_chunks = 0
+		self.new_bytes = 0
+		self.sorted = True
+		self.last_key = None
+		self.filename = manifest_path(repo_dir, '#'.join([app, collection, timestamp]))
+
+	def write_records(self, records):
+		for record in records:
+			key = str(record.get('_key'))
+			if self.last_key is not None and key <= self.last_key:
+				self.sorted = False
+			self.last_key = key
+			line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+			self.lines.append(line)
+			self.buffered += len(line)
+			if is_chunk_boundary(record.get('_key'), self.chunk_records) or self.buffered >= self.max_chunk_bytes:
+				self._store_chunk()
+		self.records += len(records)
+
+	def _store_chunk(self):
+		if len(self.lines) == 0:
+			return
+		data = b''.join(self.lines)
+		self.hash.update(data)
+		chunk_id = hashlib.sha256(data).hexdigest()
+		filename = chunk_path(self.repo_dir, chunk_id)
+		if os.path.isfile(filename):
+			# Mark the chunk as recently used so garbage collection leaves it alone
+			os.utime(filename)
+		else:
+			compressed = gzip.compress(data, self.level)
+			_write_atomic(filename, compressed)
+			self.new_chunks += 1
+			self.new_bytes += len(compressed)
+		self.chunks.append({'id': chunk_id, 'records': len(self.lines), 'bytes': len(data)})
+		self.bytes += len(data)
+		self.lines = []
+		self.buffered = 0
+
+	def close(self):
+		"""Store the last chunk and write the manifest. Returns the backup stats."""
+		self._store_chunk()
+		checksum = 'sha256:%s' % self.hash.hexdigest()
+		manifest = {
+			'version': 1,
+			'app': self.app,
+			'collection': self.collection,
+			'timestamp': self.timestamp,
+			'created': time.time(),
+			'records': self.records,
+			'bytes': self.bytes,
+			'checksum': checksum,
+			'sorted': self.sorted,
+			'chunks': self.chunks
+		}
+		_write_atomic(self.filename, json.dumps(manifest).encode('utf-8'))
+		return [{'file': self.filename, 'records': self.records, 'uncompressed_bytes': self.bytes, 'checksum': checksum,
+			'chunks': len(self.chunks), 'new_chunks': self.new_chunks, 'stored_bytes': self.new_bytes}]
+
+	def discard(self):
+		# Chunks already stored are left for garbage collection
+		self.lines = []
+		self.buffered = 0
+
+def read_manifest(filename):
+	with open(filename, 'r') as f:
+		return json.load(f)
+
+def list_manifests(repo_dir, pattern='*'):
+	"""Get the backups in the repository whose name (app#collection#timestamp) matches a wildcard
+	pattern, oldest first. The entries have the same fields as backup catalog entries."""
+	entries = []
+	for filename in glob.glob(os.path.join(repo_dir, 'manifests', '*' + MANIFEST_EXTENSION)):
+		name = os.path.basename(filename)[:-len(MANIFEST_EXTENSION)]
+		if not fnmatch.fnmatchcase(name, os.path.basename(pattern)):
+			continue
+		try:
+			manifest = read_manifest(filename)
+		except (OSError, ValueError):
+			# Partially written or removed
+			continue
+		entries.append({
+			'file': os.path.basename(filename),
+			'path': filename,
+			'backup': name,
+			'app': manifest['app'],
+			'collection': manifest['collection'],
+			'timestamp': manifest['timestamp'],
+			'mtime': manifest['created'],
+			'bytes': manifest['bytes'],
+			'records': manifest['records'],
+			'checksum': manifest['checksum'],
+			'chunks': len(manifest['chunks'])
+		})
+	return sorted(entries, key=lambda e: e['mtime'])
+
+def read_chunk(repo_dir, chunk_id):
+	"""Read the records of a chunk, checking its hash"""
+	with open(chunk_path(repo_dir, chunk_id), 'rb') as f:
+		data = gzip.decompress(f.read())
+	if hashlib.sha256(data).hexdigest() != chunk_id:
+		raise ValueError("Repository chunk is corrupt: %s" % chunk_id)
+	return [json.loads(line) for line in data.split(b'\n') if len(line) > 0]
+
+def read_manifest_records(repo_dir, manifest):
+	"""Yield the records of a backup, one chunk at a time"""
+	for chunk in manifest['chunks']:
+		for record in read_chunk(repo_dir, chunk['id']):
+			yield record
+
+def delete_manifests(logger, repo_dir, filenames):
+	"""Delete backups (manifests) from the repository. Their chunks are removed by garbage collection."""
+	deleted = []
+	for filename in filenames:
+		try:
+			os.remove(os.path.join(repo_dir, 'manifests', os.path.basename(filename)))
+			deleted.append(filename)
+		except FileNotFoundError:
+			logger.debug("Manifest already deleted: %s" % filename)
+		except BaseException as e:
+			logger.error("Could not delete manifest %s: %s" % (filename, repr(e)))
+	return deleted
+
+def collect_garbage(logger, repo_dir, grace_period=86400):
+	"""Delete the chunks that no manifest references.
+	Chunks used within the grace period (seconds) are kept, since a backup running
+	now may reference them before its manifest is written.
+	Returns the number of chunks and bytes deleted."""
+	referenced = set()
+	for filename in glob.glob(os.path.join(repo_dir, 'manifests', '*' + MANIFEST_EXTENSION)):
+		try:
+			referenced.update([c['id'] for c in read_manifest(filename)['chunks']])
+		except (OSError, ValueError) as e:
+			# Don't delete anything if a manifest can't be read
+			logger.error("Could not read manifest %s. Skipping garbage collection: %s" % (filename, repr(e)))
+			return 0, 0
+
+	cutoff = time.time() - grace_period
+	deleted_chunks = 0
+	deleted_bytes = 0
+	for filename in glob.glob(os.path.join(repo_dir, 'chunks', '*', '*')):
+		name = os.path.basename(filename)
+		if name.endswith(CHUNK_EXTENSION) and name[:-len(CHUNK_EXTENSION)] in referenced:
+			continue
+		try:
+			file_stat = os.stat(filename)
+			if file_stat.st_mtime > cutoff:
+				continue
+			os.remove(filename)
+			deleted_chunks += 1
+			deleted_bytes += file_stat.st_size
+		except FileNotFoundError:
+			pass
+	logger.info("Repository garbage collection deleted %d chunks (%d bytes) from %s" % (deleted_chunks, deleted_bytes, repo_dir))
+	return deleted_chunks, deleted_bytes
@@ -0,0 +1,221 @@
+# kv_stats.py
+# Collection statistics without downloading the collection
+# Counts records with key-only requests and estimates record sizes and field
+# distributions from a sample of the records.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import os
+import json
+import time
+import math
+import random
+import urllib.parse
+from deductiv_helpers import request
+import kv_common as kv
+
+STATS_FILENAME = 'kvstore_tools_stats.json'
+COUNT_METHODS = ['probe', 'keys']
+
+# Distinct values tracked per field in a sample, so wide free-text fields can't use unbounded memory
+MAX_DISTINCT_VALUES = 100000
+
+def get_records(uri, session_key, app, collection, limit, skip, fields=None, sort=None):
+	url = '%(server_uri)s/servicesNS/nobody/%(app)s/storage/collections/data/%(collection)s?limit=%(limit)d&skip=%(skip)d&output_mode=json%(filter)s' % dict(
+		server_uri = uri,
+		app = urllib.parse.quote(app),
+		collection = urllib.parse.quote(collection),
+		limit = limit,
+		skip = skip,
+		filter = kv.get_data_filter(fields=fields, sort=sort))
+	headers = {
+		'Authorization': 'Splunk %s' % session_key,
+		'Content-Type': 'application/json'}
+	response, response_code = request('GET', url, '', headers, retry=kv.get_retry_policy())
+	if response_code != 200:
+		raise Exception("Error %d when reading collection %s/%s" % (response_code, app, collection))
+	return json.loads(response)
+
+def _exists(uri, session_key, app, collection, position):
+	"""Whether the collection has a record at the (0-based) position"""
+	return len(get_records(uri, session_key, app, collection, 1, position, '_key')) > 0
+
+def count_records(logger, uri, session_key, app, collection, method='probe', page_size=None):
+	"""Count the records in a collection without downloading them. Returns (count, requests).
+
+	probe: find the last record position with single-record, _key-only requests, doubling the
+	skip until it passes the end and then bisecting (about 2*log2(count) requests of a few bytes).
+	keys: page through the collection, _key only, page_size records per request (exact even if
+	the collection is changing, but transfers every _key). The page size defaults to the server's
+	max_rows_per_query, since a page can't be larger and a short page ends the count."""
+	if method == 'keys':
+		if page_size is None:
+			page_size = int(kv.get_kvstore_limits(logger, uri, session_key).get('max_rows_per_query'))
+		count = 0
+		requests = 0
+		page = None
+		while page is None or len(page) == page_size:
+			page = get_records(uri, session_key, app, collection, page_size, count, '_key')
+			count += len(page)
+			requests += 1
+		return count, requests
+
+	requests = 1
+	if not _exists(uri, session_key, app, collection, 0):
+		return 0, requests
+	# Gallop: low always exists, high never does
+	low, high = 0, 1
+	while True:
+		requests += 1
+		if not _exists(uri, session_key, app, collection, high):
+			break
+		low, high = high, high * 2
+	while high - low > 1:
+		middle = (low + high) // 2
+		requests += 1
+		if _exists(uri, session_key, app, collection, middle):
+			low = middle
+		else:
+			high = middle
+	logger.debug('Counted %d records in %s/%s with %d requests' % (high, app, collection, requests))
+	return high, requests
+
+def sample_records(uri, session_key, app, collection, count, sample_size, windows=10, seed=None):
+	"""Read about sample_size records from windows evenly sized runs of records at random positions.
+	The KV store can't return random records, so this is a cluster sample: each window is a run
+	of consecutive records, and the windows don't overlap."""
+	if count <= sample_size:
+		return get_records(uri, session_key, app, collection, count or 1, 0)
+	windows = max(1, min(windows, sample_size))
+	window_size = int(math.ceil(float(sample_size) / windows))
+	# Pick non-overlapping windows from the count / window_size possible slots
+	slots = random.Random(seed).sample(range(count // window_size), min(windows, count // window_size))
+	records = []
+	for slot in sorted(slots):
+		records += get_records(uri, session_key, app, collection, window_size, slot * window_size)
+	return records
+
+def estimate_distinct(counts, sample_size, population):
+	"""Estimate the number of distinct values in the population from the value counts in a sample,
+	with the bias-corrected Chao1 estimator: d + f1*(f1-1) / (2*(f2+1)), where f1 and f2 are the
+	numbers of values seen once and twice. Unique fields (e.g. _key) come out at the population size."""
+	if sample_size == 0:
+		return 0
+	singletons = len([c for c in counts.values() if c == 1])
+	doubletons = len([c for c in counts.values() if c == 2])
+	estimate = len(counts) + singletons * (singletons - 1) / (2.0 * (doubletons + 1))
+	return int(round(min(max(estimate, len(counts)), population)))
+
+def summarize_sample(records, count):
+	"""Record size and field statistics from a sample of records, scaled to a collection of count records"""
+	sizes = [len(json.dumps(r)) for r in records]
+	fields = {}
+	for record in records:
+		for name, value in record.items():
+			field = fields.setdefault(name, {'present': 0, 'bytes': 0, 'values': {}})
+			field['present'] += 1
+			value = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+			field['bytes'] += len(value)
+			if value in field['values'] or len(field['values']) < MAX_DISTINCT_VALUES:
+				field['values'][value] = field['values'].get(value, 0) + 1
+
+	sample_size = len(records)
+	average = float(sum(sizes)) / sample_size if sample_size > 0 else 0
+	summary = {
+		'sample_records': sample_size,
+		'avg_record_bytes': round(average, 1),
+		'max_record_bytes': max(sizes) if sample_size > 0 else 0,
+		'estimated_bytes': int(average * count),
+		'fields': len(fields)
+	}
+	field_stats = []
+	for name in sorted(fields):
+		field = fields[name]
+		present_count = int(round(count * float(field['present']) / sample_size))
+		field_stats.append({
+			'field': name,
+			'present_pct': round(100.0 * field['present'] / sample_size, 1),
+			'avg_value_bytes': round(float(field['bytes']) / field['present'], 1),
+			'sample_distinct': len(field['values']),
+			'estimated_distinct': estimate_distinct(field['values'], field['present'], present_count)
+		})
+	return summary, field_stats
+
+def collection_stats(logger, uri, session_key, app, collection, sample_size=1000, count_method='probe', windows=10):
+	"""Count a collection and estimate its size and field distributions from a sample.
+	Returns (collection stats, field stats)."""
+	start_time = time.time()
+	count, requests = count_records(logger, uri, session_key, app, collection, count_method)
+	count_seconds = time.time() - start_time
+	records = sample_records(uri, session_key, app, collection, count, sample_size, windows) if sample_size > 0 and count > 0 else []
+	summary, field_stats = summarize_sample(records, count)
+	stats = {
+		'_time': time.time(),
+		'app': app,
+		'collection': collection,
+		'records': count,
+		'count_method': count_method,
+		'count_requests': requests,
+		'count_seconds': round(count_seconds, 3),
+		'seconds': round(time.time() - start_time, 3)
+	}
+	stats.update(summary)
+	return stats, field_stats
+
+def stats_path(backup_dir):
+	return os.path.join(backup_dir, STATS_FILENAME)
+
+def load_stats(backup_dir):
+	"""The last statistics saved for each collection, as a dict of 'app/collection' -> stats"""
+	try:
+		with open(stats_path(backup_dir), 'r') as f:
+			return json.load(f)
+	except (IOError, OSError, ValueError):
+		return {}
+
+def save_stats(backup_dir, stats_list):
+	"""Add collection statistics to the saved statistics for the backup directory"""
+	saved = load_stats(backup_dir)
+	for stats in stats_list:
+		saved['%s/%s' % (stats['app'], stats['collection'])] = stats
+	temp_path = stats_path(backup_dir) + '.tmp'
+	with open(temp_path, 'w') as f:
+		json.dump(saved, f)
+	os.replace(temp_path, stats_path(backup_dir))
+
+def order_by_size(logger, uri, session_key, collections, backup_dir, max_age=86400, threads=4, sample_size=100):
+	"""Sort [app, collection] pairs by estimated size, largest first. Uses the statistics saved by
+	kvstorestats if they are newer than max_age seconds, and collects (and saves) the others in parallel."""
+	saved = load_stats(backup_dir)
+	now = time.time()
+	def cached(c):
+		stats = saved.get('%s/%s' % (c[0], c[1]))
+		if stats is not None and now - stats.get('_time', 0) <= max_age:
+			return stats
+		return None
+	missing = [c for c in collections if cached(c) is None]
+	if len(missing) > 0:
+		logger.debug('Collecting statistics for %d collections' % len(missing))
+		def get_stats(c):
+			try:
+				return collection_stats(logger, uri, session_key, c[0], c[1], sample_size)[0]
+			except BaseException as e:
+				logger.warning('Could not get statistics for %s/%s: %s' % (c[0], c[1], repr(e)))
+				return None
+		from multiprocessing.dummy import Pool as ThreadPool
+		pool = ThreadPool(max(min(threads, len(missing)), 1))
+		try:
+			new_stats = [s for s in pool.map(get_stats, missing) if s is not None]
+		finally:
+			pool.close()
+		try:
+			save_stats(backup_dir, new_stats)
+		except BaseException as e:
+			logger.warning('Could not save collection statistics: %s' % repr(e))
+		for stats in new_stats:
+			saved['%s/%s' % (stats['app'], stats['collection'])] = stats
+	def size(c):
+		stats = saved.get('%s/%s' % (c[0], c[1])) or {}
+		return (stats.get('estimated_bytes') or 0, stats.get('records') or 0)
+	return sorted(collections, key=size, reverse=True)
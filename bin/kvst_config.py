@@ -23,7 +23,15 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
 # https://github.com/HurricaneLabs/splunksecrets/blob/master/splunksecrets.py
 from splunksecrets import encrypt_new
 
-options = ['log_level', 'default_path', 'backup_batch_size', 'compression', 'retention_days', 'retention_size']
+options = ['log_level', 'default_path', 'backup_batch_size', 'compression', 'retention_days', 'retention_size',
+	'retention_delete_threads', 'backup_format', 'backup_index', 'max_file_records', 'max_file_size_mb', 'restore_threads',
+	'backup_repository', 'repository_chunk_records', 'session_cache_ttl',
+	'compression_codec', 'compression_level', 'compression_threads',
+	'batch_adaptive', 'batch_min_size', 'batch_target_size_mb', 'batch_target_latency',
+	'retry_attempts', 'retry_backoff', 'retry_max_backoff', 'retry_jitter', 'retry_status_codes',
+	'metrics_log', 'profile', 'profile_memory', 'profile_limit',
+	'backup_order', 'stats_sample_size', 'stats_threads', 'stats_max_age',
+	'merkle_trees', 'merkle_leaves', 'merkle_max_age']
 for i in range(1, 20):
 	options.append('credential' + str(i)) # credential1 through credential19
 
@@ -7,22 +7,19 @@
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9
 
-from __future__ import division
-from __future__ import print_function
-from future import standard_library
-standard_library.install_aliases()
-from builtins import str
-from past.utils import old_div
 import sys, os
-import stat
-import json
 import time
 from datetime import datetime
-import glob
 import kv_common as kv
-from deductiv_helpers import setup_logger, eprint, search_console
+import kv_metrics
+import kv_stats
+import kv_merkle
+from deductiv_helpers import setup_logger, eprint, search_console, str2bool
+from kv_profile import profiled_command
+from kv_compression import get_codec, get_backup_format, backup_formats
+import kv_catalog as catalog
+import kv_repository as repository
 from splunk.clilib import cli_common as cli
-import splunk.rest as rest
 
 # Add lib folders to import path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
@@ -30,12 +27,12 @@ from splunklib.searchcommands import \
     dispatch, GeneratingCommand, Configuration, Option, validators
 
 @Configuration(distributed=False, type='reporting')
-class KVStoreBackupCommand(GeneratingCommand):
+class KVStoreBackupCommand(profiled_command, GeneratingCommand):
 	""" %(synopsis)
 
 	##Syntax
 
-	| kvstorebackup app="app_name" collection="collection_name" path="/data/backup/kvstore" global_scope="false"
+	| kvstorebackup app="app_name" collection="collection_name" path="/data/backup/kvstore" global_scope="false" compression="true" codec="gzip" format="json" query="{...}" fields="field1, field2" sort="field1" max_file_records=1000000 max_file_size=1024 repository="false"
 
 	##Description
 
@@ -78,6 +75,76 @@ class KVStoreBackupCommand(GeneratingCommand):
 			Default: Specified in app configuration ''',
 			require=False, validate=validators.Boolean())
 
+	codec = Option(
+		doc='''
+			Syntax: codec=[gzip|bz2|xz|zstd]
+			Description: Specify the compression format for the backups
+			Default: Specified in app configuration ''',
+			require=False)
+
+	format = Option(
+		doc='''
+			Syntax: format=[json|ndjson]
+			Description: Specify the backup file format (JSON array or newline-delimited JSON)
+			Default: Specified in app configuration ''',
+			require=False)
+
+	query = Option(
+		doc='''
+			Syntax: query=<json>
+			Description: Only include records matching the KV store query (e.g. {"status": "active"})
+			Default: All records ''',
+			require=False)
+
+	fields = Option(
+		doc='''
+			Syntax: fields=<field1, field2, ...>
+			Description: Only include the specified fields in each record (field:0 to exclude a field)
+			Default: All fields ''',
+			require=False)
+
+	sort = Option(
+		doc='''
+			Syntax: sort=<field1[:1|:-1], field2, ...>
+			Description: Sort the records by the specified fields (1 ascending, -1 descending)
+			Default: None ''',
+			require=False)
+
+	max_file_records = Option(
+		doc='''
+			Syntax: max_file_records=<integer>
+			Description: Split each backup into files (shards) of at most this many records. 0 for no limit.
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Integer(minimum=0))
+
+	max_file_size = Option(
+		doc='''
+			Syntax: max_file_size=<integer>
+			Description: Split each backup into files (shards) of about this many MB (uncompressed). 0 for no limit.
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Integer(minimum=0))
+
+	repository = Option(
+		doc='''
+			Syntax: repository=[true|false]
+			Description: Store the backups in the deduplicating backup repository instead of individual files
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
+	order = Option(
+		doc='''
+			Syntax: order=[name|largest]
+			Description: Back up the collections in name order, or the largest collections first (using the statistics saved by kvstorestats)
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Set('name', 'largest'))
+
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
 	def generate(self):
 		try:
 			cfg = cli.getConfStanza('kvstore_tools','settings')
@@ -98,11 +165,8 @@ class KVStoreBackupCommand(GeneratingCommand):
 		splunkd_uri = self._metadata.searchinfo.splunkd_uri
 
 		# Check for permissions to run the command
-		content = rest.simpleRequest('/services/authentication/current-context?output_mode=json', sessionKey=session_key)[1]
-		content = json.loads(content)
 		current_user = self._metadata.searchinfo.username
-		current_user_capabilities = content['entry'][0]['content']['capabilities']
-		if 'run_kvstore_backup' in current_user_capabilities or 'run_kvst_all' in current_user_capabilities or current_user == 'splunk-system-user':
+		if kv.is_authorized(session_key, current_user, 'run_kvstore_backup'):
 			logger.debug("User %s is authorized." % current_user)
 		else:
 			ui.exit_error("User %s is unauthorized. Has the run_kvstore_backup capability been granted?" % current_user)
@@ -145,16 +209,64 @@ class KVStoreBackupCommand(GeneratingCommand):
 			logger.debug('Compression: %s' % self.compression)
 		else:
 			try:
-				self.compression = cfg.get('compression')
+				self.compression = str2bool(cfg.get('compression'))
 			except:
 				self.compression = False
 
+		if self.compression:
+			if not self.codec:
+				self.codec = cfg.get('compression_codec') or 'gzip'
+		else:
+			self.codec = 'none'
+		try:
+			codec = get_codec(self.codec)
+			logger.debug('Compression codec: %s' % codec.name)
+		except ValueError as e:
+			ui.exit_error(str(e))
+
+		try:
+			self.format = get_backup_format(self.format or cfg.get('backup_format'))
+			logger.debug('Backup format: %s' % self.format)
+		except ValueError as e:
+			ui.exit_error(str(e))
+
+		try:
+			self.query, self.fields, self.sort = kv.get_data_options(logger, self.query, self.fields, self.sort)
+		except ValueError as e:
+			ui.exit_error(str(e))
+
+		if self.max_file_records is None:
+			self.max_file_records = int(cfg.get('max_file_records') or 0)
+		if self.max_file_size is None:
+			self.max_file_size = int(cfg.get('max_file_size_mb') or 0)
+		if self.max_file_records > 0 or self.max_file_size > 0:
+			logger.debug('Shard limits: %d records / %d MB' % (self.max_file_records, self.max_file_size))
+
+		if self.repository is None:
+			self.repository = str2bool(cfg.get('backup_repository') or False)
+		repo_dir = repository.repository_path(self.path)
+		if self.repository:
+			logger.debug('Backup repository: %s' % repo_dir)
+			if self.sort:
+				# Chunk boundaries (and deduplication) depend on the records arriving in _key order
+				ui.exit_error("sort can't be used with repository backups, which are always stored in _key order")
+
 		app_list = kv.get_server_apps(splunkd_uri, session_key, self.app)
 		logger.debug("Apps list: %s" % str(app_list))
 		collection_list = kv.get_app_collections(splunkd_uri, session_key, self.collection, self.app, app_list, self.global_scope)
 
+		if not self.order:
+			self.order = cfg.get('backup_order') or 'name'
+		if self.order == 'largest' and len(collection_list) > 1:
+			# Start the longest backups first, so they are not left running alone at the end of the window
+			collection_list = kv_stats.order_by_size(logger, splunkd_uri, session_key, collection_list, self.path,
+				int(cfg.get('stats_max_age') or 86400), int(cfg.get('stats_threads') or 4))
+
 		logger.info('Collections to backup: %s', str(collection_list))
 
+		# Refresh the Merkle trees of the collections from the records being downloaded
+		merkle_trees = str2bool(cfg.get('merkle_trees') or False) and not self.query and not self.fields
+
 		for collection in collection_list:
 			# Extract the app and collection name from the array
 			entry_app = collection[0]
@@ -165,57 +277,91 @@ class KVStoreBackupCommand(GeneratingCommand):
 			#maxrows = int(limits_cfg.get('max_rows_per_query'))
 
 			# Set the filename and location for the output (expanding environment variables)
-			output_filename = entry_app + "#" + collection_name + "#" + st + ".json"
-			if self.compression:
-				output_filename = output_filename + '.gz'
+			output_filename = entry_app + "#" + collection_name + "#" + st + backup_formats[self.format] + codec.extension
 			output_file = os.path.join(self.path, output_filename)
 
+			if self.repository:
+				# Store the records in the repository and write a manifest
+				writer = repository.repository_writer(repo_dir, entry_app, collection_name, st,
+					int(cfg.get('repository_chunk_records') or 1000), level=int(cfg.get('compression_level') or 6))
+				output_file = writer.filename
+			else:
+				writer = None
+
+			tree = None
+			if merkle_trees:
+				tree = kv_merkle.download_tree(logger, splunkd_uri, session_key, entry_app, collection_name, self.path,
+					int(cfg.get('merkle_leaves') or kv_merkle.DEFAULT_LEAVES))
+
 			# Download the collection to a local file
-			result, message, total_record_count = kv.download_collection(logger, splunkd_uri, session_key, entry_app, collection_name, output_file, self.compression)
+			metrics = kv_metrics.operation_metrics('download_collection', kv.get_retry_policy(), app=entry_app, collection=collection_name)
+			stats = {}
+			with metrics.phase('download'):
+				result, message, total_record_count = kv.download_collection(logger, splunkd_uri, session_key, entry_app, collection_name, output_file, self.query, self.fields, self.sort, stats,
+					str2bool(cfg.get('backup_index') or False), self.max_file_records, self.max_file_size * 1024 * 1024, writer, metrics, tree)
+			if tree is not None and result in ['success', 'skipped']:
+				try:
+					kv_merkle.save_tree(self.path, tree)
+				except BaseException as e:
+					logger.warning('Could not save the tree of %s/%s: %s' % (entry_app, collection_name, repr(e)))
 			logger.debug("Retrieved {0} records from {1}".format(total_record_count, collection_name))
-			yield {'_time': time.time(), 'app': entry_app, 'collection': collection_name, 'result': result, 'records': total_record_count, 'message': message, 'file': output_file }
+			metrics.count('records', total_record_count)
+			if 'uncompressed_bytes' in stats:
+				metrics.count('bytes', stats['uncompressed_bytes'])
+
+			backup_files = stats.get('files', [])
+			if self.repository:
+				row = {'_time': time.time(), 'app': entry_app, 'collection': collection_name, 'result': result, 'message': message, 'file': output_file }
+				if len(backup_files) > 0:
+					row.update({'chunks': backup_files[0]['chunks'], 'new_chunks': backup_files[0]['new_chunks'], 'stored_bytes': backup_files[0]['stored_bytes']})
+				row.update(metrics.fields())
+				kv_metrics.log_metrics(logger, cfg, metrics, result=result)
+				yield row
+				continue
+
+			# Add the backup (or each of its shards) to the catalog
+			for file_stats in backup_files:
+				try:
+					catalog_entry = catalog.build_catalog_entry(file_stats['file'], file_stats['records'], file_stats['uncompressed_bytes'], file_stats['checksum'], result)
+					catalog.append_catalog_entry(self.path, catalog_entry)
+				except BaseException as e:
+					logger.error("Could not add %s to the backup catalog: %s" % (file_stats['file'], repr(e)))
+			if len(backup_files) > 1:
+				output_file = [f['file'] for f in backup_files]
+			row = {'_time': time.time(), 'app': entry_app, 'collection': collection_name, 'result': result, 'message': message, 'file': output_file }
+			row.update(metrics.fields())
+			kv_metrics.log_metrics(logger, cfg, metrics, result=result, files=len(backup_files))
+			yield row
 
 		# Execute retention routine
-		max_age = 0
-		max_age = int(cfg.get('retention_days'))
-		max_size = 0
-		max_size = int(cfg.get('retention_size')) * 1024 * 1024
-
-		if max_size > 0 or max_age > 0:
-			# Check the size of all *.json and *.json.gz files in the directory
-			#dir = self.path
-			pattern = os.path.join(self.path, "*#*#*.json*")
-
-			# Get a listing of the files and check the file sizes
-			backup_file_list = glob.glob(pattern)
-
-			# Sort descending based on file timestamp
-			backup_file_list.sort(key=os.path.getmtime, reverse=True)
-
-			# Count the total bytes in all of the files
-			totalbytes = 0
-			logger.debug("Max age (days): %s / Max size: %s" % (max_age, max_size))
-			
-			for f in backup_file_list:
-				logger.debug("File %s", f)
-
-				# Get the file size (bytes) and age (days)
-				bytes = os.path.getsize(f)
-				age_days = old_div((time.time() - os.stat(f)[stat.ST_MTIME]), 86400)
-				logger.debug("Age (days): %d", age_days)
-
-				# increment the total byte count
-				totalbytes += bytes
-
-				if totalbytes > max_size and max_size > 0:
-					# Delete the files
-					logger.debug("Total bytes ({0}) > max_size ({1})".format(totalbytes, max_size))
-					os.remove(f)
-					logger.info("Deleted file due to size retention policy: %s" % f)
-
-				elif age_days > max_age and max_age > 0:
-					logger.debug("Age ({0}) > max_age ({1})".format(age_days, max_age))
-					os.remove(f)
-					logger.info("Deleted file due to age retention policy: %s" % f)
+		try:
+			conf = cli.getMergedConf('kvstore_tools')
+		except BaseException as e:
+			logger.warning("Could not read retention policies, using the default policy: %s" % repr(e))
+			conf = {'settings': cfg}
+		default_policy, policies = catalog.get_retention_policies(conf)
+
+		if self.repository and (default_policy.is_set() or len(policies) > 0):
+			# Delete the expired backups from the repository, then the chunks no backup uses any more
+			expired = catalog.evaluate_retention(repository.list_manifests(repo_dir), default_policy, policies)
+			deleted = repository.delete_manifests(logger, repo_dir, [e[0]['file'] for e in expired])
+			for filename in deleted:
+				logger.info("Deleted backup from the repository due to retention policy: %s" % filename)
+			repository.collect_garbage(logger, repo_dir)
+		elif default_policy.is_set() or len(policies) > 0:
+			logger.debug("Max age (days): %s / Max size: %s / Collection policies: %d" % (default_policy.max_age_days, default_policy.max_bytes, len(policies)))
+			# Get the backup files in the directory from the catalog (built on first use)
+			if catalog.catalog_exists(self.path):
+				backup_entries = list(catalog.load_catalog(self.path).values())
+			else:
+				backup_entries = list(catalog.rebuild_catalog(logger, self.path).values())
+
+			expired = catalog.evaluate_retention(backup_entries, default_policy, policies)
+			for entry, reason, policy_name in expired:
+				logger.debug("Deleting file due to %s retention policy (%s): %s" % (reason, policy_name, entry['file']))
+
+			deleted = catalog.delete_backup_files(logger, self.path, [e[0]['file'] for e in expired], int(cfg.get('retention_delete_threads') or 8))
+			for filename in deleted:
+				logger.info("Deleted file due to retention policy: %s" % os.path.join(self.path, filename))
 
 dispatch(KVStoreBackupCommand, sys.argv, sys.stdin, sys.stdout, __name__)
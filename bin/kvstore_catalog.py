@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# KV Store Backup Catalog
+# Lists the backups recorded in the backup catalog for a directory
+# Optionally rebuilds the catalog from the files on disk to correct drift
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import sys
+import os
+import kv_common as kv
+import kv_catalog as catalog
+from deductiv_helpers import setup_logger, search_console
+from kv_profile import profiled_command
+from splunk.clilib import cli_common as cli
+
+# Add lib folders to import path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from splunklib.searchcommands import \
+	dispatch, GeneratingCommand, Configuration, Option, validators
+
+@Configuration(distributed=False, type='reporting')
+class KVStoreCatalogCommand(profiled_command, GeneratingCommand):
+	""" %(synopsis)
+
+	##Syntax
+
+	| kvstorecatalog path="/data/backup/kvstore" rebuild=[true|false]
+
+	##Description
+
+	Lists the KV Store backups recorded in the backup catalog, optionally rebuilding it from the files on disk
+
+	"""
+
+	path = Option(
+		doc='''
+			Syntax: path=<directory>
+			Description: Specify the backup directory
+			Default: Specified in app configuration ''',
+			require=False)
+
+	rebuild = Option(
+		doc='''
+			Syntax: rebuild=[true|false]
+			Description: Rebuild the catalog from the backup files in the directory
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
+	def generate(self):
+		try:
+			cfg = cli.getConfStanza('kvstore_tools','settings')
+		except BaseException as e:
+			self.write_error("Could not read configuration: " + repr(e))
+			exit(1)
+		
+		# Facility info - prepended to log lines
+		facility = os.path.basename(__file__)
+		facility = os.path.splitext(facility)[0]
+		logger = setup_logger(cfg["log_level"], 'kvstore_tools.log', facility)
+		ui = search_console(logger, self)
+		logger.info('Script started by %s' % self._metadata.searchinfo.username)
+
+		session_key = self._metadata.searchinfo.session_key
+
+		# Check for permissions to run the command
+		current_user = self._metadata.searchinfo.username
+		if kv.is_authorized(session_key, current_user, 'run_kvstore_backup'):
+			logger.debug("User %s is authorized." % current_user)
+		else:
+			ui.exit_error("User %s is unauthorized. Has the run_kvstore_backup capability been granted?" % current_user)
+
+		if not self.path:
+			# Get path from configuration
+			try:
+				# Break path out and re-join it so it's OS independent
+				default_path = cfg.get('default_path').split('/')
+				self.path = os.path.abspath(os.path.join(os.sep, *default_path))
+			except:
+				ui.exit_error("Unable to get backup path. Path not provided in search arguments and default path is not set.")
+
+		# Replace environment variables
+		self.path = os.path.expandvars(self.path)
+		self.path = self.path.replace('//', '/')
+		logger.debug('Backup path: %s' % self.path)
+		if not os.path.isdir(self.path):
+			ui.exit_error("Path does not exist: {0}".format(self.path))
+
+		if self.rebuild or not catalog.catalog_exists(self.path):
+			entries = catalog.rebuild_catalog(logger, self.path)
+		else:
+			entries = catalog.load_catalog(self.path)
+
+		for entry in list(entries.values()):
+			row = {'_time': entry['mtime'], 'filename': os.path.join(self.path, entry['file'])}
+			for k in ['app', 'collection', 'timestamp', 'codec', 'records', 'bytes', 'uncompressed_bytes', 'checksum', 'status']:
+				row[k] = entry.get(k)
+			yield row
+
+dispatch(KVStoreCatalogCommand, sys.argv, sys.stdin, sys.stdout, __name__)
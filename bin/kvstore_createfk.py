@@ -8,28 +8,25 @@
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9
 
-from __future__ import print_function
-from builtins import str
-from future import standard_library
-standard_library.install_aliases()
-from io import open
 import sys
 import os
 import json
 import time
 import re
 import fcntl
+import urllib.parse
+import kv_metrics
 from deductiv_helpers import setup_logger, search_console
+from kv_profile import profiled_command
 from splunk.clilib import cli_common as cli
 
 # Add lib folders to import path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
-from splunklib.client import connect
 from splunklib.searchcommands import \
-    dispatch, StreamingCommand, Configuration, Option
+    dispatch, StreamingCommand, Configuration, Option, validators
 
 @Configuration(local=True)
-class KVStoreCreateFKCommand(StreamingCommand):
+class KVStoreCreateFKCommand(profiled_command, StreamingCommand):
 	""" %(synopsis)
 	
 	##Syntax (Example)  
@@ -89,6 +86,13 @@ class KVStoreCreateFKCommand(StreamingCommand):
 			require=False)
 
 
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
 	def stream(self, events):
 		try:
 			cfg = cli.getConfStanza('kvstore_tools','settings')
@@ -138,6 +142,16 @@ class KVStoreCreateFKCommand(StreamingCommand):
 		opts["owner"] = "nobody"
 		opts["token"] = self._metadata.searchinfo.session_key
 		opts["app"] = self.app
+		# Connect to the splunkd that started the search, like the other commands do. splunklib otherwise
+		# connects to https://localhost:8089, which fails when the management port or its bind address
+		# was changed (e.g. mgmtHostPort in web.conf) or splunkd serves plain HTTP.
+		splunkd_url_tuple = urllib.parse.urlparse(self._metadata.searchinfo.splunkd_uri or '')
+		if splunkd_url_tuple.hostname and splunkd_url_tuple.port:
+			opts["scheme"] = splunkd_url_tuple.scheme
+			opts["host"] = splunkd_url_tuple.hostname
+			opts["port"] = splunkd_url_tuple.port
+		else:
+			logger.warning('No splunkd URI for the search. Connecting to the default https://localhost:8089.')
 
 		#epoch_time = int(time.time())
 		current_user = self._metadata.searchinfo.username
@@ -170,6 +184,7 @@ class KVStoreCreateFKCommand(StreamingCommand):
 					variable_output_fields = json.loads(f.read())	#dict
 			
 			# Connect to the kv store
+			from splunklib.client import connect
 			service = connect(**opts)
 			if self.collection in service.kvstore:
 				obj_collection = service.kvstore[self.collection]
@@ -217,6 +232,7 @@ class KVStoreCreateFKCommand(StreamingCommand):
 			ui.exit_error('Error connecting to collection: %s' % repr(e))
 
 		# Read the events, resolve the variables, store them on a per-groupby-fieldvalue basis
+		metrics = kv_metrics.operation_metrics('create_fk', app=self.app, collection=self.collection)
 		i = 0
 		inserts = 0
 		for e in events:
@@ -253,7 +269,10 @@ class KVStoreCreateFKCommand(StreamingCommand):
 					try:
 						# Update the collection
 						new_kv_record.update(static_output_fields)
-						response = obj_collection.data.update(kvstore_entry_key, json.dumps(new_kv_record))
+						with metrics.phase('kvstore'):
+							response = obj_collection.data.update(kvstore_entry_key, json.dumps(new_kv_record))
+						metrics.count('updates')
+						metrics.count('http_requests')
 
 						# Write the data to disk immediately so other threads can benefit
 						with open(resolved_variables_file, 'w') as f:
@@ -277,7 +296,9 @@ class KVStoreCreateFKCommand(StreamingCommand):
 				
 				try:
 					# Write the new kvstore record and get the ID (_key) 
-					response = obj_collection.data.insert(json.dumps(new_kv_record))
+					with metrics.phase('kvstore'):
+						response = obj_collection.data.insert(json.dumps(new_kv_record))
+					metrics.count('http_requests')
 				except BaseException as e:
 					ui.exit_error('Unable to insert record into collection %s: %s' % (self.collection, repr(e)))
 				kvstore_entry_key = response["_key"]
@@ -294,5 +315,9 @@ class KVStoreCreateFKCommand(StreamingCommand):
 			yield e
 			i += 1
 		logger.info("Modified %d events and inserted %s new records into %s" % (i, inserts, self.collection))
+		metrics.count('records', i)
+		metrics.count('inserts', inserts)
+		metrics.count('http_seconds', metrics.phases.get('kvstore', 0))
+		kv_metrics.log_metrics(logger, cfg, metrics)
 	
 dispatch(KVStoreCreateFKCommand, sys.argv, sys.stdin, sys.stdout, __name__)
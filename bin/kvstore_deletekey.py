@@ -6,25 +6,23 @@
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9
 
-from __future__ import print_function
-from builtins import str
-from future import standard_library
-standard_library.install_aliases()
 import sys
 import os
 import urllib.parse
 import time
 import kv_common as kv
+import kv_metrics
 from deductiv_helpers import setup_logger, request, search_console
+from kv_profile import profiled_command
 from splunk.clilib import cli_common as cli
 
 # Add lib folders to import path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
 from splunklib.searchcommands import \
-	dispatch, GeneratingCommand, Configuration, Option
+	dispatch, GeneratingCommand, Configuration, Option, validators
 
 @Configuration(distributed=False, type='reporting')
-class KVStoreDeleteKeyCommand(GeneratingCommand):
+class KVStoreDeleteKeyCommand(profiled_command, GeneratingCommand):
 	""" %(synopsis)
 
 	##Syntax
@@ -55,6 +53,12 @@ class KVStoreDeleteKeyCommand(GeneratingCommand):
 		 Description: Specify the record to delete within the collection''',
 		 require=True)
 
+	profile = Option(
+		doc='''
+		 Syntax: profile=[true|false]
+		 Description: Profile the command with cProfile and write the results to the search's dispatch directory''',
+		require=False, validate=validators.Boolean())
+
 	def generate(self):
 		try:
 			cfg = cli.getConfStanza('kvstore_tools','settings')
@@ -120,6 +124,7 @@ class KVStoreDeleteKeyCommand(GeneratingCommand):
 			ui.exit_error('Error enumerating collections: ' + str(e))
 
 		url_tmpl_delete = '%(server_uri)s/servicesNS/%(owner)s/%(app)s/storage/collections/data/%(collection)s/%(id)s?output_mode=json'
+		metrics = kv_metrics.operation_metrics('delete_key', kv.get_retry_policy(), app=self.app, collection=self.collection)
 		try:
 			delete_url = url_tmpl_delete % dict(
 				server_uri = splunkd_uri,
@@ -130,7 +135,7 @@ class KVStoreDeleteKeyCommand(GeneratingCommand):
 			logger.debug("Delete url: " + delete_url)
 
 			try:
-				response, response_code = request('DELETE', delete_url, '', headers)
+				response, response_code = request('DELETE', delete_url, '', headers, retry=kv.get_retry_policy())
 				logger.debug('Server response: %s', response)
 			except BaseException as e:
 				logger.error('Failed to delete key %s from collection %s/%s: %s' % (self.key, self.app, self.collection, repr(e)))
@@ -138,6 +143,7 @@ class KVStoreDeleteKeyCommand(GeneratingCommand):
 			if response_code == 200:
 				logger.debug("Successfully deleted key %s from collection %s/%s" % (self.key, self.app, self.collection))
 				result = "success"
+				metrics.count('records')
 			else:
 				logger.error("Error deleting key %s from collection %s/%s: %s" % (self.key, self.app, self.collection, response))
 				result = "error"
@@ -147,6 +153,9 @@ class KVStoreDeleteKeyCommand(GeneratingCommand):
 			result = "error"
 
 		# Entry deleted
-		yield {'_time': time.time(), 'app': self.app, 'collection': self.collection, 'key': self.key, 'result': result }
+		row = {'_time': time.time(), 'app': self.app, 'collection': self.collection, 'key': self.key, 'result': result }
+		row.update(metrics.fields())
+		kv_metrics.log_metrics(logger, cfg, metrics, result=result)
+		yield row
 
 dispatch(KVStoreDeleteKeyCommand, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -7,27 +7,24 @@
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9
 
-from __future__ import print_function
-from builtins import str
-from future import standard_library
-standard_library.install_aliases()
 import sys
 import os
 import urllib.parse
 import http.client as httplib
 import kv_common as kv
-from multiprocessing import Pool
-from multiprocessing.dummy import Pool as ThreadPool
+import kv_metrics
 import threading
 from deductiv_helpers import request, setup_logger, search_console
+from kv_profile import profiled_command
 from splunk.clilib import cli_common as cli
 
 # Add lib folders to import path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
 from splunklib.searchcommands import \
-    dispatch, StreamingCommand, Configuration, Option
+    dispatch, StreamingCommand, Configuration, Option, validators
 
-lock = threading.Lock()
+# One keep-alive connection per worker thread, so a request waiting to be retried doesn't block the others
+connections = threading.local()
 cfg = cli.getConfStanza('kvstore_tools','settings')
 # Facility info - prepended to log lines
 facility = os.path.basename(__file__)
@@ -35,7 +32,7 @@ facility = os.path.splitext(facility)[0]
 logger = setup_logger(cfg["log_level"], 'kvstore_tools.log', facility)
 
 @Configuration(local=True)
-class KVStoreDeleteKeysCommand(StreamingCommand):
+class KVStoreDeleteKeysCommand(profiled_command, StreamingCommand):
 	""" %(synopsis)
 
 	##Syntax
@@ -66,9 +63,23 @@ class KVStoreDeleteKeysCommand(StreamingCommand):
 		 Description: Specify the field name from the event''',
 		require=False)
 
+	profile = Option(
+		doc='''
+		 Syntax: profile=[true|false]
+		 Description: Profile the command with cProfile and write the results to the search's dispatch directory''',
+		require=False, validate=validators.Boolean())
+
 	splunkd_uri = None
 	session_key = None
-	conn = None
+	metrics = None
+
+	def connection(self):
+		"""The splunkd connection of the current worker thread"""
+		conn = getattr(connections, 'conn', None)
+		if conn is None:
+			conn = httplib.HTTPSConnection(urllib.parse.urlparse(self.splunkd_uri).netloc)
+			connections.conn = conn
+		return conn
 
 	def delete_key_from_event(self, delete_event):
 		url_tmpl_delete = '%(server_uri)s/servicesNS/%(owner)s/%(app)s/storage/collections/data/%(collection)s/%(id)s?output_mode=json'
@@ -92,16 +103,15 @@ class KVStoreDeleteKeysCommand(StreamingCommand):
 							id = urllib.parse.quote(event_key_value, safe=''))
 
 						try:
-							lock.acquire()
-							response, response_code = request('DELETE', delete_url, '', headers, self.conn)
+							response, response_code = request('DELETE', delete_url, '', headers, self.connection(), retry=kv.get_retry_policy())
 							logger.debug('Server response for key %s: %s' % (event_key_value, response))
-							lock.release()
 						except BaseException as e:
 							logger.error('ERROR Failed to delete key %s: %s', (event_key_value, repr(e)))
 
 						if response_code == 200:
 							logger.debug("Successfully deleted key " + event_key_value)
 							delete_event['delete_status'] = "success"
+							self.metrics.count('records')
 							return delete_event
 						else:
 							logger.error("Error %d deleting key %s: %s" % (response_code, event_key_value, response))
@@ -135,8 +145,6 @@ class KVStoreDeleteKeysCommand(StreamingCommand):
 		
 		self.session_key = self._metadata.searchinfo.session_key
 		self.splunkd_uri = self._metadata.searchinfo.splunkd_uri
-		splunkd_url_tuple = urllib.parse.urlparse(self.splunkd_uri)
-		self.conn = httplib.HTTPSConnection(splunkd_url_tuple.netloc)
 
 		# Enumerate all app_list
 		app_list = kv.get_server_apps(self.splunkd_uri, self.session_key, self.app)
@@ -166,13 +174,17 @@ class KVStoreDeleteKeysCommand(StreamingCommand):
 			ui.exit_error('Error enumerating collections: %s' % repr(e))
 
 		# Make a Pool of workers
+		from multiprocessing.dummy import Pool as ThreadPool
 		pool = ThreadPool(4)
 
+		self.metrics = kv_metrics.operation_metrics('delete_keys', kv.get_retry_policy(), app=self.app, collection=self.collection)
 		try:
-			results = pool.map(self.delete_key_from_event, events)
+			with self.metrics.phase('delete'):
+				results = pool.map(self.delete_key_from_event, events)
 		except BaseException as e:
 			logger.error("%s" % repr(e), exc_info=True)
 			results = {}
+		kv_metrics.log_metrics(logger, cfg, self.metrics, events=len(results))
 			
 		for result in results:
 			yield result
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+# KV Store Diff
+# Compares a KV Store collection with the same collection on a remote host or in a backup.
+# Both sides are read in _key order and merge joined, so memory use doesn't grow with the
+# size of the collection.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import sys
+import os
+import re
+import glob
+import json
+import urllib.error
+import kv_common as kv
+import kv_credentials
+import kv_diff
+import kv_metrics
+import kv_merkle
+import kv_catalog as catalog
+import kv_repository as repository
+from kv_compression import INDEX_EXTENSION
+from deductiv_helpers import setup_logger, is_ipv4, search_console
+from kv_profile import profiled_command
+from splunk.clilib import cli_common as cli
+
+# Add lib folders to import path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from splunklib.searchcommands import \
+	dispatch, GeneratingCommand, Configuration, Option, validators
+
+@Configuration(distributed=False, type='reporting')
+class KVStoreDiffCommand(profiled_command, GeneratingCommand):
+	""" %(synopsis)
+
+	##Syntax
+
+	| kvstorediff app="app_name" collection="collection_name" target="remotehost" targetport=8089 filename="app_name#collection_name#*" details=[true|false] merkle=[true|false] summary=[true|false]
+
+	##Description
+
+	Compare a collection with the same collection on a remote host or in a backup, and list the added, removed and changed records
+
+	"""
+
+	app = Option(
+		doc='''
+			Syntax: app=<appname>
+			Description: The app of the collection to compare
+			Default: The app in the backup filename ''',
+			require=False)
+
+	collection = Option(
+		doc='''
+			Syntax: collection=<collection_name>
+			Description: The collection to compare
+			Default: The collection in the backup filename ''',
+			require=False)
+
+	source = Option(
+		doc='''
+			Syntax: source=<hostname>
+			Description: Read the collection from a remote host instead of the local KV Store. Credentials must be given via setup.
+			Default: The local KV Store ''',
+			require=False)
+
+	target = Option(
+		doc='''
+			Syntax: target=<hostname>
+			Description: The remote host to compare the collection with. Credentials must be given via setup.''',
+			require=False)
+
+	targetport = Option(
+		doc='''
+			Syntax: targetport=<Port>
+			Description: Specify the Splunk REST API port of the remote hosts
+			Default: 8089 ''',
+			require=False, validate=validators.Integer(minimum=1,maximum=65535))
+
+	filename = Option(
+		doc='''
+			Syntax: filename=<filename>
+			Description: The backup to compare the collection with. Wildcards select the newest matching backup.''',
+			require=False)
+
+	repository = Option(
+		doc='''
+			Syntax: repository=[true|false]
+			Description: Read the backup from the deduplicating backup repository. The filename is matched against the backup names (app#collection#timestamp).
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	query = Option(
+		doc='''
+			Syntax: query=<json>
+			Description: Only compare the records matching the KV store query (e.g. {"status": "active"}). Not applied to backups.
+			Default: All records ''',
+			require=False)
+
+	fields = Option(
+		doc='''
+			Syntax: fields=<field1, field2, ...>
+			Description: Only compare the specified fields of each record (field:0 to exclude a field). Not applied to backups.
+			Default: All fields ''',
+			require=False)
+
+	ignore = Option(
+		doc='''
+			Syntax: ignore=<field1, field2, ...>
+			Description: Fields to leave out of the comparison
+			Default: None ''',
+			require=False)
+
+	details = Option(
+		doc='''
+			Syntax: details=[true|false]
+			Description: List the changed fields of each changed record, with their values before and after
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	merkle = Option(
+		doc='''
+			Syntax: merkle=[true|false]
+			Description: Compare the Merkle trees of the collections first, and only read the _key ranges that differ. The target host must have this app installed.
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	summary = Option(
+		doc='''
+			Syntax: summary=[true|false]
+			Description: Only output the number of added, removed, changed and unchanged records
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
+	def get_remote_session(self, logger, ui, cfg, host):
+		# Use the credential where the realm matches the target hostname
+		# Otherwise, use the credential for the short hostname
+		try:
+			hostname = host
+			try:
+				if host not in kv_credentials.list_credentials(cfg):
+					if '.' in host and not is_ipv4(host):
+						hostname = host.split('.')[0]
+					else:
+						raise KeyError
+				remote_user, remote_password = kv_credentials.get_credential(cfg, hostname)
+			except KeyError:
+				ui.exit_error("Could not get password for %s: Record not found" % hostname)
+		except BaseException as e:
+			ui.exit_error('Failed to get credentials for remote Splunk instance: %s' % repr(e))
+
+		# Reuse a cached session if there is one, instead of logging in on every run
+		try:
+			remote_uri = 'https://%s:%s' % (host, self.targetport)
+			return remote_uri, kv.get_remote_session_key(logger, host, self.targetport, remote_user, remote_password)
+		except (urllib.error.HTTPError, BaseException) as e:
+			ui.exit_error('Failed to login to remote Splunk instance %s: %s' % (host, repr(e)))
+
+	def find_backup_files(self, logger, ui, default_path):
+		"""Get the files of the backup to compare with (the newest match for a wildcard)"""
+		if '*' in self.filename:
+			pattern = self.filename if os.path.dirname(self.filename) else os.path.join(default_path, self.filename)
+			names = glob.glob(pattern)
+		elif os.path.isfile(self.filename):
+			names = [self.filename]
+		elif os.path.isfile(os.path.join(default_path, self.filename)):
+			names = [os.path.join(default_path, self.filename)]
+		else:
+			# Look for the shards of a sharded backup (app#collection#timestamp#partNNN.json[.ext])
+			shard_pattern = re.sub(r'(\.(?:nd)?json.*)$', r'#part*\1', self.filename)
+			names = glob.glob(shard_pattern) or glob.glob(os.path.join(default_path, shard_pattern))
+
+		backups = {}
+		for name in names:
+			file_info = catalog.parse_backup_filename(name)
+			if file_info is None or name.endswith(INDEX_EXTENSION):
+				continue
+			if self.app and file_info['app'] != self.app or self.collection and file_info['collection'] != self.collection:
+				continue
+			backup_id = os.path.join(os.path.dirname(name), file_info['backup'])
+			backups.setdefault(backup_id, (file_info, []))[1].append(name)
+		if len(backups) == 0:
+			ui.exit_error("No matching backup files: %s" % self.filename)
+		# Newest backup
+		file_info, files = backups[max(backups.keys(), key=lambda b: (backups[b][0]['timestamp'], b))]
+		logger.debug('Comparing with backup files: %s' % str(files))
+		# Shards in part number order (#part1000 after #part999)
+		return file_info, sorted(files, key=lambda name: catalog.parse_backup_filename(name)['part'] or 0)
+
+	def generate(self):
+		try:
+			cfg = cli.getConfStanza('kvstore_tools','settings')
+		except BaseException as e:
+			self.write_error("Could not read configuration: " + repr(e))
+			exit(1)
+
+		# Facility info - prepended to log lines
+		facility = os.path.basename(__file__)
+		facility = os.path.splitext(facility)[0]
+		logger = setup_logger(cfg["log_level"], 'kvstore_tools.log', facility)
+		ui = search_console(logger, self)
+		logger.info('Script started by %s' % self._metadata.searchinfo.username)
+
+		session_key = self._metadata.searchinfo.session_key
+		splunkd_uri = self._metadata.searchinfo.splunkd_uri
+
+		# Check for permissions to run the command
+		current_user = self._metadata.searchinfo.username
+		if kv.is_authorized(session_key, current_user, 'run_kvstore_backup'):
+			logger.debug("User %s is authorized." % current_user)
+		else:
+			ui.exit_error("User %s is unauthorized. Has the run_kvstore_backup capability been granted?" % current_user)
+		if (self.source or self.target) and not kv.is_authorized(session_key, current_user, 'run_kvstore_pull'):
+			ui.exit_error("User %s is unauthorized to read remote collections. Has the run_kvstore_pull capability been granted?" % current_user)
+
+		# Sanitize input
+		if (self.target and self.filename) or not (self.target or self.filename):
+			ui.exit_error("Specify either a target host or a backup filename to compare the collection with")
+		if not self.targetport:
+			self.targetport = '8089'
+		if self.query:
+			try:
+				json.loads(self.query)
+			except ValueError as e:
+				ui.exit_error("Invalid query (must be JSON): %s" % repr(e))
+		ignore = set([f.strip() for f in self.ignore.split(',') if f.strip()]) if self.ignore else None
+		if self.merkle and (self.filename or self.source or self.query or self.fields or ignore):
+			ui.exit_error("merkle=true compares whole local and remote records and can't be used with filename, source, query, fields or ignore")
+		default_path = cfg.get('default_path').split('/')
+		default_path = os.path.expandvars(os.path.abspath(os.path.join(os.sep, *default_path))).replace('//', '/')
+
+		# The base side: a remote collection or a backup
+		if self.filename:
+			if self.repository:
+				repo_dir = repository.repository_path(default_path)
+				pattern = os.path.basename(self.filename)
+				if pattern.endswith(repository.MANIFEST_EXTENSION):
+					pattern = pattern[:-len(repository.MANIFEST_EXTENSION)]
+				manifests = [m for m in repository.list_manifests(repo_dir, pattern)
+					if (not self.app or m['app'] == self.app) and (not self.collection or m['collection'] == self.collection)]
+				if len(manifests) == 0:
+					ui.exit_error("No matching backups in the repository: %s" % pattern)
+				entry = manifests[-1]
+				base_name = entry['backup']
+				self.app = entry['app']
+				self.collection = entry['collection']
+				manifest = repository.read_manifest(entry['path'])
+				base_records = repository.read_manifest_records(repo_dir, manifest)
+				# Manifests written before the sorted flag existed may not be in _key order
+				base_sorted = manifest.get('sorted', False)
+			else:
+				file_info, files = self.find_backup_files(logger, ui, default_path)
+				base_name = file_info['backup']
+				self.app = file_info['app']
+				self.collection = file_info['collection']
+				base_records = kv_diff.backup_file_records(logger, files)
+				base_sorted = kv_diff.backup_is_sorted(files)
+		else:
+			if not self.app or not self.collection:
+				ui.exit_error("Specify the app and collection to compare")
+			target_uri, target_session_key = self.get_remote_session(logger, ui, cfg, self.target)
+			base_name = self.target
+			base_records = kv_diff.collection_records(logger, target_uri, target_session_key, self.app, self.collection, self.query, self.fields)
+			base_sorted = True
+
+		# The other side: the local collection, or a remote one
+		if self.source:
+			source_uri, source_session_key = self.get_remote_session(logger, ui, cfg, self.source)
+		else:
+			source_uri, source_session_key = splunkd_uri, session_key
+		records = kv_diff.collection_records(logger, source_uri, source_session_key, self.app, self.collection, self.query, self.fields)
+		source_name = self.source or kv.hostname_from_uri(splunkd_uri)
+		logger.info('Comparing %s/%s on %s with %s' % (self.app, self.collection, source_name, base_name))
+
+		metrics = kv_metrics.operation_metrics('diff', kv.get_retry_policy(), app=self.app, collection=self.collection)
+		if self.merkle:
+			# Only read the _key ranges whose hashes differ
+			try:
+				with metrics.phase('compare'):
+					source_tree, base_tree, ranges = kv_merkle.compare(logger, source_uri, source_session_key, target_uri, target_session_key,
+						self.app, self.collection, default_path, int(cfg.get('merkle_max_age') or 0))
+			except BaseException as e:
+				ui.exit_error('Failed to compare the trees of %s/%s: %s' % (self.app, self.collection, repr(e)))
+			logger.info('%d _key ranges of %s/%s differ' % (len(ranges), self.app, self.collection))
+			base_records = kv_merkle.range_records(logger, target_uri, target_session_key, self.app, self.collection, ranges)
+			records = kv_merkle.range_records(logger, source_uri, source_session_key, self.app, self.collection, ranges)
+		base_items = kv_diff.hashed_records(base_records, ignore, self.details)
+		if base_sorted:
+			base_items = kv_diff.check_order(base_items, base_name)
+		else:
+			# Backups that weren't downloaded in _key order are sorted in memory first
+			logger.info('%s is not in _key order. Sorting it in memory.' % base_name)
+			with metrics.phase('sort'):
+				base_items = kv_diff.sort_items(base_items)
+		items = kv_diff.check_order(kv_diff.hashed_records(records, ignore, self.details), source_name)
+
+		counts = {}
+		try:
+			for change, key, before, after in kv_diff.diff_items(kv_diff.prefetch(base_items), kv_diff.prefetch(items), counts):
+				if self.summary:
+					continue
+				row = {'_key': key, 'change': change, 'app': self.app, 'collection': self.collection}
+				if self.details:
+					if change == 'changed':
+						names = kv_diff.changed_fields(before, after, ignore)
+						row['changed_fields'] = names
+						row['before'] = json.dumps(dict([(n, before[n]) for n in names if n in before]), sort_keys=True)
+						row['after'] = json.dumps(dict([(n, after[n]) for n in names if n in after]), sort_keys=True)
+					elif change == 'added':
+						row['after'] = json.dumps(after, sort_keys=True)
+					else:
+						row['before'] = json.dumps(before, sort_keys=True)
+				yield row
+		except BaseException as e:
+			ui.exit_error('Failed to compare %s/%s: %s' % (self.app, self.collection, repr(e)))
+
+		metrics.count('records', counts['base_records'] + counts['source_records'])
+		if self.merkle:
+			# The records outside of the ranges that were read are unchanged
+			counts['source_records'] = source_tree.records
+			counts['base_records'] = base_tree.records
+			counts['unchanged'] = source_tree.records - counts['added'] - counts['changed']
+			metrics.count('ranges', len(ranges))
+		result = dict([(name, counts[name]) for name in ['base_records', 'source_records', 'unchanged'] + kv_diff.CHANGE_TYPES])
+		logger.info('Compared %s/%s on %s with %s: %s' % (self.app, self.collection, source_name, base_name, json.dumps(result, sort_keys=True)))
+		kv_metrics.log_metrics(logger, cfg, metrics, base=base_name, **result)
+		if self.summary:
+			row = {'app': self.app, 'collection': self.collection, 'source': source_name, 'base': base_name}
+			row.update(result)
+			row.update(metrics.fields())
+			yield row
+
+dispatch(KVStoreDiffCommand, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# KV Store Merkle Tree
+# Builds (or reads the saved) Merkle tree of a collection: hashes of the records in each
+# _key range. kvstorediff, kvstorepush and kvstorepull run this command on remote hosts
+# to compare collections without transferring their records.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import sys
+import os
+import kv_common as kv
+import kv_merkle
+from deductiv_helpers import setup_logger, search_console
+from kv_profile import profiled_command
+from splunk.clilib import cli_common as cli
+
+# Add lib folders to import path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from splunklib.searchcommands import \
+	dispatch, GeneratingCommand, Configuration, Option, validators
+
+@Configuration(distributed=False, type='reporting')
+class KVStoreMerkleCommand(profiled_command, GeneratingCommand):
+	""" %(synopsis)
+
+	##Syntax
+
+	| kvstoremerkle app="app_name" collection="collection_name" output=[root|leaves] max_age=0 leaves=256 rebuild=[true|false] expire=[true|false]
+
+	##Description
+
+	Output the Merkle tree root, or the record count and hash of each _key range, of a collection
+
+	"""
+
+	app = Option(
+		doc='''
+			Syntax: app=<appname>
+			Description: The app of the collection''',
+			require=True)
+
+	collection = Option(
+		doc='''
+			Syntax: collection=<collection_name>
+			Description: The collection to build the tree of''',
+			require=True)
+
+	output = Option(
+		doc='''
+			Syntax: output=[root|leaves]
+			Description: Output the root hash of the tree, or one row per leaf (_key range)
+			Default: root ''',
+			require=False, validate=validators.Set('root', 'leaves'))
+
+	max_age = Option(
+		doc='''
+			Syntax: max_age=<seconds>
+			Description: Use the saved tree if it was built within this many seconds, instead of reading the collection
+			Default: 0 ''',
+			require=False, validate=validators.Integer(minimum=0))
+
+	leaves = Option(
+		doc='''
+			Syntax: leaves=<integer>
+			Description: The number of _key ranges to split the collection into when new ranges are chosen
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Integer(minimum=1, maximum=65536))
+
+	rebuild = Option(
+		doc='''
+			Syntax: rebuild=[true|false]
+			Description: Choose new _key ranges instead of the ranges of the saved tree. Trees with different ranges can't be compared.
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	expire = Option(
+		doc='''
+			Syntax: expire=[true|false]
+			Description: Mark the saved tree as out of date instead of outputting the tree, so it's rebuilt the next time it's used
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
+	def generate(self):
+		try:
+			cfg = cli.getConfStanza('kvstore_tools','settings')
+		except BaseException as e:
+			self.write_error("Could not read configuration: " + repr(e))
+			exit(1)
+
+		# Facility info - prepended to log lines
+		facility = os.path.basename(__file__)
+		facility = os.path.splitext(facility)[0]
+		logger = setup_logger(cfg["log_level"], 'kvstore_tools.log', facility)
+		ui = search_console(logger, self)
+		logger.info('Script started by %s' % self._metadata.searchinfo.username)
+
+		session_key = self._metadata.searchinfo.session_key
+		splunkd_uri = self._metadata.searchinfo.splunkd_uri
+
+		# Check for permissions to run the command. Remote hosts run it for kvstorediff, kvstorepush and kvstorepull.
+		current_user = self._metadata.searchinfo.username
+		if any([kv.is_authorized(session_key, current_user, c) for c in ['run_kvstore_backup', 'run_kvstore_push', 'run_kvstore_pull']]):
+			logger.debug("User %s is authorized." % current_user)
+		else:
+			ui.exit_error("User %s is unauthorized. Has the run_kvstore_backup capability been granted?" % current_user)
+
+		if not self.output:
+			self.output = 'root'
+		if not self.leaves:
+			self.leaves = int(cfg.get('merkle_leaves') or kv_merkle.DEFAULT_LEAVES)
+
+		# Trees are saved in the backup directory
+		default_path = cfg.get('default_path').split('/')
+		default_path = os.path.expandvars(os.path.abspath(os.path.join(os.sep, *default_path))).replace('//', '/')
+
+		if self.expire:
+			try:
+				expired = kv_merkle.expire_tree(default_path, self.app, self.collection)
+			except BaseException as e:
+				ui.exit_error('Failed to expire the tree of %s/%s: %s' % (self.app, self.collection, repr(e)))
+			logger.info('Expired the tree of %s/%s: %s' % (self.app, self.collection, expired))
+			yield {'app': self.app, 'collection': self.collection, 'expired': expired}
+			return
+
+		try:
+			boundaries = None
+			if self.rebuild:
+				boundaries = kv_merkle.key_boundaries(logger, splunkd_uri, session_key, self.app, self.collection, self.leaves)
+			tree = kv_merkle.get_tree(logger, splunkd_uri, session_key, self.app, self.collection, default_path,
+				self.max_age or 0, boundaries, self.leaves)
+		except BaseException as e:
+			ui.exit_error('Failed to build the tree of %s/%s: %s' % (self.app, self.collection, repr(e)))
+
+		logger.info('Tree of %s/%s: %d records in %d leaves, root %s' % (self.app, self.collection, tree.records, len(tree.leaves), tree.root()))
+		if self.output == 'leaves':
+			for row in tree.leaf_rows():
+				yield row
+		else:
+			yield tree.root_row()
+
+dispatch(KVStoreMerkleCommand, sys.argv, sys.stdin, sys.stdout, __name__)
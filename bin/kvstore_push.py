@@ -7,33 +7,29 @@
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9
 
-from __future__ import print_function
-from builtins import str
-from future import standard_library
-standard_library.install_aliases()
 import sys
 import os
-import json
 import urllib.error
 import urllib.parse
 import kv_common as kv
-from deductiv_helpers import setup_logger, eprint, is_ipv4, search_console
+import kv_credentials
+import kv_merkle
+from deductiv_helpers import setup_logger, eprint, is_ipv4, search_console, str2bool
+from kv_profile import profiled_command
 from splunk.clilib import cli_common as cli
-import splunk.rest as rest
 
 # Add lib folders to import path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
-import splunklib.client as client
 from splunklib.searchcommands import \
 	dispatch, GeneratingCommand, Configuration, Option, validators
 
 @Configuration(distributed=False, type='reporting')
-class KVStorePushCommand(GeneratingCommand):
+class KVStorePushCommand(profiled_command, GeneratingCommand):
 	""" %(synopsis)
 
 	##Syntax  
 
-	| kvstorepush app="app_name" collection="collection_name" global_scope="false" target="remotehost[, remotehost2, ...]" append=[true|false] targetport=8089  
+	| kvstorepush app="app_name" collection="collection_name" global_scope="false" target="remotehost[, remotehost2, ...]" append=[true|false] targetport=8089 query="{...}" fields="field1, field2" sort="field1" merkle=[true|false]  
 
 	##Description  
 
@@ -77,6 +73,41 @@ class KVStorePushCommand(GeneratingCommand):
 			Description: Specify the Splunk REST API port''',
 			require=False, validate=validators.Integer(minimum=1,maximum=65535))
 
+	query = Option(
+		doc='''
+			Syntax: query=<json>
+			Description: Only include records matching the KV store query (e.g. {"status": "active"})
+			Default: All records ''',
+			require=False)
+
+	fields = Option(
+		doc='''
+			Syntax: fields=<field1, field2, ...>
+			Description: Only include the specified fields in each record (field:0 to exclude a field). Requires append=true.
+			Default: All fields ''',
+			require=False)
+
+	sort = Option(
+		doc='''
+			Syntax: sort=<field1[:1|:-1], field2, ...>
+			Description: Sort the records by the specified fields (1 ascending, -1 descending)
+			Default: None ''',
+			require=False)
+
+	merkle = Option(
+		doc='''
+			Syntax: merkle=[true|false]
+			Description: Compare the Merkle trees of the local and remote collections and only copy the _key ranges that differ. The remote host must have this app installed.
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
 	def generate(self):
 		try:
 			cfg = cli.getConfStanza('kvstore_tools','settings')
@@ -98,11 +129,8 @@ class KVStorePushCommand(GeneratingCommand):
 		splunkd_uri = self._metadata.searchinfo.splunkd_uri
 
 		# Check for permissions to run the command
-		content = rest.simpleRequest('/services/authentication/current-context?output_mode=json', sessionKey=local_session_key)[1]
-		content = json.loads(content)
 		current_user = self._metadata.searchinfo.username
-		current_user_capabilities = content['entry'][0]['content']['capabilities']
-		if 'run_kvstore_push' in current_user_capabilities or 'run_kvst_all' in current_user_capabilities or current_user == 'splunk-system-user':
+		if kv.is_authorized(local_session_key, current_user, 'run_kvstore_push'):
 			logger.debug("User %s is authorized." % current_user)
 		else:
 			ui.exit_error("User %s is unauthorized. Has the run_kvstore_push capability been granted?" % current_user)
@@ -134,6 +162,21 @@ class KVStorePushCommand(GeneratingCommand):
 		else:
 			self.targetport = '8089'
 
+		try:
+			self.query, self.fields, self.sort = kv.get_data_options(logger, self.query, self.fields, self.sort, self.append)
+		except ValueError as e:
+			ui.exit_error(str(e))
+
+		if self.merkle and (self.append or self.query or self.fields):
+			ui.exit_error("merkle=true copies whole records and can't be used with append, query or fields")
+
+		# Merkle trees are saved in the backup directory
+		default_path = cfg.get('default_path').split('/')
+		default_path = os.path.expandvars(os.path.abspath(os.path.join(os.sep, *default_path))).replace('//', '/')
+		merkle_max_age = int(cfg.get('merkle_max_age') or 0)
+		merkle_leaves = int(cfg.get('merkle_leaves') or kv_merkle.DEFAULT_LEAVES)
+		merkle_trees = str2bool(cfg.get('merkle_trees') or False) and not (self.append or self.query or self.fields)
+
 		#split target into list
 		target_list = map(str.strip, self.target.split(','))
 
@@ -141,19 +184,16 @@ class KVStorePushCommand(GeneratingCommand):
 			# Get credentials
 			try:
 				# Use the credential where the realm matches the host hostname
-				# Otherwise, use the last entry in the list
-				credentials = kv.parse_custom_credentials(logger, cfg)
+				# Otherwise, use the credential for the short hostname
+				# Only that credential is decrypted (and cached for the other targets)
+				hostname = host
 				try:
-					if self.target in list(credentials.keys()):
-						hostname = self.target
-					else:
-						if '.' in self.target and not is_ipv4(self.target):
-							hostname = self.target.split('.')[0]
+					if host not in kv_credentials.list_credentials(cfg):
+						if '.' in host and not is_ipv4(host):
+							hostname = host.split('.')[0]
 						else:
 							raise KeyError
-					credential = credentials[hostname]
-					remote_user = credential['username']
-					remote_password = credential['password']
+					remote_user, remote_password = kv_credentials.get_credential(cfg, hostname)
 				
 				except KeyError:
 					ui.exit_error("Could not get password for %s: Record not found" % hostname)
@@ -166,15 +206,8 @@ class KVStorePushCommand(GeneratingCommand):
 				remote_port = self.targetport
 				remote_uri = 'https://%s:%s' % (host, self.targetport)
 				
-				remote_service = client.connect(
-					host = remote_host,
-					port = remote_port,
-					username = remote_user,
-					password = remote_password)
-				remote_service.login()
-
-				remote_session_key = remote_service.token.replace('Splunk ', '')
-				logger.debug('Remote session key: %s' % remote_session_key)
+				# Reuse a cached session if there is one, instead of logging in on every run
+				remote_session_key = kv.get_remote_session_key(logger, remote_host, remote_port, remote_user, remote_password)
 				
 			except (urllib.error.HTTPError, BaseException) as e:
 				ui.exit_error('Failed to login to remote Splunk instance: %s' % repr(e))
@@ -188,8 +221,18 @@ class KVStorePushCommand(GeneratingCommand):
 				# Extract the app and collection name from the array
 				collection_app = local_collection[0]
 				collection_name = local_collection[1]
+				if self.merkle:
+					try:
+						row = kv_merkle.sync_collection(logger, local_session_key, splunkd_uri, remote_session_key, remote_uri, collection_app, collection_name, True, default_path, merkle_max_age)
+					except BaseException as e:
+						logger.warning('Could not compare %s/%s with %s. Copying the whole collection: %s' % (collection_app, collection_name, host, repr(e)))
+						row = None
+					if row is not None:
+						yield(row)
+						continue
 				try:
-					yield(kv.copy_collection(logger, local_session_key, splunkd_uri, remote_session_key, remote_uri, collection_app, collection_name, self.append))
+					tree = kv_merkle.download_tree(logger, splunkd_uri, local_session_key, collection_app, collection_name, default_path, merkle_leaves) if merkle_trees else None
+					yield(kv.copy_collection(logger, local_session_key, splunkd_uri, remote_session_key, remote_uri, collection_app, collection_name, self.append, self.query, self.fields, self.sort, tree))
 				except BaseException as e:
 					ui.exit_error('Failed to copy collections from %s to remote KV store: %s' % (host, repr(e)))
 			
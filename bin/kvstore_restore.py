@@ -1,26 +1,24 @@
 #!/usr/bin/env python
 
 # KV Store App Restore
-# Enables restore of backed up KV Store from json or json.gz files
+# Enables restore of backed up KV Store from json or compressed json files
 
 # Author: J.R. Murray <jr.murray@deductiv.net>
 # Version: 2.0.9
 
-from __future__ import print_function
-from builtins import str
-from future import standard_library
-standard_library.install_aliases()
 import sys
 import os
-import json
 import time
 import glob
 import re
-import gzip
 import kv_common as kv
-from deductiv_helpers import setup_logger, get_uncompressed_size, search_console
+import kv_metrics
+from deductiv_helpers import setup_logger, search_console
+from kv_profile import profiled_command
+from kv_compression import codec_from_filename, INDEX_EXTENSION
+import kv_catalog as catalog
+import kv_repository as repository
 from splunk.clilib import cli_common as cli
-import splunk.rest as rest
 
 # Add lib folders to import path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
@@ -28,16 +26,16 @@ from splunklib.searchcommands import \
     dispatch, GeneratingCommand, Configuration, Option, validators
 
 @Configuration(distributed=False, type='reporting')
-class KVStoreRestoreCommand(GeneratingCommand):
+class KVStoreRestoreCommand(profiled_command, GeneratingCommand):
 	""" %(synopsis)
 
 	##Syntax
 
-	| kvstorerestore filename="/data/backup/kvstore/app_name#*#20170130*"
+	| kvstorerestore filename="/data/backup/kvstore/app_name#*#20170130*" key="key1,key2"
 
 	##Description
 
-	Restores backed up KV Store from json or json.gz files
+	Restores backed up KV Store from json or compressed json (json.gz, json.bz2, json.xz, json.zst) files
 
 	"""
 
@@ -53,6 +51,26 @@ class KVStoreRestoreCommand(GeneratingCommand):
 			Description: Specify whether or not to delete existing entries on the target.''',
 			require=False, validate=validators.Boolean())
 
+	key = Option(
+		doc='''
+			Syntax: key=<_key1,_key2,...>
+			Description: Only restore the records with the specified _key values, adding or replacing them in the collection
+			Default: All records ''',
+			require=False)
+
+	repository = Option(
+		doc='''
+			Syntax: repository=[true|false]
+			Description: Restore from the deduplicating backup repository. The filename is matched against the backup names (app#collection#timestamp).
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
 
 	def generate(self):
 		try:
@@ -72,11 +90,8 @@ class KVStoreRestoreCommand(GeneratingCommand):
 		splunkd_uri = self._metadata.searchinfo.splunkd_uri
 
 		# Check for permissions to run the command
-		content = rest.simpleRequest('/services/authentication/current-context?output_mode=json', sessionKey=session_key)[1]
-		content = json.loads(content)
 		current_user = self._metadata.searchinfo.username
-		current_user_capabilities = content['entry'][0]['content']['capabilities']
-		if 'run_kvstore_restore' in current_user_capabilities or 'run_kvst_all' in current_user_capabilities or current_user == 'splunk-system-user':
+		if kv.is_authorized(session_key, current_user, 'run_kvstore_restore'):
 			logger.debug("User %s is authorized." % current_user)
 		else:
 			ui.exit_error("User %s is unauthorized. Has the run_kvstore_restore capability been granted?" % current_user)
@@ -86,7 +101,7 @@ class KVStoreRestoreCommand(GeneratingCommand):
 			logger.debug('Restore filename: %s' % self.filename)
 			list_only = False
 		else:
-			self.filename = "*#*#*.json*"
+			self.filename = catalog.BACKUP_FILE_PATTERN
 			list_only = True
 
 		if self.append:
@@ -95,6 +110,16 @@ class KVStoreRestoreCommand(GeneratingCommand):
 			self.append = False
 			logger.debug('Append to existing collection: %s' % str(self.append))
 
+		if self.key:
+			if list_only:
+				ui.exit_error("Specify the backup filename to restore the records from")
+			keys = [k.strip() for k in self.key.split(',') if len(k.strip()) > 0]
+			logger.debug('Restoring records with keys: %s' % str(keys))
+			# Individual records are added to (or replaced in) the existing collection
+			self.append = True
+		else:
+			keys = None
+
 		backup_file_list = []
 
 		# Get the default path from the configuration
@@ -104,87 +129,183 @@ class KVStoreRestoreCommand(GeneratingCommand):
 		default_path = os.path.expandvars(default_path)
 		default_path = default_path.replace('//', '/')
 
-		if '*' in self.filename:
+		if self.repository:
+			# Backups in the repository are manifests of deduplicated chunks
+			repo_dir = repository.repository_path(default_path)
+			pattern = '*' if list_only else os.path.basename(self.filename)
+			if pattern.endswith(repository.MANIFEST_EXTENSION):
+				pattern = pattern[:-len(repository.MANIFEST_EXTENSION)]
+			manifests = repository.list_manifests(repo_dir, pattern)
+			if len(manifests) == 0:
+				ui.exit_error("No matching backups in the repository: %s" % pattern)
+			deleted_collections = []
+			for entry in manifests:
+				if list_only:
+					yield {'filename': entry['backup'], 'app': entry['app'], 'collection': entry['collection'], 'bytes': entry['bytes'], 'records': entry['records'], 'chunks': entry['chunks'], 'status': 'ready' if entry['records'] > 0 else 'empty' }
+					continue
+				collection_id = entry['app'] + "/" + entry['collection']
+				metrics = kv_metrics.operation_metrics('upload_collection', kv.get_retry_policy(), app=entry['app'], collection=entry['collection'])
+				if not self.append and collection_id not in deleted_collections:
+					try:
+						with metrics.phase('delete'):
+							kv.delete_collection(logger, splunkd_uri, session_key, entry['app'], entry['collection'])
+						deleted_collections.append(collection_id)
+					except BaseException as e:
+						ui.exit_error('Failed to delete collection %s: %s' % (collection_id, repr(e)))
+				try:
+					records = repository.read_manifest_records(repo_dir, repository.read_manifest(entry['path']))
+					if keys is not None:
+						key_set = set(keys)
+						records = (r for r in records if str(r.get('_key')) in key_set)
+					with metrics.phase('upload'):
+						result, message, record_count = kv.save_records(logger, splunkd_uri, session_key, entry['app'], entry['collection'], records, metrics)
+				except BaseException as e:
+					logger.error("Error restoring collection from %s: %s" % (entry['backup'], repr(e)), exc_info=True)
+					result, message, record_count = 'error', 'Failed to restore collection: %s' % repr(e), 0
+				metrics.count('records', record_count)
+				row = { 'filename': entry['backup'], 'app': entry['app'], 'collection': entry['collection'], 'result': result, 'message': message }
+				row.update(metrics.fields())
+				kv_metrics.log_metrics(logger, cfg, metrics, result=result, filename=entry['backup'])
+				yield row
+			return
+
+		# Catalog entries for the backup files, by full path
+		cataloged = {}
+
+		if '*' in self.filename and os.path.dirname(self.filename) in ['', default_path] and catalog.catalog_exists(default_path):
+			# Match the wildcard against the backup catalog instead of the filesystem
+			for entry in catalog.find_catalog_entries(default_path, self.filename):
+				name = os.path.join(default_path, entry['file'])
+				cataloged[name] = entry
+				backup_file_list.append(name)
+
+			if len(backup_file_list) == 0:
+				# Backups from before the catalog existed, or copied in by hand, are only on disk
+				logger.debug('No matching files in the backup catalog: %s. Searching the backup directory.' % self.filename)
+
+		if '*' in self.filename and len(backup_file_list) == 0:
 			# Expand the wildcard to include all matching files from the filesystem
 			for name in glob.glob(self.filename):
-				backup_file_list.append(name)
+				if not name.endswith(INDEX_EXTENSION):
+					backup_file_list.append(name)
 
 			if len(backup_file_list) == 0:
 				# Check again in the default path
 				self.filename = os.path.join(default_path, self.filename)
 				for name in glob.glob(self.filename):
-					backup_file_list.append(name)
+					if not name.endswith(INDEX_EXTENSION):
+						backup_file_list.append(name)
 
 			if len(backup_file_list) == 0:
 				ui.exit_error("No matching files: %s" % self.filename)
-		else:
+		elif '*' not in self.filename:
 			logger.debug('No wildcard string found in %s' % self.filename)
 			if os.path.isfile(self.filename):
 				backup_file_list.append(self.filename)
 			elif os.path.isfile(os.path.join(default_path, self.filename)):
 				backup_file_list.append(os.path.join(default_path, self.filename))
 			else:
-				ui.exit_error("File does not exist: %s" % self.filename)
-
-		deleted_collections = []
+				# Look for the shards of a sharded backup (app#collection#timestamp#partNNN.json[.ext])
+				shard_pattern = re.sub(r'(\.(?:nd)?json.*)$', r'#part*\1', self.filename)
+				for name in glob.glob(shard_pattern) or glob.glob(os.path.join(default_path, shard_pattern)):
+					if not name.endswith(INDEX_EXTENSION):
+						backup_file_list.append(name)
+				if len(backup_file_list) == 0:
+					ui.exit_error("File does not exist: %s" % self.filename)
 
-		# f is now an array of filenames
+		# Group the shards of each backup so they are restored together
+		backups = {}
 		for name in backup_file_list:
 			logger.debug('Parsing filename: %s' % name)
-			try:
-				# Isolate the filename from the path
-				matches = re.search(r'(.*)(?:\/|\\)([^\/\\]+)', name)
-				#path = matches.group(1)
-				file_param = matches.group(2)
-				name_split = file_param.split('#')
-			except BaseException as e:
-				ui.exit_error('Invalid filename: %s\n\t%s' % (name, repr(e)))
-
-			# Open the file if it's a supported format
-			if (name.endswith('.json') or name.endswith('.json.gz')) and len(name_split)==3:
-
-				# Extract the app name and collection name from the file name
-				file_app = name_split[0]
-				file_collection = name_split[1]
-				if name.endswith('.json.gz'):
-					data_bytes = get_uncompressed_size(name)
-				else:		
-					data_bytes = os.stat(name).st_size
-				
-				if list_only:
-					status = 'ready' if data_bytes > 0 else 'empty'
-					yield {'filename': name, 'app': file_app, 'collection': file_collection, 'bytes': data_bytes, 'status': status }
+			file_info = catalog.parse_backup_filename(name)
+			if file_info is None:
+				if name.endswith('.tar.gz') or name.endswith('.tgz'):
+					logger.info('Skipping filename (unsupported format): %s' % name)
 				else:
-					if data_bytes > 0:
-						if not self.append:
-							# Delete the collection contents using the KV Store REST API
-							try:
-								collection_id = file_app + "/" + file_collection
-								# Make sure we aren't trying to delete the same collection twice
-								if not collection_id in deleted_collections:
-									kv.delete_collection(logger, splunkd_uri, session_key, file_app, file_collection)
-									deleted_collections.append(collection_id)
-							except BaseException as e:
-								ui.exit_error('Failed to delete collection %s/%s: %s' % (file_app, file_collection, repr(e)))
-						
-						# Upload the collection to the KV Store REST API
-						try:
-							result, message, record_count = kv.upload_collection(logger, splunkd_uri, session_key, file_app, file_collection, name)
-							yield({ 'filename': name, 'app': file_app, 'collection': file_collection, 'result': result, 'message': message, 'records': record_count })
-						except BaseException as e:
-							logger.error("Error restoring collection: %s" % repr(e), exc_info=True)
-							yield({ 'filename': name, 'app': file_app, 'collection': file_collection, 'result': 'error', 'message': 'Failed to delete collection: %s' % repr(e), 'records': 0})
-					else:
-						yield({ 'filename': name, 'app': file_app, 'collection': file_collection, 'result': 'skipped', 'message': f'Restored 0 records to {file_app}/{file_collection}', 'records': 0 })
-
-			elif name.endswith('.tar.gz') or name.endswith('.tgz'):
-				logger.info('Skipping filename (unsupported format): %s' % name)
+					# Skip this file
+					logger.info('Skipping filename (does not meet naming convention): %s' % name)
 				yield {'_time': time.time(), 'source': name, 'app': '', 'collection': '', 'records': 0, 'result': 'error' }
 				continue
+			backup_id = os.path.join(os.path.dirname(name), file_info['backup'])
+			backups.setdefault(backup_id, (file_info, []))[1].append(name)
+
+		def file_bytes(name):
+			codec = codec_from_filename(name)
+			if name in cataloged and cataloged[name].get('uncompressed_bytes') is not None:
+				data_bytes = cataloged[name]['uncompressed_bytes']
 			else:
-				# Skip this file
-				logger.info('Skipping filename (does not meet naming convention): %s' % name)
-				yield {'_time': time.time(), 'source': name, 'app': '', 'collection': '', 'records': 0, 'result': 'error' }
-				continue
+				data_bytes = codec.uncompressed_size(name)
+			if data_bytes is None:
+				# Size unknown without decompressing. Report the size on disk.
+				data_bytes = 0 if codec.is_empty(name) else os.stat(name).st_size
+			return data_bytes
+
+		def restore_file(name, file_app, file_collection, metrics):
+			try:
+				if keys is not None:
+					# Only decompress the parts of the backup that contain the keys
+					with metrics.phase('read'):
+						records = kv.find_backup_records(logger, name, keys)
+					logger.info('Found %d of %d keys in %s' % (len(records), len(keys), name))
+					return kv.save_records(logger, splunkd_uri, session_key, file_app, file_collection, records, metrics)
+				return kv.upload_collection(logger, splunkd_uri, session_key, file_app, file_collection, name, metrics)
+			except BaseException as e:
+				logger.error("Error restoring collection from %s: %s" % (name, repr(e)), exc_info=True)
+				return 'error', 'Failed to restore collection: %s' % repr(e), 0
+
+		deleted_collections = []
+		restore_threads = int(cfg.get('restore_threads') or 4)
+
+		for file_info, names in list(backups.values()):
+			file_app = file_info['app']
+			file_collection = file_info['collection']
+			names.sort()
+			# Report a single file name, or the list of shards
+			filename = names[0] if len(names) == 1 else names
+			data_bytes = sum([file_bytes(name) for name in names])
+
+			if list_only:
+				status = 'ready' if data_bytes > 0 else 'empty'
+				yield {'filename': filename, 'app': file_app, 'collection': file_collection, 'bytes': data_bytes, 'files': len(names), 'status': status }
+			elif data_bytes > 0:
+				metrics = kv_metrics.operation_metrics('upload_collection', kv.get_retry_policy(), app=file_app, collection=file_collection)
+				if not self.append:
+					# Delete the collection contents using the KV Store REST API
+					try:
+						collection_id = file_app + "/" + file_collection
+						# Make sure we aren't trying to delete the same collection twice
+						if not collection_id in deleted_collections:
+							with metrics.phase('delete'):
+								kv.delete_collection(logger, splunkd_uri, session_key, file_app, file_collection)
+							deleted_collections.append(collection_id)
+					except BaseException as e:
+						ui.exit_error('Failed to delete collection %s/%s: %s' % (file_app, file_collection, repr(e)))
+
+				# Upload the collection to the KV Store REST API (shards in parallel)
+				from multiprocessing.dummy import Pool as ThreadPool
+				pool = ThreadPool(max(min(restore_threads, len(names)), 1))
+				try:
+					with metrics.phase('upload'):
+						results = pool.map(lambda name: restore_file(name, file_app, file_collection, metrics), names)
+				finally:
+					pool.close()
+				record_count = sum([r[2] for r in results])
+				errors = [r[1] for r in results if r[0] == 'error']
+				if len(errors) > 0:
+					result = 'error'
+					message = errors[0] if len(names) == 1 else '%d of %d shards failed: %s' % (len(errors), len(names), errors[0])
+				elif len(names) == 1:
+					result, message = results[0][0:2]
+				else:
+					result = 'success'
+					message = "Restored %d records to %s/%s from %d shards" % (record_count, file_app, file_collection, len(names))
+				metrics.count('records', record_count)
+				metrics.count('bytes', data_bytes)
+				row = { 'filename': filename, 'app': file_app, 'collection': file_collection, 'result': result, 'message': message }
+				row.update(metrics.fields())
+				kv_metrics.log_metrics(logger, cfg, metrics, result=result, files=len(names))
+				yield(row)
+			else:
+				yield({ 'filename': filename, 'app': file_app, 'collection': file_collection, 'result': 'skipped', 'message': f'Restored 0 records to {file_app}/{file_collection}', 'records': 0 })
 
 dispatch(KVStoreRestoreCommand, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# KV Store Collection Statistics
+# Reports the record count, record sizes and field distributions of collections
+# without downloading them. Counts use key-only requests and the sizes and fields
+# are estimated from a sample of records.
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import sys
+import os
+import kv_common as kv
+import kv_stats
+from deductiv_helpers import setup_logger, search_console
+from kv_profile import profiled_command
+from splunk.clilib import cli_common as cli
+
+# Add lib folders to import path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from splunklib.searchcommands import \
+	dispatch, GeneratingCommand, Configuration, Option, validators
+
+@Configuration(distributed=False, type='reporting')
+class KVStoreStatsCommand(profiled_command, GeneratingCommand):
+	""" %(synopsis)
+
+	##Syntax
+
+	| kvstorestats app="app_name" collection="collection_name" global_scope="false" path="/data/backup/kvstore" sample=1000 count_method="probe" by_field="false" threads=4
+
+	##Description
+
+	Counts the records in each collection and estimates the record sizes and field distributions from a sample of records
+
+	"""
+
+	app = Option(
+		doc='''
+			Syntax: app=<appname>
+			Description: Specify the app to get collection statistics from
+			Default: All ''',
+			require=False)
+
+	collection = Option(
+		doc='''
+			Syntax: collection=<collection_name>
+			Description: Specify the collection to get statistics for within the specified app
+			Default: All ''',
+			require=False)
+
+	global_scope = Option(
+		doc='''
+			Syntax: global_scope=[true|false]
+			Description: Specify the whether or not to include all globally available collections
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	path = Option(
+		doc='''
+			Syntax: path=<directory>
+			Description: Specify the backup directory to save the statistics in, for kvstorebackup order=largest
+			Default: Specified in app configuration ''',
+			require=False)
+
+	sample = Option(
+		doc='''
+			Syntax: sample=<integer>
+			Description: Specify the number of records to sample from each collection. 0 to only count the records.
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Integer(minimum=0))
+
+	count_method = Option(
+		doc='''
+			Syntax: count_method=[probe|keys]
+			Description: Count records by probing for the last record (a few small requests) or by paging through the _key values (exact for collections that are changing)
+			Default: probe ''',
+			require=False, validate=validators.Set(*kv_stats.COUNT_METHODS))
+
+	by_field = Option(
+		doc='''
+			Syntax: by_field=[true|false]
+			Description: Output one row per field of each collection, with the field's presence, size and estimated cardinality
+			Default: False ''',
+			require=False, validate=validators.Boolean())
+
+	threads = Option(
+		doc='''
+			Syntax: threads=<integer>
+			Description: Specify the number of collections to process in parallel
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Integer(minimum=1, maximum=64))
+
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
+	def generate(self):
+		try:
+			cfg = cli.getConfStanza('kvstore_tools','settings')
+		except BaseException as e:
+			self.write_error("Could not read configuration: " + repr(e))
+			exit(1)
+
+		# Facility info - prepended to log lines
+		facility = os.path.basename(__file__)
+		facility = os.path.splitext(facility)[0]
+		logger = setup_logger(cfg["log_level"], 'kvstore_tools.log', facility)
+		ui = search_console(logger, self)
+		logger.info('Script started by %s' % self._metadata.searchinfo.username)
+
+		session_key = self._metadata.searchinfo.session_key
+		splunkd_uri = self._metadata.searchinfo.splunkd_uri
+
+		# Check for permissions to run the command
+		current_user = self._metadata.searchinfo.username
+		if kv.is_authorized(session_key, current_user, 'run_kvstore_backup'):
+			logger.debug("User %s is authorized." % current_user)
+		else:
+			ui.exit_error("User %s is unauthorized. Has the run_kvstore_backup capability been granted?" % current_user)
+
+		if self.sample is None:
+			self.sample = int(cfg.get('stats_sample_size') or 1000)
+		if not self.count_method:
+			self.count_method = 'probe'
+		if not self.threads:
+			self.threads = int(cfg.get('stats_threads') or 4)
+
+		app_list = kv.get_server_apps(splunkd_uri, session_key, self.app)
+		collection_list = kv.get_app_collections(splunkd_uri, session_key, self.collection, self.app, app_list, self.global_scope or False)
+		if len(collection_list) == 0:
+			ui.exit_error("No matching collections found")
+		logger.info('Collecting statistics for %d collections with %d threads (sample size %d)' % (len(collection_list), self.threads, self.sample))
+
+		def get_stats(collection):
+			try:
+				return kv_stats.collection_stats(logger, splunkd_uri, session_key, collection[0], collection[1], self.sample, self.count_method)
+			except BaseException as e:
+				logger.error('Could not get statistics for %s/%s: %s' % (collection[0], collection[1], repr(e)))
+				return {'app': collection[0], 'collection': collection[1], 'result': 'error', 'message': repr(e)}, []
+
+		from multiprocessing.dummy import Pool as ThreadPool
+		pool = ThreadPool(min(self.threads, len(collection_list)))
+		results = []
+		try:
+			for stats, field_stats in pool.imap(get_stats, collection_list):
+				if 'result' not in stats:
+					results.append(stats)
+				if self.by_field:
+					for field in field_stats:
+						row = {'app': stats['app'], 'collection': stats['collection'], 'records': stats['records']}
+						row.update(field)
+						yield row
+				else:
+					yield stats
+		finally:
+			pool.close()
+
+		# Save the statistics so kvstorebackup can order collections by size
+		try:
+			if not self.path:
+				default_path = cfg.get('default_path').split('/')
+				self.path = os.path.abspath(os.path.join(os.sep, *default_path))
+			self.path = os.path.expandvars(self.path).replace('//', '/')
+			if os.path.isdir(self.path):
+				kv_stats.save_stats(self.path, results)
+		except BaseException as e:
+			logger.warning('Could not save collection statistics: %s' % repr(e))
+
+dispatch(KVStoreStatsCommand, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# KV Store Backup Verification
+# Checks backup files against the checksums and record counts in the backup catalog
+# Files are checked in parallel and are never parsed as JSON
+
+# Author: J.R. Murray <jr.murray@deductiv.net>
+# Version: 2.0.9
+
+import sys
+import os
+import time
+import kv_common as kv
+import kv_catalog as catalog
+from deductiv_helpers import setup_logger, search_console
+from kv_profile import profiled_command
+from splunk.clilib import cli_common as cli
+
+# Add lib folders to import path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from splunklib.searchcommands import \
+	dispatch, GeneratingCommand, Configuration, Option, validators
+
+@Configuration(distributed=False, type='reporting')
+class KVStoreVerifyCommand(profiled_command, GeneratingCommand):
+	""" %(synopsis)
+
+	##Syntax
+
+	| kvstoreverify filename="app_name#*#20230130*" path="/data/backup/kvstore" threads=8
+
+	##Description
+
+	Verifies backup files against the checksums and record counts recorded in the backup catalog
+
+	"""
+
+	filename = Option(
+		doc='''
+			Syntax: filename=<filename>
+			Description: Specify the backup file(s) to verify. Wildcards are allowed.
+			Default: All backups in the catalog ''',
+			require=False)
+
+	path = Option(
+		doc='''
+			Syntax: path=<directory>
+			Description: Specify the backup directory
+			Default: Specified in app configuration ''',
+			require=False)
+
+	threads = Option(
+		doc='''
+			Syntax: threads=<integer>
+			Description: Specify the number of files to verify in parallel
+			Default: 4 ''',
+			require=False, validate=validators.Integer(minimum=1, maximum=64))
+
+	profile = Option(
+		doc='''
+			Syntax: profile=[true|false]
+			Description: Profile the command with cProfile and write the results to the search's dispatch directory
+			Default: Specified in app configuration ''',
+			require=False, validate=validators.Boolean())
+
+	def generate(self):
+		try:
+			cfg = cli.getConfStanza('kvstore_tools','settings')
+		except BaseException as e:
+			self.write_error("Could not read configuration: " + repr(e))
+			exit(1)
+		
+		# Facility info - prepended to log lines
+		facility = os.path.basename(__file__)
+		facility = os.path.splitext(facility)[0]
+		logger = setup_logger(cfg["log_level"], 'kvstore_tools.log', facility)
+		ui = search_console(logger, self)
+		logger.info('Script started by %s' % self._metadata.searchinfo.username)
+
+		session_key = self._metadata.searchinfo.session_key
+
+		# Check for permissions to run the command
+		current_user = self._metadata.searchinfo.username
+		if kv.is_authorized(session_key, current_user, 'run_kvstore_backup'):
+			logger.debug("User %s is authorized." % current_user)
+		else:
+			ui.exit_error("User %s is unauthorized. Has the run_kvstore_backup capability been granted?" % current_user)
+
+		if not self.path:
+			# Get path from configuration
+			try:
+				# Break path out and re-join it so it's OS independent
+				default_path = cfg.get('default_path').split('/')
+				self.path = os.path.abspath(os.path.join(os.sep, *default_path))
+			except:
+				ui.exit_error("Unable to get backup path. Path not provided in search arguments and default path is not set.")
+
+		# Replace environment variables
+		self.path = os.path.expandvars(self.path)
+		self.path = self.path.replace('//', '/')
+		logger.debug('Backup path: %s' % self.path)
+		if not os.path.isdir(self.path):
+			ui.exit_error("Path does not exist: {0}".format(self.path))
+
+		if not self.filename:
+			self.filename = catalog.BACKUP_FILE_PATTERN
+		if not self.threads:
+			self.threads = 4
+
+		if not catalog.catalog_exists(self.path):
+			catalog.rebuild_catalog(logger, self.path)
+		entries = catalog.find_catalog_entries(self.path, self.filename)
+		if len(entries) == 0:
+			ui.exit_error("No matching files in the backup catalog: %s" % self.filename)
+		logger.info("Verifying %d backup files with %d threads" % (len(entries), self.threads))
+
+		def verify(entry):
+			filename = os.path.join(self.path, entry['file'])
+			start_time = time.time()
+			result = catalog.verify_backup_file(filename, entry)
+			result.update({'_time': time.time(), 'filename': filename, 'app': entry['app'], 'collection': entry['collection'],
+				'expected_records': entry.get('records'), 'expected_checksum': entry.get('checksum'),
+				'seconds': round(time.time() - start_time, 3)})
+			if result['status'] == 'invalid':
+				logger.warning("Backup verification failed for %s: %s" % (filename, result['message']))
+			return result
+
+		from multiprocessing.dummy import Pool as ThreadPool
+		pool = ThreadPool(min(self.threads, len(entries)))
+		try:
+			for result in pool.imap(verify, entries):
+				yield result
+		finally:
+			pool.close()
+
+dispatch(KVStoreVerifyCommand, sys.argv, sys.stdin, sys.stdout, __name__)